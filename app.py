@@ -5,20 +5,29 @@ Run with: streamlit run app.py
 
 import streamlit as st
 import pandas as pd
-import numpy as np
-from io import BytesIO
 from pathlib import Path
 from datetime import datetime
 import re
 import folium
-import leafmap.foliumap as leafmap
+from folium.plugins import DualMap
+import leafmap.foliumap as leafmap
 from dotenv import load_dotenv
-import os
-import rioxarray
-import rasterio
-import tempfile
-import requests
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import rasterio
+from azure.core import MatchConditions
 from azure.storage.blob import BlobServiceClient
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from utils.cache_rasters import CacheRasters, MemoLRU
+from utils.manifiesto import imagenes_de_bpin, leer_manifiesto_si_cambio
+from utils.metadata_proyectos import COLUMNAS_APP, cargar_metadata
+from utils.visualizacion import (
+    MODOS, PREFIJO_DERIVADOS, blob_derivado, estadisticas_desde_metadata,
+    leer_reflectancia, overlay_web, renderizar,
+)
 
 load_dotenv()
 
@@ -37,8 +46,14 @@ PROJECT_METADATA_SHEET_NAME = os.getenv(
     "proyectos_satview",
 )
 
-AZURE_CONN_STR  = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-AZURE_CONTAINER = os.getenv("AZURE_CONTAINER", "imagenes-sentinel")
+AZURE_CONN_STR  = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+AZURE_CONTAINER = os.getenv("AZURE_CONTAINER", "imagenes-sentinel")
+
+# Seconds between conditional checks of the container manifest
+TTL_MANIFIESTO = 60
+
+# Selected images downloaded and processed at the same time
+MAX_DESCARGAS_PARALELAS = int(os.getenv("MAX_PARALLEL_DOWNLOADS", "4"))
 
 MESES_ES = {
     "01": "Enero",   "02": "Febrero",    "03": "Marzo",      "04": "Abril",
@@ -101,42 +116,39 @@ st.markdown("""
 
 # ── Google Sheets (project metadata) ────────────────────────────────
 
-def _metadata_download_url(url: str) -> str:
-    if "sharepoint.com" in url and "/:x:/" in url:
-        return url.split("?", 1)[0] + "?download=1"
-    return url
-
-
-@st.cache_data(ttl=300, show_spinner=False)
+# cache_resource rather than cache_data: the sheet is only read, so every
+# rerun can share one DataFrame instead of unpickling a fresh copy.
+@st.cache_resource(ttl=300, show_spinner=False)
 def cargar_hoja_proyectos() -> pd.DataFrame:
     if not PROJECT_METADATA_XLSX_URL:
         st.error("Missing environment variable: PROJECT_METADATA_XLSX_URL")
         st.stop()
 
-    response = requests.get(_metadata_download_url(PROJECT_METADATA_XLSX_URL), timeout=120)
-    response.raise_for_status()
-    excel_bytes = BytesIO(response.content)
-    try:
-        df = pd.read_excel(
-            excel_bytes,
-            sheet_name=PROJECT_METADATA_SHEET_NAME,
-            dtype=str,
-        )
-    except ValueError:
-        excel_bytes.seek(0)
-        df = pd.read_excel(excel_bytes, sheet_name=0, dtype=str)
-    df.columns = [c.strip() for c in df.columns]
-    return df
-
-
-def buscar_proyecto(bpin: str) -> dict | None:
-    df = cargar_hoja_proyectos()
-    if df.empty or "bpin" not in df.columns:
-        return None
-    match = df[df["bpin"].astype(str).str.strip() == bpin.strip()]
-    if match.empty:
-        return None
-    return match.iloc[0].to_dict()
+    # Conditional request: once the TTL expires, an unchanged workbook costs
+    # a 304 and a local Parquet read instead of a download and an Excel parse.
+    return cargar_metadata(PROJECT_METADATA_XLSX_URL, PROJECT_METADATA_SHEET_NAME,
+                           COLUMNAS_APP)
+
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _indice_proyectos(version: str, _df: pd.DataFrame) -> dict:
+    """
+    Normalized BPIN -> row dict. Keyed by the sheet version, so it is built
+    once per change of the workbook, not on every rerun. The first row of a
+    duplicated BPIN wins.
+    """
+    indice = {}
+    for bpin, fila in zip(_df["bpin"].astype(str).str.strip(), _df.to_dict("records")):
+        indice.setdefault(bpin, fila)
+    return indice
+
+
+def buscar_proyecto(bpin: str) -> dict | None:
+    df = cargar_hoja_proyectos()
+    if df.empty or "bpin" not in df.columns:
+        return None
+    fila = _indice_proyectos(df.attrs.get("version"), df).get(bpin.strip())
+    return dict(fila) if fila is not None else None
 
 
 # ── Azure Blob Storage (satellite images) ────────────────────────────
@@ -157,23 +169,78 @@ def parsear_fecha_archivo(filename: str) -> datetime | None:
         return None
 
 
-@st.cache_data(ttl=300, show_spinner=False)
-def listar_imagenes(bpin: str) -> list[dict]:
-    container_client = _azure_container_client()
-    prefix = f"sentinel2_{bpin}/"
-    result = []
-    try:
-        for blob in container_client.list_blobs(name_starts_with=prefix):
-            filename = blob.name.split("/")[-1]
-            if not filename.lower().endswith((".tiff", ".tif")):
-                continue
-            fecha = parsear_fecha_archivo(filename)
-            result.append({
-                "bucket_path": blob.name,
-                "filename":    filename,
-                "fecha":       fecha,
-                "label":       fecha.strftime("%b %Y") if fecha else Path(filename).stem,
-            })
+# Last manifest read by this instance. After TTL_MANIFIESTO it is checked
+# again with a conditional request: an unchanged manifest costs a 304.
+@st.cache_resource(show_spinner=False)
+def _estado_manifiesto() -> dict:
+    return {"lock": threading.Lock(), "manifiesto": None, "etag": None, "leido": 0.0}
+
+
+def manifiesto_actual() -> dict | None:
+    estado = _estado_manifiesto()
+    with estado["lock"]:
+        if time.monotonic() - estado["leido"] >= TTL_MANIFIESTO:
+            try:
+                manifiesto, etag = leer_manifiesto_si_cambio(_azure_container_client(), estado["etag"])
+            except Exception as e:
+                print(f"Could not read the container manifest: {e}")
+            else:
+                if manifiesto is not None or etag is None:
+                    estado["manifiesto"] = manifiesto
+                estado["etag"]  = etag
+                estado["leido"] = time.monotonic()
+        return estado["manifiesto"]
+
+
+def _item_imagen(bucket_path: str, etag: str, estadisticas: dict | None, derivados: dict) -> dict:
+    """`derivados` maps each rendered mode to its blob's ETag."""
+    filename = bucket_path.split("/")[-1]
+    fecha    = parsear_fecha_archivo(filename)
+    return {
+        "bucket_path":  bucket_path,
+        "filename":     filename,
+        "fecha":        fecha,
+        "label":        fecha.strftime("%b %Y") if fecha else Path(filename).stem,
+        "etag":         etag,
+        "derivados":    {modo: {"bucket_path": blob_derivado(bucket_path, modo), "etag": et}
+                         for modo, et in derivados.items()},
+        "estadisticas": estadisticas,
+    }
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def listar_imagenes(bpin: str) -> list[dict]:
+    """
+    Images of `bpin` from the container manifest; a BPIN the manifest does
+    not know (or a container without one) falls back to listing its prefix.
+    """
+    manifiesto = manifiesto_actual()
+    entradas   = imagenes_de_bpin(manifiesto, bpin) if manifiesto else []
+    if entradas:
+        result = [_item_imagen(e["blob"], e["etag"], e.get("estadisticas"), e.get("derivados", {}))
+                  for e in entradas]
+        result.sort(key=lambda x: x["fecha"] or datetime.min)
+        return result
+    return listar_imagenes_azure(bpin)
+
+
+def listar_imagenes_azure(bpin: str) -> list[dict]:
+    container_client = _azure_container_client()
+    prefix = f"sentinel2_{bpin}/"
+    result = []
+    try:
+        derivados = {blob.name: blob.etag for blob in
+                     container_client.list_blobs(name_starts_with=PREFIJO_DERIVADOS + prefix)}
+        # Stats written by the pipeline travel as blob metadata, so the list
+        # already knows which months are empty without downloading them.
+        for blob in container_client.list_blobs(name_starts_with=prefix, include=["metadata"]):
+            if not blob.name.lower().endswith((".tiff", ".tif")):
+                continue
+            result.append(_item_imagen(
+                blob.name, blob.etag, estadisticas_desde_metadata(blob.metadata),
+                {modo: derivados[blob_derivado(blob.name, modo)] for modo in MODOS
+                 if blob_derivado(blob.name, modo) in derivados},
+            ))
     except Exception as e:
         st.error(f"Error accessing Azure Blob container: {e}")
         return []
@@ -181,18 +248,36 @@ def listar_imagenes(bpin: str) -> list[dict]:
     return result
 
 
-@st.cache_data(ttl=300, show_spinner=False)
-def descargar_tiff_temp(bucket_path: str) -> str | None:
-    try:
-        container_client = _azure_container_client()
-        blob_client = container_client.get_blob_client(bucket_path)
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".tiff")
-        with open(tmp.name, "wb") as f:
-            f.write(blob_client.download_blob().readall())
-        return tmp.name
-    except Exception as e:
-        st.error(f"Failed to download {bucket_path}: {e}")
-        return None
+# One disk cache per instance, shared by every session: entries are keyed
+# by blob name and ETag, so they outlive reruns and the listing TTL.
+@st.cache_resource(show_spinner=False)
+def _cache_rasters() -> CacheRasters:
+    return CacheRasters()
+
+
+# Prepared images by (bucket_path, etag, modo): reruns and mode switches
+# with unchanged inputs reuse the result without touching the raster.
+@st.cache_resource(show_spinner=False)
+def _renders_preparados() -> MemoLRU:
+    return MemoLRU()
+
+
+def descargar_raster(bucket_path: str, etag: str) -> str | None:
+    def descargar(destino: str) -> None:
+        blob_client = _azure_container_client().get_blob_client(bucket_path)
+        # The ETag condition guarantees the bytes match the cache key even if
+        # the blob was overwritten after it was listed.
+        descarga = blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+        with open(destino, "wb") as f:
+            descarga.readinto(f)
+
+    # No st.error here: this runs on the worker threads of preparar_imagenes,
+    # which cannot write to the page. The caller reports the "error" state.
+    try:
+        return _cache_rasters().obtener_o_crear(f"{bucket_path}@{etag}", descargar)
+    except Exception as e:
+        print(f"Failed to download {bucket_path}: {e}")
+        return None
 
 
 # ── Coordinate and image processing helpers ─────────────────────────
@@ -212,60 +297,147 @@ def dms_to_decimal(dms_str) -> float | None:
     return decimal
 
 
-def stretch_percentile(band: np.ndarray) -> np.ndarray:
-    valid = band[~np.isnan(band)]
-    if valid.size == 0:
-        return np.zeros_like(band)
-    p2, p98 = np.percentile(valid, (2, 98))
-    if p98 == p2:
-        return np.where(np.isnan(band), 0.0, 0.5)
-    stretched = np.clip((band - p2) / (p98 - p2), 0, 1)
-    stretched = np.power(stretched, 1 / 1.2)
-    stretched = np.where(np.isnan(band), 0.0, stretched)
-    return stretched
-
-
-def generar_tiff_procesado(path_entrada: str, modo: str) -> str:
-    data = rioxarray.open_rasterio(path_entrada)
-
-    if modo == "gris":
-        banda = data.sel(band=3).values.astype(float)
-        canal = stretch_percentile(banda)
-        rgb = np.stack([canal, canal, canal])
-    elif modo == "falso":
-        bandas = data.sel(band=[4, 3, 2]).values.astype(float)
-        rgb = np.stack([stretch_percentile(bandas[i]) for i in range(3)])
-    else:
-        bandas = data.sel(band=[3, 2, 1]).values.astype(float)
-        rgb = np.stack([stretch_percentile(bandas[i]) for i in range(3)])
-
-    nan_mask = np.isnan(data.sel(band=3).values.astype(float))
-    for i in range(3):
-        rgb[i][nan_mask] = 0.0
-
-    rgb_uint8 = (rgb * 255).astype(np.uint8)
-
-    tmp = tempfile.NamedTemporaryFile(suffix=".tif", delete=False)
-    with rasterio.open(
-        tmp.name, "w", driver="GTiff",
-        height=rgb_uint8.shape[1], width=rgb_uint8.shape[2],
-        count=3, dtype=rasterio.uint8,
-        crs=data.rio.crs, transform=data.rio.transform(),
-    ) as dst:
-        dst.write(rgb_uint8)
-
-    return tmp.name
-
-
-def tiff_has_data(path: str) -> bool:
-    try:
-        data = rioxarray.open_rasterio(path)
-        arr  = data.sel(band=3).values.astype(float)
-        return np.any(~np.isnan(arr))
-    except Exception:
-        return False
+def generar_tiff_procesado(path_entrada: str, modo: str, path_salida: str,
+                           estadisticas: dict | None = None) -> bool:
+    """
+    Writes the `modo` rendering of `path_entrada` to `path_salida` and
+    returns whether the image has any valid pixel. The raster is decoded
+    once, as float32 reflectance (scaled-int16 files included).
+    """
+    bandas, perfil = leer_reflectancia(path_entrada)
+    rgb_uint8, tiene_datos = renderizar(bandas, modo, estadisticas)
+
+    with rasterio.open(
+        path_salida, "w", driver="GTiff",
+        height=rgb_uint8.shape[1], width=rgb_uint8.shape[2],
+        count=3, dtype=rasterio.uint8,
+        crs=perfil["crs"], transform=perfil["transform"],
+    ) as dst:
+        dst.write(rgb_uint8)
+
+    return tiene_datos
+
+
+def render_tiene_datos(path: str) -> bool:
+    """A rendering is empty when every pixel is 0: any valid pixel stretches above 0."""
+    with rasterio.open(path) as src:
+        return bool(src.read(1).any())
 
 
+def sin_datos(img: dict) -> bool:
+    """True when the pipeline stats say no pixel survived the cloud mask."""
+    est = img.get("estadisticas")
+    return est is not None and est.get("fraccion_valida", 1.0) == 0
+
+
+def render_memorizado(img: dict, modo: str) -> tuple | None:
+    """(tif, estado) prepared earlier for the same blob version and mode, if its file is still cached."""
+    clave  = (img["bucket_path"], img["etag"], modo)
+    previo = _renders_preparados().obtener(clave)
+    if previo is None:
+        return None
+    tif, _ = previo
+    if tif is not None and not _cache_rasters().vigente(tif):
+        _renders_preparados().descartar(clave)
+        return None
+    return previo
+
+
+def _preparar_y_memorizar(img: dict, modo: str) -> tuple:
+    # Failures are not remembered, so the next rerun retries them.
+    resultado = preparar_imagen(img, modo)
+    if resultado[1] != "error":
+        _renders_preparados().guardar((img["bucket_path"], img["etag"], modo), resultado)
+    return resultado
+
+
+def preparar_imagen(img: dict, modo: str) -> tuple:
+    """
+    Returns (tif, estado) for one listed image, estado being "ok", "vacia"
+    or "error". Uses the derivative pre-rendered by the pipeline when there
+    is one, so only a download is needed; older blobs are rendered here.
+    Images with pipeline stats are neither downloaded when empty nor scanned
+    for data, and are stretched with the stored percentiles.
+    """
+    if sin_datos(img):
+        return None, "vacia"
+    derivado = img.get("derivados", {}).get(modo)
+    if derivado:
+        tif = descargar_raster(derivado["bucket_path"], derivado["etag"])
+        if tif is not None:
+            return tif, "ok"
+
+    tif, tiene_datos = renderizar_crudo(img, modo)
+    if tif is None:
+        return None, "error"
+    return tif, "ok" if tiene_datos else "vacia"
+
+
+def preparar_imagenes(imagenes: list, modo: str):
+    """
+    Runs preparar_imagen for every image on a bounded thread pool and
+    yields (indice, tif, estado) in completion order, so the caller can draw
+    each map as soon as its image is ready instead of after the slowest.
+    Images already prepared on an earlier rerun are yielded first, without
+    going through the pool.
+    """
+    pendientes = []
+    for i, img in enumerate(imagenes):
+        previo = render_memorizado(img, modo)
+        if previo is None:
+            pendientes.append(i)
+        else:
+            yield (i, *previo)
+    if not pendientes:
+        return
+
+    ctx = get_script_run_ctx()
+    # Worker threads get the session's script context so the cached
+    # resources (container client, disk cache) resolve as on the main thread.
+    inicializar = lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DESCARGAS_PARALELAS, len(pendientes))),
+                            initializer=inicializar) as pool:
+        futuros = {pool.submit(_preparar_y_memorizar, imagenes[i], modo): i for i in pendientes}
+        for futuro in as_completed(futuros):
+            try:
+                tif, estado = futuro.result()
+            except Exception as e:
+                print(f"Failed to prepare {imagenes[futuros[futuro]]['bucket_path']}: {e}")
+                tif, estado = None, "error"
+            yield futuros[futuro], tif, estado
+
+
+def renderizar_crudo(img: dict, modo: str) -> tuple:
+    """
+    Renders `modo` from the raw blob, through the disk cache like the
+    downloads. Returns (tif, tiene_datos); tif is None on failure. The
+    rendering also gives the emptiness verdict, so the raw raster is
+    decoded once; on a cache hit the verdict comes from the cached
+    rendering, or from the pipeline stats when there are any.
+    """
+    veredicto = {}
+
+    def crear(destino: str) -> None:
+        raw_path = descargar_raster(img["bucket_path"], img["etag"])
+        if raw_path is None:
+            raise RuntimeError(f"could not download {img['bucket_path']}")
+        veredicto["tiene_datos"] = generar_tiff_procesado(raw_path, modo, destino,
+                                                          img.get("estadisticas"))
+
+    try:
+        tif = _cache_rasters().obtener_o_crear(f"{img['bucket_path']}@{img['etag']}#{modo}", crear)
+    except Exception as e:
+        print(f"Failed to render {img['bucket_path']}: {e}")
+        return None, False
+    if tif is None:
+        return None, False
+    if "tiene_datos" in veredicto:
+        return tif, veredicto["tiene_datos"]
+    if img.get("estadisticas") is not None:
+        return tif, not sin_datos(img)
+    return tif, render_tiene_datos(tif)
+
+
 def add_project_marker(mapa, lat: float, lon: float, nombre: str):
     folium.Marker(
         location=[lat, lon],
@@ -275,11 +447,40 @@ def add_project_marker(mapa, lat: float, lon: float, nombre: str):
     ).add_to(mapa)
 
 
-def crear_mapa_individual(tiff_path: str, lat: float, lon: float, label: str) -> leafmap.Map:
-    m = leafmap.Map(center=[lat, lon], zoom=14, draw_control=False,
-                    measure_control=False, fullscreen_control=True)
-    m.add_raster(tiff_path, layer_name=label)
-    return m
+# Keyed by the cached file path, which is content-addressed (blob, ETag,
+# mode), so an entry can never go stale.
+@st.cache_data(max_entries=64, show_spinner=False)
+def overlay_imagen(tiff_path: str) -> tuple:
+    return overlay_web(tiff_path)
+
+
+def agregar_overlay(mapa, tiff_path: str, label: str) -> None:
+    """
+    Embeds the rendering as a downsampled image in the map HTML, with bounds
+    from its transform: no tile server, and a payload bounded by
+    LADO_OVERLAY whatever the raster size.
+    """
+    url, bounds = overlay_imagen(tiff_path)
+    folium.raster_layers.ImageOverlay(image=url, bounds=bounds, name=label).add_to(mapa)
+
+
+def crear_mapa_individual(tiff_path: str, lat: float, lon: float, label: str) -> leafmap.Map:
+    m = leafmap.Map(center=[lat, lon], zoom=14, draw_control=False,
+                    measure_control=False, fullscreen_control=True)
+    agregar_overlay(m, tiff_path, label)
+    return m
+
+
+def crear_mapa_comparacion(izquierda: tuple, derecha: tuple, lat: float, lon: float) -> DualMap:
+    """
+    Two synchronized maps side by side; `izquierda` and `derecha` are
+    (tiff_path, label), with tiff_path None for an image without data.
+    """
+    m = DualMap(location=[lat, lon], zoom_start=14, tiles="OpenStreetMap")
+    for mapa, (tiff_path, label) in ((m.m1, izquierda), (m.m2, derecha)):
+        if tiff_path is not None:
+            agregar_overlay(mapa, tiff_path, label)
+    return m
 
 
 def render_map(m, height: int = 600) -> None:
@@ -290,8 +491,11 @@ def render_map(m, height: int = 600) -> None:
     to cp1252, which crashes on any non-ASCII character (accents, tildes)
     in the map content. This renders the HTML directly in memory as UTF-8.
     """
-    import streamlit.components.v1 as components
-    m.add_layer_control()
+    import streamlit.components.v1 as components
+    if isinstance(m, leafmap.Map):
+        m.add_layer_control()
+    else:
+        folium.LayerControl().add_to(m)
     html = m.get_root().render()
     components.html(html, height=height, scrolling=False)
 
@@ -420,17 +624,25 @@ with sidebar_col:
     # Image selection
     st.markdown('<div class="section-title">Imagenes disponibles</div>', unsafe_allow_html=True)
 
-    anios = {}
-    for img in imagenes:
+    vacias = [img for img in imagenes if sin_datos(img)]
+    visibles = imagenes
+    if vacias:
+        mostrar_vacias = st.toggle(f"Mostrar meses sin datos ({len(vacias)})", value=False)
+        if not mostrar_vacias:
+            visibles = [img for img in imagenes if not sin_datos(img)]
+
+    anios = {}
+    for img in visibles:
         anio = img["fecha"].year if img["fecha"] else "Sin fecha"
         anios.setdefault(anio, []).append(img)
 
     seleccionadas = []
     for anio, imgs in sorted(anios.items()):
         with st.expander(f"{anio}  --  {len(imgs)} imagenes", expanded=True):
-            for img in imgs:
-                checked = st.checkbox(
-                    f"**{img['label']}**  `S-2`",
+            for img in imgs:
+                nubes = (img["estadisticas"] or {}).get("pct_nubes")
+                checked = st.checkbox(
+                    f"**{img['label']}**  `S-2`" + (f"  ·  {nubes:.0f}% nubes" if nubes is not None else ""),
                     key=f"cb_{img['filename']}",
                     value=False,
                 )
@@ -448,7 +660,13 @@ with sidebar_col:
 
     # Comparison and marker toggles
     modo_comparar    = st.toggle("Modo comparacion (2 imagenes)", value=False)
-    mostrar_marcador = st.toggle("Mostrar ubicacion del proyecto", value=False)
+    mostrar_marcador = st.toggle("Mostrar ubicacion del proyecto", value=False)
+
+    cache = _cache_rasters().metricas()
+    memo  = _renders_preparados().metricas()
+    st.caption(f"Cache de rasters: {cache['aciertos']} aciertos, {cache['fallos']} fallos, "
+               f"{cache['mb']:.0f} MB · {memo['entradas']} vistas en memoria, "
+               f"{memo['aciertos']} reutilizadas")
 
 
 # ── Main area ─────────────────────────────────────────────────────
@@ -483,35 +701,29 @@ with main_col:
 
         st.markdown(f"### Comparacion: {anterior['label']} vs {reciente['label']}")
 
-        with st.spinner("Procesando imagenes satelitales..."):
-            left_path  = descargar_tiff_temp(anterior["bucket_path"])
-            right_path = descargar_tiff_temp(reciente["bucket_path"])
-
-            if left_path is None or right_path is None:
-                st.error("No se pudieron descargar una o ambas imagenes.")
-                st.stop()
-
-            left_empty  = not tiff_has_data(left_path)
-            right_empty = not tiff_has_data(right_path)
-
-            if left_empty and right_empty:
-                st.error("Ambas imagenes estan vacias (sin datos). Selecciona otros meses.")
-                st.stop()
-            if left_empty:
-                st.warning(f"{anterior['label']} no tiene datos (nubosidad total).")
-            if right_empty:
-                st.warning(f"{reciente['label']} no tiene datos (nubosidad total).")
-
-            left_tif  = generar_tiff_procesado(left_path, modo)
-            right_tif = generar_tiff_procesado(right_path, modo)
-
-        m = leafmap.Map(center=[proj_lat, proj_lon], zoom=14,
-                        draw_control=False, measure_control=False)
-        m.split_map(
-            left_layer=left_tif,
-            right_layer=right_tif,
-            left_label=f"Anterior ({anterior['label']})",
-            right_label=f"Reciente ({reciente['label']})",
+        with st.spinner("Procesando imagenes satelitales..."):
+            listas = {i: (tif, estado) for i, tif, estado in preparar_imagenes(par, modo)}
+            (left_tif, left_estado), (right_tif, right_estado) = listas[0], listas[1]
+
+            if "error" in (left_estado, right_estado):
+                st.error("No se pudieron descargar una o ambas imagenes.")
+                st.stop()
+
+            if left_estado == "vacia" and right_estado == "vacia":
+                st.error("Ambas imagenes estan vacias (sin datos). Selecciona otros meses.")
+                st.stop()
+            # An empty month leaves its side with the base map only.
+            if left_estado == "vacia":
+                st.warning(f"{anterior['label']} no tiene datos (nubosidad total).")
+                left_tif = None
+            if right_estado == "vacia":
+                st.warning(f"{reciente['label']} no tiene datos (nubosidad total).")
+                right_tif = None
+
+        m = crear_mapa_comparacion(
+            (left_tif,  f"Anterior ({anterior['label']})"),
+            (right_tif, f"Reciente ({reciente['label']})"),
+            proj_lat, proj_lon,
         )
         if mostrar_marcador:
             add_project_marker(m, proj_lat, proj_lon, nombre_proy)
@@ -535,36 +747,32 @@ with main_col:
 
         st.markdown(f"### Galeria  --  {len(ordenadas)} imagen(es) seleccionadas")
 
-        with st.spinner("Descargando y procesando imagenes..."):
-            processed = []
-            for img in ordenadas:
-                raw_path = descargar_tiff_temp(img["bucket_path"])
-                if raw_path is None:
-                    processed.append({"img": img, "tif": None, "empty": True})
-                    continue
-                empty = not tiff_has_data(raw_path)
-                tif   = None if empty else generar_tiff_procesado(raw_path, modo)
-                processed.append({"img": img, "tif": tif, "empty": empty})
-
-        for row_start in range(0, len(processed), 2):
-            row_items = processed[row_start:row_start + 2]
+        # The grid is laid out first, with a placeholder per image; each one
+        # is filled as soon as its download and processing finish.
+        huecos = []
+        for row_start in range(0, len(ordenadas), 2):
             cols = st.columns(2)
-
-            for col, item in zip(cols, row_items):
+            for col, img in zip(cols, ordenadas[row_start:row_start + 2]):
                 with col:
-                    img       = item["img"]
                     label     = img["label"]
                     fecha_str = img["fecha"].strftime("%d/%m/%Y") if img["fecha"] else "-"
-
                     st.markdown(
                         f'<div class="gallery-label">{label} <small>| Sentinel-2 | {fecha_str}</small></div>',
                         unsafe_allow_html=True,
                     )
-
-                    if item["empty"]:
-                        st.warning(f"Sin datos para {label} (nubosidad total).")
-                    else:
-                        gm = crear_mapa_individual(item["tif"], proj_lat, proj_lon, label)
-                        if mostrar_marcador:
-                            add_project_marker(gm, proj_lat, proj_lon, nombre_proy)
-                        render_map(gm, height=420)
+                    hueco = st.empty()
+                    hueco.info("Descargando y procesando...")
+                    huecos.append(hueco)
+
+        for i, tif, estado in preparar_imagenes(ordenadas, modo):
+            label = ordenadas[i]["label"]
+            with huecos[i].container():
+                if estado == "vacia":
+                    st.warning(f"Sin datos para {label} (nubosidad total).")
+                elif estado == "error":
+                    st.error(f"No se pudo descargar {label}.")
+                else:
+                    gm = crear_mapa_individual(tif, proj_lat, proj_lon, label)
+                    if mostrar_marcador:
+                        add_project_marker(gm, proj_lat, proj_lon, nombre_proy)
+                    render_map(gm, height=420)
@@ -7,6 +7,12 @@ ones from Copernicus using utils/Download_sat_imgs.py, and uploads them.
 Azure Blob Storage is the source of truth for what has already been
 processed -- not a local state file. This means the script gives correct
 results even on a fresh machine or after pipeline_state.json is deleted.
+What exists is read from the container manifest (utils/manifiesto.py),
+which every upload and copy updates; listing the container rebuilds it.
+Months Copernicus had no data for are recorded there as well and skipped
+until --no-data-ttl-days have passed. Before anything is sent to openEO, a
+STAC search per project (utils/escenas_stac.py) drops the months without
+any scene under MAX_NUBOSIDAD.
 
 Runs once and exits.
 
@@ -17,29 +23,62 @@ Usage:
 import sys
 import os
 import json
+import hashlib
 import time
 import logging
 import argparse
-from io import BytesIO
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
 
 import pandas as pd
 import openeo
-import requests
 from dotenv import load_dotenv
 from azure.storage.blob import BlobServiceClient
 
 sys.path.insert(0, str(Path(__file__).resolve().parent))
-from utils.Download_sat_imgs import (
-    dms_a_decimal,
-    calcular_bbox,
-    descargar_mes,
-    CARPETA_SALIDA,
-    DESCARGA,
-    KM_BUFFER,
-    PAUSA_ENTRE_DESCARGAS,
-)
+from utils.Download_sat_imgs import (
+    dms_a_decimal,
+    calcular_bbox,
+    descargar_mes,
+    descargar_meses,
+    abrir_resultado_mes,
+    es_sin_datos,
+    etiqueta_meses,
+    ruta_local,
+    CARPETA_SALIDA,
+    DESCARGA,
+    KM_BUFFER,
+    MAX_NUBOSIDAD,
+    PERFILES_ALMACENAMIENTO,
+)
+from utils.lotes_openeo import (
+    borrar_trabajos, ejecutar_lotes, firma_trabajo, meses_tarea, tarea_por_mes,
+)
+from utils.bitacora import (
+    BLOB_BITACORA, RUTA_BITACORA, Bitacora, subidas_confirmadas, trabajos_en_curso,
+)
+from utils.planificador import (
+    BLOB_APLAZADAS, BLOB_COSTOS, CLAVES_PRIORIDAD, Presupuesto, guardar_json, leer_json,
+    ordenar_tareas, parsear_prioridad,
+)
+from utils.agrupacion_espacial import agrupar_bboxes, area_km2, recortar_bbox, union_bbox
+from utils.escenas_stac import WORKERS_STAC, VerificadorEscenas
+from utils.etapas import Etapa, encadenar, resumen_etapas
+from utils.shards import indice_shard, parsear_shard, ruta_shard
+from utils.limitador_tasa import LIMITADOR_OPENEO, es_limite_tasa
+from utils.manifiesto import (
+    BLOB_MANIFIESTO, TTL_SIN_DATOS_DIAS, RegistroManifiesto, actualizar_manifiesto,
+    aplicar_registro, clave_imagen, inventario_desde_manifiesto, leer_manifiesto,
+    meses_sin_datos, parsear_blob, reparar_manifiesto,
+)
+from utils.metadata_proyectos import COLUMNAS_PIPELINE, cargar_metadata
+from utils.procesamiento_raster import COMPRESIONES_COG, convertir_a_cog, escalar_a_int16
+from utils.visualizacion import (
+    MODOS, blob_derivado, calcular_estadisticas, escribir_derivados,
+    estadisticas_a_metadata, leer_reflectancia,
+)
 
 load_dotenv()
 
@@ -58,7 +97,16 @@ AZURE_CONTAINER = os.getenv("AZURE_CONTAINER", "imagenes-sentinel")
 STATE_PATH = Path("pipeline_state.json")   # audit log only, not source of truth
 LOG_PATH   = Path("pipeline_log.txt")
 
-BORRAR_LOCAL_TRAS_SUBIR = True
+BORRAR_LOCAL_TRAS_SUBIR = True
+
+BLOB_PREFIX        = "sentinel2_"
+INVENTARIO_WORKERS = 8    # suggested value for --inventory-workers
+ESPERA_MAX_COPIA   = 120  # seconds to wait for a server-side blob copy to finish
+
+# --stream-upload: memory use is bounded by about
+# STREAM_MAX_CONCURRENCY * STREAM_BLOCK_MB
+STREAM_MAX_CONCURRENCY = 4
+STREAM_BLOCK_MB        = 4
 
 # ─────────────────────────────────────────────────────────────────
 
@@ -68,7 +116,19 @@ logging.basicConfig(
     handlers=[logging.FileHandler(LOG_PATH, encoding="utf-8"),
               logging.StreamHandler()],
 )
-log = logging.getLogger("pipeline")
+log = logging.getLogger("pipeline")
+
+
+def registrar_log_en(ruta: Path) -> None:
+    """Moves the detailed log to `ruta` (e.g. a per-shard file)."""
+    raiz = logging.getLogger()
+    for handler in list(raiz.handlers):
+        if isinstance(handler, logging.FileHandler):
+            raiz.removeHandler(handler)
+            handler.close()
+    handler = logging.FileHandler(ruta, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+    raiz.addHandler(handler)
 
 # Silence verbose HTTP request/response logging from the Azure SDK and its
 # dependencies. They log at INFO level by default, which floods the console
@@ -99,56 +159,171 @@ def validar_configuracion() -> None:
 
 # ── Metadata reading (Excel) ────────────────────────────────────────
 
-def _metadata_download_url(url: str) -> str:
-    """
-    Normalizes SharePoint/OneDrive viewer links to direct-download links.
-    Other URLs are left untouched.
-    """
-    if "sharepoint.com" in url and "/:x:/" in url:
-        return url.split("?", 1)[0] + "?download=1"
-    return url
+def leer_metadata_proyectos() -> pd.DataFrame:
+    df = cargar_metadata(PROJECT_METADATA_XLSX_URL, PROJECT_METADATA_SHEET_NAME,
+                         COLUMNAS_PIPELINE)
+    log.info(f"Project metadata: {df.attrs['origen']} in {df.attrs['segundos']:.2f}s "
+             f"(version {df.attrs['version']}).")
+    return df.astype(str)
 
 
-def leer_metadata_proyectos() -> pd.DataFrame:
-    response = requests.get(_metadata_download_url(PROJECT_METADATA_XLSX_URL), timeout=120)
-    response.raise_for_status()
-    excel_bytes = BytesIO(response.content)
-    try:
-        df = pd.read_excel(
-            excel_bytes,
-            sheet_name=PROJECT_METADATA_SHEET_NAME,
-            dtype=str,
-        )
-    except ValueError:
-        excel_bytes.seek(0)
-        df = pd.read_excel(excel_bytes, sheet_name=0, dtype=str)
-    df.columns = [c.strip() for c in df.columns]
-    df = df.astype(str)
-    return df
-
-
 # ── Azure ground-truth check ────────────────────────────────────────
 
 def meses_objetivo() -> set:
     return {(anio, mes) for anio, meses in DESCARGA.items() for mes in meses}
 
 
-def meses_ya_en_azure(container_client, bpin: str) -> set:
-    prefix = f"sentinel2_{bpin}/"
-    existentes = set()
-    for blob in container_client.list_blobs(name_starts_with=prefix):
-        filename = blob.name.split("/")[-1]
-        stem = filename.rsplit(".", 1)[0]
-        parts = stem.split("_")
-        if len(parts) == 2:
-            existentes.add((parts[0], parts[1]))
-    return existentes
-
-
-def calcular_pendientes(df: pd.DataFrame, container_client) -> list:
-    """
-    Returns a list of dicts: {"row": pd.Series, "pendientes": [(anio, mes), ...]}
-    Only includes projects that are missing at least one target month in Azure.
+def _parsear_blob_imagen(nombre: str) -> tuple | None:
+    """
+    Splits a blob name like 'sentinel2_{bpin}/{anio}_{mes}.tiff' into
+    (bpin, (anio, mes)). Returns None for names that do not follow it.
+    """
+    carpeta, _, filename = nombre.rpartition("/")
+    if not carpeta.startswith(BLOB_PREFIX):
+        return None
+    stem  = filename.rsplit(".", 1)[0]
+    parts = stem.split("_")
+    if len(parts) != 2:
+        return None
+    return carpeta[len(BLOB_PREFIX):], (parts[0], parts[1])
+
+
+def meses_ya_en_azure(container_client, bpin: str) -> set:
+    prefix = f"{BLOB_PREFIX}{bpin}/"
+    existentes = set()
+    for blob in container_client.list_blobs(name_starts_with=prefix):
+        parsed = _parsear_blob_imagen(blob.name)
+        if parsed:
+            existentes.add(parsed[1])
+    return existentes
+
+
+def _listar_prefijo(container_client, prefix: str) -> list:
+    return [parsed for blob in container_client.list_blobs(name_starts_with=prefix)
+            if (parsed := _parsear_blob_imagen(blob.name))]
+
+
+def prefijos_inventario(bpins: list, workers: int) -> list:
+    """
+    Disjoint blob-name prefixes covering every BPIN in `bpins`, at least
+    `workers` of them when the BPINs allow it. BPINs share their leading
+    year digits, so the prefix grows one character at a time until there
+    are enough distinct ones; it never grows past the shortest BPIN, which
+    keeps prefixes of the same length from nesting.
+    """
+    bpins = [b for b in bpins if b]
+    if workers <= 1 or not bpins:
+        return [BLOB_PREFIX]
+    largo, tope = 2, min(len(b) for b in bpins)
+    while len({b[:largo] for b in bpins}) < workers and largo < tope:
+        largo += 1
+    return sorted({f"{BLOB_PREFIX}{b[:largo]}" for b in bpins})
+
+
+def inventario_azure(container_client, bpins=None, workers: int = 1) -> dict:
+    """
+    Lists the container once and returns {bpin: {(anio, mes), ...}}.
+
+    With workers > 1 the listing is split into the disjoint name ranges of
+    prefijos_inventario, and each range is paged on its own thread. Ranges
+    never overlap, so every blob is still listed exactly once.
+    """
+    prefijos = prefijos_inventario(bpins or [], workers)
+    log.info(f"Listing the container under {len(prefijos)} prefix(es) "
+             f"with {min(workers, len(prefijos))} worker(s).")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(prefijos)))) as pool:
+        paginas = list(pool.map(lambda p: _listar_prefijo(container_client, p), prefijos))
+
+    inventario = {}
+    for pagina in paginas:
+        for bpin, anio_mes in pagina:
+            inventario.setdefault(bpin, set()).add(anio_mes)
+    return inventario
+
+
+def cargar_manifiesto(container_client, reparar: bool = False) -> dict:
+    """
+    Reads the container manifest (see inventario_desde_manifiesto for the
+    shape of inventario_azure). It is rebuilt from a container listing
+    first when `reparar` is set or when there is none yet.
+    """
+    manifiesto = None
+    if not reparar:
+        manifiesto, _ = leer_manifiesto(container_client)
+        if manifiesto is None:
+            log.info(f"No {BLOB_MANIFIESTO} in the container yet: building it from a listing.")
+    if manifiesto is None:
+        inicio     = time.perf_counter()
+        manifiesto = reparar_manifiesto(container_client)
+        log.info(f"{BLOB_MANIFIESTO} rebuilt from a container listing: "
+                 f"{len(manifiesto['imagenes'])} entries in {time.perf_counter() - inicio:.2f}s.")
+    return manifiesto
+
+
+def reponer_subidas(container_client, subidas: list) -> int:
+    """
+    Merges the uploads journaled by an interrupted run (see
+    subidas_confirmadas) into the manifest, where the batch still buffered
+    when the runner died never arrived. Entries already recorded are left
+    alone. Without a manifest nothing is done: the listing that builds it
+    sees those blobs. Returns how many entries were added.
+    """
+    if not subidas or leer_manifiesto(container_client)[0] is None:
+        return 0
+    agregadas = []
+
+    def cambios(manifiesto):
+        agregadas.clear()
+        for s in subidas:
+            parsed = parsear_blob(s["blob"])
+            if parsed is None:
+                continue
+            bpin, anio, mes, modo = parsed
+            entrada    = manifiesto["imagenes"].get(clave_imagen(bpin, anio, mes), {})
+            registrado = entrada.get("derivados", {}).get(modo) if modo else entrada.get("etag")
+            if registrado == s["etag"]:
+                continue
+            aplicar_registro(manifiesto, s["blob"], s["bytes"], s["etag"], s.get("metadata"), s["t"])
+            agregadas.append(s["blob"])
+
+    actualizar_manifiesto(container_client, cambios)
+    return len(agregadas)
+
+
+def filtrar_shard(df: pd.DataFrame, k: int, n: int) -> pd.DataFrame:
+    """
+    Rows of shard k of n (see utils/shards.py). The hashed key is the lowest
+    BPIN among the projects at the same coordinates, so a site is never
+    split across workers: its image is still downloaded once and copied
+    server-side to the other BPINs.
+    """
+    sitio_de, representante = {}, {}
+    for _, row in df.iterrows():
+        bpin = str(row["bpin"]).strip()
+        try:
+            sitio = tuple(_bbox_proyecto(row).values())
+        except (ValueError, KeyError):
+            sitio = bpin
+        sitio_de[bpin]       = sitio
+        representante[sitio] = min(representante.get(sitio, bpin), bpin)
+    en_shard = df["bpin"].map(
+        lambda b: indice_shard(representante[sitio_de[str(b).strip()]], n) == k)
+    return df[en_shard]
+
+
+def calcular_pendientes(df: pd.DataFrame, container_client, inventario: dict | None = None,
+                        sin_datos: dict | None = None, omitidos: list | None = None) -> list:
+    """
+    Returns a list of dicts: {"row": pd.Series, "pendientes": [(anio, mes), ...],
+    "existentes": {(anio, mes), ...}}
+    Only includes projects that are missing at least one target month in Azure.
+
+    When `inventario` is given (see inventario_desde_manifiesto and
+    inventario_azure) the diff is a pure in-memory set operation; otherwise
+    every BPIN is listed on its own. Months in `sin_datos` (see
+    meses_sin_datos) are not pending; they are appended to `omitidos` as
+    (bpin, anio, mes).
     """
     objetivo   = meses_objetivo()
     resultado  = []
@@ -157,73 +332,756 @@ def calcular_pendientes(df: pd.DataFrame, container_client) -> list:
         bpin = str(row["bpin"]).strip()
         if not bpin:
             continue
-        ya_en_azure = meses_ya_en_azure(container_client, bpin)
-        pendientes  = sorted(objetivo - ya_en_azure)
+        if inventario is None:
+            ya_en_azure = meses_ya_en_azure(container_client, bpin)
+        else:
+            ya_en_azure = inventario.get(bpin, set())
+        pendientes  = sorted(objetivo - ya_en_azure)
+        vacios      = (sin_datos or {}).get(bpin, set())
+        if vacios:
+            if omitidos is not None:
+                omitidos.extend((bpin, anio, mes) for anio, mes in pendientes
+                                if (anio, mes) in vacios)
+            pendientes = [anio_mes for anio_mes in pendientes if anio_mes not in vacios]
         if pendientes:
-            resultado.append({"row": row, "pendientes": pendientes})
+            resultado.append({"row": row, "pendientes": pendientes, "existentes": ya_en_azure})
 
     return resultado
 
 
-# ── Azure upload ───────────────────────────────────────────────────
-
-def subir_a_azure(container_client, local_path: str, bpin: str, anio: str, mes: str) -> bool:
-    if not os.path.exists(local_path):
-        log.error(f"Local file not found, cannot upload: {local_path}")
-        return False
-
-    blob_path = f"sentinel2_{bpin}/{anio}_{mes}.tiff"
-    try:
-        with open(local_path, "rb") as f:
-            container_client.upload_blob(name=blob_path, data=f, overwrite=True)
+def prevuelo_stac(pendientes_por_proyecto: list, workers: int = WORKERS_STAC) -> tuple:
+    """
+    Keeps only the pending months with at least one Sentinel-2 scene under
+    MAX_NUBOSIDAD, from one STAC search per project bbox over its pending
+    range. Projects whose coordinates cannot be parsed, or whose search
+    fails, keep every month.
+
+    Returns (pendientes_por_proyecto, descartados), where descartados is a
+    list of (bpin, anio, mes) left out.
+    """
+    consultas, items = [], []
+    for item in pendientes_por_proyecto:
+        try:
+            consultas.append((_bbox_proyecto(item["row"]), item["pendientes"]))
+            items.append(item)
+        except (ValueError, KeyError):
+            continue
+
+    inicio      = time.perf_counter()
+    verificador = VerificadorEscenas()
+    resumenes   = dict(zip(map(id, items), verificador.verificar(consultas, workers)))
+    log.info(f"STAC pre-flight: {verificador.metricas()} in {time.perf_counter() - inicio:.1f}s.")
+
+    resultado, descartados = [], []
+    for item in pendientes_por_proyecto:
+        resumen = resumenes.get(id(item))
+        if resumen is None:
+            resultado.append(item)
+            continue
+        bpin = str(item["row"]["bpin"]).strip()
+        sin_escenas = [anio_mes for anio_mes in item["pendientes"] if anio_mes not in resumen]
+        descartados.extend((bpin, anio, mes) for anio, mes in sin_escenas)
+        for (anio, mes), r in sorted(resumen.items()):
+            log.info(f"{bpin} {anio}-{mes}: {r['escenas']} scene(s), cloud cover "
+                     f"min {r['nubosidad_min']:.0f}% / mean {r['nubosidad_media']:.0f}%")
+        if sin_escenas:
+            log.info(f"{bpin}: no scene under {MAX_NUBOSIDAD}% cloud cover in "
+                     f"{', '.join(f'{a}-{m}' for a, m in sin_escenas)}")
+        if resumen:
+            resultado.append({**item, "pendientes": [m for m in item["pendientes"] if m in resumen]})
+    return resultado, descartados
+
+
+# ── Azure upload ───────────────────────────────────────────────────
+
+def blob_imagen(bpin: str, anio: str, mes: str) -> str:
+    return f"{BLOB_PREFIX}{bpin}/{anio}_{mes}.tiff"
+
+
+# Set by main(): every image and derivative written to the container is
+# recorded in the manifest through it, and every transition of the run in
+# the journal (utils/bitacora.py).
+REGISTRO_MANIFIESTO: RegistroManifiesto | None = None
+BITACORA: Bitacora | None = None
+# Set by main(): time budget of the run (--deadline) and latency history.
+PRESUPUESTO: Presupuesto | None = None
+
+
+def _anotar(evento: str, **datos) -> None:
+    if BITACORA is not None:
+        BITACORA.anotar(evento, **datos)
+
+
+def _registrar_blob(blob_path: str, tamano: int, etag: str, metadata: dict | None = None) -> None:
+    if REGISTRO_MANIFIESTO is not None:
+        REGISTRO_MANIFIESTO.registrar(blob_path, tamano, etag, metadata)
+    _anotar("subida", blob=blob_path, bytes=tamano, etag=etag, metadata=metadata)
+
+
+def _registrar_sin_datos(bpins: list, anio: str, mes: str, resultados: dict) -> None:
+    for bpin in bpins:
+        _contar(resultados, bpin, "imagenes_sin_datos")
+        if REGISTRO_MANIFIESTO is not None:
+            REGISTRO_MANIFIESTO.registrar_sin_datos(bpin, anio, mes)
+
+
+def _puede_empezar(tarea: dict) -> bool:
+    """False, and the unit is deferred to the next run, when it would not finish before --deadline."""
+    if PRESUPUESTO is None or PRESUPUESTO.alcanza(tarea):
+        return True
+    PRESUPUESTO.aplazar([tarea])
+    log.info(f"{tarea['bpin']}: {etiqueta_meses(meses_tarea(tarea))} deferred, about "
+             f"{PRESUPUESTO.estimar(tarea) / 60:.0f} min needed and "
+             f"{max(0, PRESUPUESTO.restante()) / 60:.0f} min left before the deadline.")
+    return False
+
+
+def _observar_mes(tarea_mes: dict, estado: str) -> None:
+    # A re-attached job was submitted by an earlier run: timing it from
+    # this run's start would bias the latency estimate low.
+    if PRESUPUESTO is not None:
+        PRESUPUESTO.observar(tarea_mes,
+                             medir=estado != "ya_existe" and not tarea_mes.get("reanudado"))
+
+
+def vaciar_manifiesto() -> None:
+    if REGISTRO_MANIFIESTO is None:
+        return
+    try:
+        REGISTRO_MANIFIESTO.vaciar()
+        log.info(f"{BLOB_MANIFIESTO}: {REGISTRO_MANIFIESTO.escritos} blob(s) recorded.")
+    except Exception as e:
+        log.error(f"{BLOB_MANIFIESTO} could not be updated ({e}); run with "
+                  f"--repair-manifest to rebuild it from a listing.")
+
+
+def subir_a_azure(container_client, local_path: str, bpin: str, anio: str, mes: str,
+                  blob_path: str | None = None, metadata: dict | None = None) -> bool:
+    if not os.path.exists(local_path):
+        log.error(f"Local file not found, cannot upload: {local_path}")
+        return False
+
+    blob_path = blob_path or blob_imagen(bpin, anio, mes)
+    try:
+        tamano = os.path.getsize(local_path)
+        inicio = time.perf_counter()
+        with open(local_path, "rb") as f:
+            respuesta = container_client.get_blob_client(blob_path).upload_blob(
+                f, overwrite=True, metadata=metadata)
+        _registrar_velocidad(blob_path, tamano, time.perf_counter() - inicio, "uploaded")
+        _registrar_blob(blob_path, tamano, respuesta["etag"], metadata)
         return True
     except Exception as e:
         log.error(f"Azure upload failed for {blob_path}: {e}")
         return False
     finally:
-        if BORRAR_LOCAL_TRAS_SUBIR and os.path.exists(local_path):
-            os.remove(local_path)
-
-
-# ── Per-project processing ──────────────────────────────────────────
-
-def procesar_proyecto(connection, container_client, row: pd.Series,
-                      pendientes: list, descarga_log: list) -> dict:
-    bpin = str(row["bpin"]).strip()
-    log.info(f"Processing project: {bpin} ({len(pendientes)} month(s) pending)")
-
-    resultado = {"bpin": bpin, "fecha_proceso": datetime.now(timezone.utc).isoformat(),
-                "imagenes_ok": 0, "imagenes_error": 0}
-
-    try:
-        lat = dms_a_decimal(str(row["latitud"]).strip())
-        lon = dms_a_decimal(str(row["longitud"]).strip())
-    except (ValueError, KeyError) as e:
-        log.error(f"{bpin}: invalid coordinates, skipping image download: {e}")
-        resultado["imagenes_error"] = len(pendientes)
-        return resultado
-
-    bbox = calcular_bbox(lat, lon, KM_BUFFER)
-
-    for anio, mes in pendientes:
-        estado_descarga = descargar_mes(connection, bpin, bbox, anio, mes, descarga_log)
-
-        if estado_descarga not in ("ok", "ya_existe"):
-            resultado["imagenes_error"] += 1
-            continue
-
-        ruta_local = os.path.join(CARPETA_SALIDA, f"sentinel2_{bpin}", f"{anio}_{mes}.tiff")
-        if subir_a_azure(container_client, ruta_local, bpin, anio, mes):
-            resultado["imagenes_ok"] += 1
-        else:
-            resultado["imagenes_error"] += 1
-
-        time.sleep(PAUSA_ENTRE_DESCARGAS)
-
-    log.info(f"{bpin}: {resultado['imagenes_ok']} uploaded, {resultado['imagenes_error']} failed")
-    return resultado
+        if BORRAR_LOCAL_TRAS_SUBIR and os.path.exists(local_path):
+            os.remove(local_path)
+
+
+def _registrar_velocidad(blob_path: str, n_bytes: int, segundos: float, accion: str) -> None:
+    mb = n_bytes / 1e6
+    log.info(f"{blob_path}: {accion} {mb:.1f} MB in {segundos:.1f}s "
+             f"({mb / max(segundos, 1e-6):.2f} MB/s)")
+
+
+class _LectorContado:
+    """
+    Read-only, non-seekable view over a streaming HTTP response that counts
+    the bytes handed to the Azure SDK. Because it cannot seek, the SDK reads
+    it block by block and uploads up to max_concurrency blocks in parallel.
+    """
+
+    def __init__(self, respuesta):
+        self._raw = respuesta.raw
+        self._raw.decode_content = True
+        self.bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._raw.read(None if size is None or size < 0 else size)
+        self.bytes += len(chunk)
+        return chunk
+
+
+def transmitir_a_azure(connection, container_client, bpin: str, bbox: dict,
+                       anio: str, mes: str, descarga_log: list) -> str | None:
+    """
+    Streams the openEO result for one month straight into a chunked,
+    parallel block upload, without touching the local disk. Returns "ok" or
+    "sin_datos", or None when the caller should fall back to the local-file
+    path (rate limiting, network errors). Blocks are only committed when the
+    whole body has been read, so a failed stream never leaves a partial blob.
+    """
+    blob_path = blob_imagen(bpin, anio, mes)
+    LIMITADOR_OPENEO.adquirir()
+    inicio    = time.perf_counter()
+    try:
+        respuesta = abrir_resultado_mes(connection, bbox, anio, mes)
+        LIMITADOR_OPENEO.exito()
+    except Exception as e:
+        msg = str(e)
+        if es_limite_tasa(e):
+            LIMITADOR_OPENEO.limitado()
+        elif es_sin_datos(msg):
+            LIMITADOR_OPENEO.exito()
+            descarga_log.append(f"NO_DATA | {bpin} | {anio}-{mes} | {msg[:120]}")
+            return "sin_datos"
+        log.warning(f"{blob_path}: streaming request failed ({msg[:100]}), "
+                    f"falling back to local file.")
+        return None
+
+    lector = _LectorContado(respuesta)
+    try:
+        resultado = container_client.get_blob_client(blob_path).upload_blob(
+            lector, overwrite=True, max_concurrency=STREAM_MAX_CONCURRENCY)
+    except Exception as e:
+        log.warning(f"{blob_path}: streaming upload failed after {lector.bytes} bytes "
+                    f"({str(e)[:100]}), falling back to local file.")
+        return None
+    finally:
+        respuesta.close()
+
+    _registrar_velocidad(blob_path, lector.bytes, time.perf_counter() - inicio, "streamed")
+    _registrar_blob(blob_path, lector.bytes, resultado["etag"])
+    descarga_log.append(f"OK | {bpin} | {anio}-{mes} | streamed to {blob_path}")
+    return "ok"
+
+
+def copiar_en_azure(container_client, origen: str, destino: str, anio: str, mes: str) -> bool:
+    """
+    Copies an image that already exists for BPIN `origen` to BPIN `destino`
+    with a server-side copy inside the storage account, so no Copernicus
+    job and no upload from this machine are needed. Its display derivatives
+    are copied too when they exist.
+    """
+    origen_path, destino_path = blob_imagen(origen, anio, mes), blob_imagen(destino, anio, mes)
+    if not _copiar_blob(container_client, origen_path, destino_path):
+        return False
+    for modo in MODOS:
+        fuente = blob_derivado(origen_path, modo)
+        try:
+            existe = container_client.get_blob_client(fuente).exists()
+        except Exception:
+            existe = False
+        if existe:
+            _copiar_blob(container_client, fuente, blob_derivado(destino_path, modo))
+    return True
+
+
+def _copiar_blob(container_client, origen_path: str, destino_path: str) -> bool:
+    blob_origen  = container_client.get_blob_client(origen_path)
+    blob_destino = container_client.get_blob_client(destino_path)
+    try:
+        estado = blob_destino.start_copy_from_url(blob_origen.url)["copy_status"]
+        limite = time.monotonic() + ESPERA_MAX_COPIA
+        while estado == "pending" and time.monotonic() < limite:
+            time.sleep(1)
+            estado = blob_destino.get_blob_properties().copy.status
+        if estado != "success":
+            log.error(f"Server-side copy {blob_origen.blob_name} -> {blob_destino.blob_name} "
+                      f"ended as '{estado}'")
+            return False
+        propiedades = blob_destino.get_blob_properties()
+        _registrar_blob(destino_path, propiedades.size, propiedades.etag, propiedades.metadata)
+        return True
+    except Exception as e:
+        log.error(f"Server-side copy failed for {blob_destino.blob_name}: {e}")
+        return False
 
 
+# ── Work planning and processing ────────────────────────────────────
+
+def _resultado_vacio(bpin: str) -> dict:
+    return {"bpin": bpin, "fecha_proceso": datetime.now(timezone.utc).isoformat(),
+            "imagenes_ok": 0, "imagenes_error": 0, "imagenes_copiadas": 0,
+            "imagenes_sin_datos": 0}
+
+
+def _bbox_proyecto(row: pd.Series) -> dict:
+    """Raises ValueError/KeyError when the row has no usable coordinates."""
+    lat = dms_a_decimal(str(row["latitud"]).strip())
+    lon = dms_a_decimal(str(row["longitud"]).strip())
+    return calcular_bbox(lat, lon, KM_BUFFER)
+
+
+def _clave_grupo(sitios: list, bbox: dict) -> str:
+    """
+    Name of the shared download of a cluster request, a digest of its union
+    bbox and member BPINs: a file left at ruta_local by an earlier run only
+    matches the exact same request.
+    """
+    firma = json.dumps([[bbox["west"], bbox["south"], bbox["east"], bbox["north"]],
+                        sorted(d["bpin"] for s in sitios for d in s["destinos"])])
+    return f"grupo_{hashlib.sha1(firma.encode('utf-8')).hexdigest()[:12]}"
+
+
+def _tareas_grupo(sitios: list, multimes: bool) -> list:
+    if len(sitios) == 1:
+        s = sitios[0]
+        if multimes and len(s["pendientes"]) > 1:
+            return [{"bpin": s["bpin"], "bbox": s["bbox"], "meses": s["pendientes"],
+                     "miembros": sitios}]
+        return [{"bpin": s["bpin"], "bbox": s["bbox"], "anio": anio, "mes": mes,
+                 "miembros": sitios}
+                for anio, mes in s["pendientes"]]
+
+    meses = sorted({anio_mes for s in sitios for anio_mes in s["pendientes"]})
+    if multimes and len(meses) > 1:
+        bbox = union_bbox([s["bbox"] for s in sitios])
+        return [{"bpin": _clave_grupo(sitios, bbox), "bbox": bbox,
+                 "meses": meses, "miembros": sitios}]
+
+    tareas = []
+    for anio, mes in meses:
+        quienes = [s for s in sitios if (anio, mes) in s["pendientes"]]
+        if len(quienes) == 1:
+            tareas.append({"bpin": quienes[0]["bpin"], "bbox": quienes[0]["bbox"],
+                           "anio": anio, "mes": mes, "miembros": quienes})
+        else:
+            bbox = union_bbox([s["bbox"] for s in quienes])
+            tareas.append({"bpin": _clave_grupo(quienes, bbox), "bbox": bbox,
+                           "anio": anio, "mes": mes, "miembros": quienes})
+    return tareas
+
+
+def _agrupar_por_sitio(proyectos: list) -> tuple:
+    """
+    Collapses projects with identical bboxes into sites, keyed on the bbox,
+    so each (bbox, month) is downloaded once. Returns (sitios, copias):
+
+      sitios: [{"bpin", "bbox", "pendientes", "destinos": [{"bpin", "pendientes"}]}]
+              where "bpin" is the first project at that bbox and is only used
+              to name local files, and "pendientes" are the months no project
+              at that bbox has in Azure yet.
+      copias: [{"origen", "destino", "anio", "mes"}] for months that another
+              project at the same bbox already has in Azure.
+    """
+    por_bbox = {}
+    for p in proyectos:
+        clave = (p["bbox"]["west"], p["bbox"]["south"], p["bbox"]["east"], p["bbox"]["north"])
+        por_bbox.setdefault(clave, []).append(p)
+
+    sitios, copias = [], []
+    for grupo in por_bbox.values():
+        a_descargar = set()
+        destinos    = []
+        for p in grupo:
+            pendientes = set()
+            for anio_mes in p["pendientes"]:
+                origen = next((o["bpin"] for o in grupo if anio_mes in o["existentes"]), None)
+                if origen is None:
+                    pendientes.add(anio_mes)
+                else:
+                    copias.append({"origen": origen, "destino": p["bpin"],
+                                   "anio": anio_mes[0], "mes": anio_mes[1]})
+            a_descargar |= pendientes
+            destinos.append({"bpin": p["bpin"], "pendientes": pendientes})
+        if a_descargar:
+            sitios.append({"bpin": grupo[0]["bpin"], "bbox": grupo[0]["bbox"],
+                           "pendientes": sorted(a_descargar), "destinos": destinos})
+    return sitios, copias
+
+
+def planificar_tareas(pendientes_por_proyecto: list, resultados: dict,
+                      multimes: bool = False, cluster_km: float | None = None,
+                      perfil: str = "float32") -> tuple:
+    """
+    Turns the pending months of every project into download units, one per
+    openEO request: {"bpin", "bbox", "anio", "mes", "miembros"} for a single
+    month, or {"bpin", "bbox", "meses", "miembros"} with `multimes`.
+
+    Work is keyed on (bbox, month): projects sharing the same coordinates
+    form one site (see _agrupar_por_sitio), and "miembros" lists the sites
+    a unit covers. With `cluster_km`, sites whose bboxes are closer than
+    that share one request over the union extent; those units use a
+    synthetic grupo_ key (see _clave_grupo) as "bpin", and each site's
+    window is cropped out of the shared result before upload. Every unit
+    carries the storage `perfil` its graph is built with.
+
+    Fills `resultados` with one entry per BPIN and returns
+    (tareas, copias, areas), where copias are server-side copies that need
+    no download and areas holds the total km2 requested with and without
+    deduplication and clustering.
+    """
+    proyectos = []
+    for item in pendientes_por_proyecto:
+        bpin = str(item["row"]["bpin"]).strip()
+        resultados[bpin] = _resultado_vacio(bpin)
+        try:
+            bbox = _bbox_proyecto(item["row"])
+        except (ValueError, KeyError) as e:
+            log.error(f"{bpin}: invalid coordinates, skipping image download: {e}")
+            resultados[bpin]["imagenes_error"] = len(item["pendientes"])
+            continue
+        proyectos.append({"bpin": bpin, "bbox": bbox, "pendientes": list(item["pendientes"]),
+                          "existentes": set(item.get("existentes", ()))})
+
+    sitios, copias = _agrupar_por_sitio(proyectos)
+
+    if cluster_km is None:
+        grupos = [[s] for s in sitios]
+    else:
+        por_clave = {s["bpin"]: s for s in sitios}
+        claves    = agrupar_bboxes([(s["bpin"], s["bbox"]) for s in sitios], cluster_km)
+        grupos    = [[por_clave[clave] for clave in grupo] for grupo in claves]
+
+    tareas = []
+    for miembros in grupos:
+        tareas.extend(_tareas_grupo(miembros, multimes))
+    for tarea in tareas:
+        tarea["perfil"] = perfil
+
+    areas = {
+        "sin_agrupar": sum(area_km2(p["bbox"]) * len(p["pendientes"]) for p in proyectos),
+        "solicitada":  sum(area_km2(t["bbox"]) * len(meses_tarea(t)) for t in tareas),
+    }
+    return tareas, copias, areas
+
+
+_LOCK_RESULTADOS = threading.Lock()
+
+
+def _contar(resultados: dict, bpin: str, clave: str, n: int = 1) -> None:
+    """Counter update that is safe to call from the pipeline worker threads."""
+    with _LOCK_RESULTADOS:
+        resultados[bpin][clave] += n
+
+
+def copiar_pendientes(container_client, copias: list, resultados: dict) -> None:
+    for copia in copias:
+        destino = copia["destino"]
+        if copiar_en_azure(container_client, copia["origen"], destino,
+                           copia["anio"], copia["mes"]):
+            _contar(resultados, destino, "imagenes_ok")
+            _contar(resultados, destino, "imagenes_copiadas")
+        else:
+            _contar(resultados, destino, "imagenes_error")
+
+
+def _copiar_a_resto(container_client, origen: str, resto: list, anio: str, mes: str,
+                    resultados: dict, disponible: bool) -> None:
+    for bpin in resto:
+        if disponible and copiar_en_azure(container_client, origen, bpin, anio, mes):
+            _contar(resultados, bpin, "imagenes_ok")
+            _contar(resultados, bpin, "imagenes_copiadas")
+        else:
+            _contar(resultados, bpin, "imagenes_error")
+
+
+def _subir_a_destinos(container_client, ruta: str, destinos: list, anio: str, mes: str,
+                      resultados: dict, metadata: dict | None = None) -> None:
+    """
+    Uploads `ruta` once, then server-side copies it to the other destinos.
+    The copies inherit the blob metadata of the upload.
+    """
+    primero, *resto = destinos
+    subido = subir_a_azure(container_client, ruta, primero, anio, mes, metadata=metadata)
+    _contar(resultados, primero, "imagenes_ok" if subido else "imagenes_error")
+    _copiar_a_resto(container_client, primero, resto, anio, mes, resultados, subido)
+
+
+def _destinos(sitio: dict, anio: str, mes: str) -> list:
+    return [d["bpin"] for d in sitio["destinos"] if (anio, mes) in d["pendientes"]]
+
+
+def opciones_postproceso(args) -> dict:
+    """Local post-processing selected on the command line, passed down to preparar_entregas."""
+    return {"int16":     args.storage_profile == "scaled-int16",
+            "cog":       None if args.no_cog else args.cog_compression,
+            "derivados": not args.no_derivatives}
+
+
+def postprocesar(ruta: str, postproceso: dict) -> bool:
+    """
+    Rewrites the local GeoTIFF in place as configured. Returns False when
+    the file must not be uploaded: digital numbers that could not get their
+    scale metadata would be misread as reflectance. A failed COG conversion
+    only logs a warning and the GeoTIFF is uploaded as it is.
+    """
+    if postproceso.get("int16"):
+        try:
+            escalar_a_int16(ruta)
+        except Exception as e:
+            log.error(f"{ruta}: could not write the scaled-int16 profile: {e}")
+            return False
+    if postproceso.get("cog"):
+        try:
+            convertir_a_cog(ruta, postproceso["cog"])
+        except Exception as e:
+            log.warning(f"{ruta}: COG conversion failed ({e}), uploading the raw GeoTIFF.")
+    return True
+
+
+def analizar(ruta: str, postproceso: dict) -> tuple:
+    """
+    Reads `ruta` once and returns (estadisticas, derivados): the stats that
+    go into the image's blob metadata and the display derivatives
+    ({modo: local path}). Best effort: on failure the image is uploaded
+    without them and the app scans and renders it itself, as for legacy
+    blobs.
+    """
+    try:
+        bandas, perfil = leer_reflectancia(ruta)
+        estadisticas   = calcular_estadisticas(bandas)
+    except Exception as e:
+        log.warning(f"{ruta}: could not compute image statistics: {e}")
+        return None, {}
+    if not postproceso.get("derivados"):
+        return estadisticas, {}
+    try:
+        return estadisticas, escribir_derivados(ruta, bandas, perfil, estadisticas)
+    except Exception as e:
+        log.warning(f"{ruta}: could not render display derivatives: {e}")
+        return estadisticas, {}
+
+
+def preparar_entregas(tarea: dict, estado: str, resultados: dict,
+                      postproceso: dict | None = None) -> list:
+    """
+    Local post-processing of the result of one single-month unit. Results
+    shared by a cluster are cropped per site, then each file goes through
+    postprocesar; failures are counted against every BPIN they would have
+    reached.
+
+    Returns the uploads still to do:
+    [{"ruta", "destinos", "anio", "mes", "estadisticas", "derivados"}, ...].
+    """
+    anio, mes  = tarea["anio"], tarea["mes"]
+    ruta       = ruta_local(tarea["bpin"], anio, mes)
+    compartida = len(tarea["miembros"]) > 1
+    entregas   = []
+    _anotar("mes", bpin=tarea["bpin"], anio=anio, mes=mes, estado=estado,
+            destinos=[b for sitio in tarea["miembros"] for b in _destinos(sitio, anio, mes)])
+
+    for sitio in tarea["miembros"]:
+        destinos = _destinos(sitio, anio, mes)
+        if not destinos:
+            continue
+        if estado not in ("ok", "ya_existe"):
+            for bpin in destinos:
+                _contar(resultados, bpin, "imagenes_error")
+            if estado == "sin_datos":
+                _registrar_sin_datos(destinos, anio, mes, resultados)
+            continue
+
+        ruta_sitio = ruta
+        if compartida:
+            ruta_sitio = ruta_local(sitio["bpin"], anio, mes)
+            try:
+                recortado = recortar_bbox(ruta, sitio["bbox"], ruta_sitio)
+            except Exception as e:
+                log.error(f"{sitio['bpin']}: could not crop {anio}-{mes} from {tarea['bpin']}: {e}")
+                recortado = False
+            if not recortado:
+                for bpin in destinos:
+                    _contar(resultados, bpin, "imagenes_error")
+                continue
+
+        if not postprocesar(ruta_sitio, postproceso or {}):
+            for bpin in destinos:
+                _contar(resultados, bpin, "imagenes_error")
+            continue
+        estadisticas, derivados = analizar(ruta_sitio, postproceso or {})
+        entregas.append({"ruta": ruta_sitio, "destinos": destinos, "anio": anio, "mes": mes,
+                         "estadisticas": estadisticas, "derivados": derivados})
+
+    if compartida and os.path.exists(ruta):
+        os.remove(ruta)
+    return entregas
+
+
+def subir_entrega(container_client, entrega: dict, resultados: dict) -> None:
+    """Upload half of a delivery prepared by preparar_entregas."""
+    primero, anio, mes = entrega["destinos"][0], entrega["anio"], entrega["mes"]
+    # Derivatives go first so that, once the image is copied to the other
+    # destinos, copiar_en_azure finds them and copies them along.
+    for modo, ruta in entrega.get("derivados", {}).items():
+        subir_a_azure(container_client, ruta, primero, anio, mes,
+                      blob_derivado(blob_imagen(primero, anio, mes), modo))
+    estadisticas = entrega.get("estadisticas")
+    _subir_a_destinos(container_client, entrega["ruta"], entrega["destinos"], anio, mes,
+                      resultados, estadisticas_a_metadata(estadisticas) if estadisticas else None)
+
+
+def entregar(container_client, tarea: dict, estado: str, resultados: dict,
+             postproceso: dict | None = None) -> None:
+    """
+    Delivers the result of one single-month unit to every BPIN it covers and
+    updates their counters. Projects sharing a site get a server-side copy
+    of one upload.
+    """
+    for entrega in preparar_entregas(tarea, estado, resultados, postproceso):
+        subir_entrega(container_client, entrega, resultados)
+
+
+def _transmitir_tarea(connection, container_client, tarea: dict,
+                      descarga_log: list, resultados: dict) -> str | None:
+    """Zero-disk delivery of a single-month, single-site unit."""
+    anio, mes = tarea["anio"], tarea["mes"]
+    primero, *resto = _destinos(tarea["miembros"][0], anio, mes)
+
+    estado = transmitir_a_azure(connection, container_client, primero, tarea["bbox"],
+                                anio, mes, descarga_log)
+    if estado is None:
+        return None
+    _anotar("mes", bpin=primero, anio=anio, mes=mes, estado=estado, destinos=[primero, *resto])
+    _contar(resultados, primero, "imagenes_ok" if estado == "ok" else "imagenes_error")
+    _copiar_a_resto(container_client, primero, resto, anio, mes, resultados, estado == "ok")
+    if estado == "sin_datos":
+        _registrar_sin_datos([primero, *resto], anio, mes, resultados)
+    return estado
+
+
+def descargar_tarea(connection, container_client, tarea: dict, descarga_log: list,
+                    resultados: dict, stream: bool = False) -> tuple:
+    """
+    Downloads one unit synchronously. With `stream`, single-month units that
+    need no local cropping or splitting are streamed straight into Azure,
+    falling back to the local-file path if streaming fails.
+
+    Returns ({(anio, mes): estado}, [(tarea_mes, estado), ...]); the list
+    holds the months that still have to be delivered.
+    """
+    bpin = tarea["bpin"]
+    if stream and "meses" not in tarea and len(tarea["miembros"]) == 1:
+        estado = _transmitir_tarea(connection, container_client, tarea, descarga_log, resultados)
+        if estado is not None:
+            _observar_mes(tarea, estado)
+            return {(tarea["anio"], tarea["mes"]): estado}, []
+
+    perfil = tarea.get("perfil", "float32")
+    if "meses" in tarea:
+        estados = descargar_meses(connection, bpin, tarea["bbox"], tarea["meses"],
+                                  descarga_log, perfil)
+    else:
+        anio, mes = tarea["anio"], tarea["mes"]
+        estados   = {(anio, mes): descargar_mes(connection, bpin, tarea["bbox"],
+                                                anio, mes, descarga_log, perfil)}
+    por_entregar = [(tarea_por_mes(tarea, anio, mes), estado)
+                    for (anio, mes), estado in estados.items()]
+    for tarea_mes, estado in por_entregar:
+        _observar_mes(tarea_mes, estado)
+    return estados, por_entregar
+
+
+def procesar_tarea(connection, container_client, tarea: dict, descarga_log: list,
+                   resultados: dict, stream: bool = False, postproceso: dict | None = None) -> dict:
+    """Downloads one unit and delivers each of its months. Returns {(anio, mes): estado}."""
+    estados, por_entregar = descargar_tarea(connection, container_client, tarea,
+                                            descarga_log, resultados, stream)
+    for tarea_mes, estado in por_entregar:
+        entregar(container_client, tarea_mes, estado, resultados, postproceso)
+    return estados
+
+
+def _anunciar_tarea(tarea: dict) -> None:
+    n_bpins = sum(len(sitio["destinos"]) for sitio in tarea["miembros"])
+    destino = f" for {n_bpins} projects" if n_bpins > 1 else ""
+    log.info(f"Processing {tarea['bpin']}: {etiqueta_meses(meses_tarea(tarea))}{destino}")
+
+
+def procesar_secuencial(connection, container_client, tareas: list, descarga_log: list,
+                        resultados: dict, stream: bool = False,
+                        postproceso: dict | None = None) -> None:
+    for tarea in tareas:
+        if not _puede_empezar(tarea):
+            continue
+        _anunciar_tarea(tarea)
+        procesar_tarea(connection, container_client, tarea, descarga_log, resultados,
+                       stream, postproceso)
+
+
+def procesar_en_lotes(connection, tareas: list, descarga_log: list,
+                      max_jobs: int, al_terminar, reanudar: dict | None = None,
+                      terminados: list | None = None) -> None:
+    """
+    Submits every unit as an openEO batch job with up to `max_jobs` in
+    flight. `al_terminar(tarea_mes, estado)` receives each month as soon as
+    its job finishes. Units covered by a job in `reanudar` (see
+    trabajos_en_curso) re-attach to it; new jobs go to the journal.
+    Finished jobs go to `terminados` when given, see ejecutar_lotes.
+    """
+    log.info(f"Submitting {len(tareas)} openEO batch job(s), {max_jobs} in flight.")
+
+    def al_enviar(tarea, job):
+        _anotar("trabajo", job_id=job.job_id, bpin=tarea["bpin"], **firma_trabajo(tarea))
+
+    aplazadas = ejecutar_lotes(connection, tareas, max_jobs, al_terminar, descarga_log,
+                               reanudar, al_enviar,
+                               PRESUPUESTO.alcanza if PRESUPUESTO is not None else None,
+                               terminados)
+    if aplazadas:
+        PRESUPUESTO.aplazar(aplazadas)
+        log.info(f"Deadline near: {len(aplazadas)} batch job(s) not submitted.")
+
+
+def procesar_por_etapas(connection, container_client, tareas: list, descarga_log: list,
+                        resultados: dict, args, reanudar: dict | None = None) -> list:
+    """
+    Runs the work as a chain of stages connected by bounded queues:
+
+        download -> process -> upload
+
+    so the next download starts while earlier results are still being
+    cropped, analyzed and uploaded. Downloads come from `--download-workers`
+    synchronous workers or, with --max-jobs, from the batch-job scheduler
+    running on this thread. The process stage runs preparar_entregas (cluster
+    crops, post-processing, statistics and derivatives). A full queue blocks
+    the stage feeding it.
+
+    Returns the per-stage metrics (see utils/etapas.py).
+    """
+    subida = Etapa("upload", lambda entrega: subir_entrega(container_client, entrega, resultados),
+                   args.upload_workers, args.queue_size)
+    postproceso = opciones_postproceso(args)
+    preparar    = lambda par: preparar_entregas(par[0], par[1], resultados, postproceso)
+
+    etapas = [Etapa("process", preparar, args.post_workers, args.queue_size), subida]
+    terminados = []
+
+    if args.max_jobs == 0:
+        def descargar(tarea):
+            if not _puede_empezar(tarea):
+                return []
+            _anunciar_tarea(tarea)
+            _, por_entregar = descargar_tarea(connection, container_client, tarea,
+                                              descarga_log, resultados, args.stream_upload)
+            return por_entregar
+
+        etapas.insert(0, Etapa("download", descargar, args.download_workers, args.queue_size))
+
+    for etapa in etapas:
+        etapa.on_error = lambda item, e, nombre=etapa.nombre: log.error(f"{nombre} stage: {e}")
+    primera = encadenar(*etapas).iniciar()
+
+    try:
+        if args.max_jobs > 0:
+            # The batch scheduler itself is the download stage; its time spent
+            # blocked on a full queue shows up as longer polling intervals.
+            def al_terminar(tarea_mes, estado):
+                _observar_mes(tarea_mes, estado)
+                primera.poner((tarea_mes, estado))
+
+            procesar_en_lotes(connection, tareas, descarga_log, args.max_jobs, al_terminar,
+                              reanudar, terminados)
+        else:
+            for tarea in tareas:
+                primera.poner(tarea)
+    finally:
+        # Also when the producer raises: every stage finishes what it holds
+        # and is joined before the exception propagates, and its metrics
+        # reach the log even though main() prints no summary then.
+        primera.cerrar()
+        metricas = resumen_etapas(primera)
+        log.info("Stage metrics: " + "; ".join(
+            f"{m['etapa']} {m['procesados']} item(s), {m['errores']} error(s)" for m in metricas))
+
+    # Only now are their results uploaded and journaled; a run that dies
+    # earlier leaves the jobs for the next one to re-attach to.
+    borrar_trabajos(terminados)
+    return metricas
+
+
 # ── Main (single run) ────────────────────────────────────────────────
 
 def parse_args():
@@ -235,12 +1093,186 @@ def parse_args():
         action="store_true",
         help="Run without asking for manual confirmation before processing.",
     )
+    parser.add_argument(
+        "--shard",
+        type=parsear_shard,
+        default=None,
+        metavar="K/N",
+        help="Process only slice K of N (1-based) of the projects, split by a stable "
+             "hash of the BPIN, so N workers can run in parallel without overlapping. "
+             "State and log files get a .shardKofN suffix; merge them with "
+             "utils/shards.py. --cluster-km groups projects within each slice.",
+    )
+    parser.add_argument(
+        "--priority",
+        type=parsear_prioridad,
+        default="sheet",
+        metavar="KEYS",
+        help=f"Order of the download requests, as comma-separated keys applied in turn: "
+             f"{', '.join(CLAVES_PRIORIDAD)} (default: sheet). Requests deferred by the "
+             f"previous run always go first.",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        metavar="MIN",
+        help="Time budget in minutes from start. A request is only started if its "
+             "estimated duration, learned from past runs, fits before the deadline; "
+             "the rest is saved and goes first in the next run.",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help=f"Start a new run journal ({RUTA_BITACORA}, mirrored to {BLOB_BITACORA}) "
+             f"even if the previous run was interrupted, instead of recording its "
+             f"uploads in the manifest and re-attaching to its openEO batch jobs.",
+    )
+    parser.add_argument(
+        "--inventory",
+        choices=("manifest", "container", "per-project"),
+        default="manifest",
+        help=f"How existing images are discovered: the container manifest "
+             f"({BLOB_MANIFIESTO}, default), a single listing of the whole container, "
+             f"or one listing per BPIN.",
+    )
+    parser.add_argument(
+        "--repair-manifest",
+        action="store_true",
+        help=f"Rebuild {BLOB_MANIFIESTO} from a container listing before computing the "
+             f"pending work, e.g. after blobs were added or deleted outside the pipeline.",
+    )
+    parser.add_argument(
+        "--no-data-ttl-days",
+        type=int,
+        default=TTL_SIN_DATOS_DIAS,
+        metavar="N",
+        help=f"Skip months Copernicus had no data for until N days after the last check "
+             f"(default {TTL_SIN_DATOS_DIAS}, or NO_DATA_TTL_DAYS). The no-data records "
+             f"live in {BLOB_MANIFIESTO}; 0 re-checks them every run.",
+    )
+    parser.add_argument(
+        "--no-stac-preflight",
+        action="store_true",
+        help=f"Send every pending month to openEO, without first checking the STAC "
+             f"catalogue for scenes under {MAX_NUBOSIDAD}%% cloud cover.",
+    )
+    parser.add_argument(
+        "--stac-workers",
+        type=int,
+        default=WORKERS_STAC,
+        metavar="N",
+        help=f"Concurrent STAC searches of the pre-flight check (default {WORKERS_STAC}).",
+    )
+    parser.add_argument(
+        "--inventory-workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help=f"Split the container listing into name ranges paged on N threads "
+             f"(e.g. {INVENTARIO_WORKERS}). Only used with --inventory container.",
+    )
+    parser.add_argument(
+        "--max-jobs",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Run downloads as openEO batch jobs with up to N in flight at once. "
+             "With 0 (default) each month is downloaded synchronously, one at a time.",
+    )
+    parser.add_argument(
+        "--multi-month",
+        action="store_true",
+        help="Request all pending months of a project in one openEO graph "
+             "(monthly median per month) and split the result locally.",
+    )
+    parser.add_argument(
+        "--cluster-km",
+        type=float,
+        default=None,
+        metavar="D",
+        help="Share one openEO request among projects whose bboxes overlap or "
+             "are less than D km apart, cropping each project's window locally.",
+    )
+    parser.add_argument(
+        "--stream-upload",
+        action="store_true",
+        help="Stream each single-month result from openEO straight into a parallel "
+             "block upload to Azure, without writing it to disk. Falls back to the "
+             "local-file path when streaming fails. Streamed images skip the COG "
+             "rewrite. Ignored with --max-jobs.",
+    )
+    parser.add_argument(
+        "--storage-profile",
+        choices=PERFILES_ALMACENAMIENTO,
+        default="float32",
+        help="How band values are stored: float32 reflectance (default) or "
+             "scaled-int16 digital numbers with scale/offset metadata and an explicit "
+             "nodata value, half the bytes. The app reads both.",
+    )
+    parser.add_argument(
+        "--cog-compression",
+        choices=COMPRESIONES_COG,
+        default="DEFLATE",
+        help="Compression of the Cloud-Optimized GeoTIFF written before each upload "
+             "(internal tiles, overviews and a predictor). Default: DEFLATE.",
+    )
+    parser.add_argument(
+        "--no-cog",
+        action="store_true",
+        help="Upload the GeoTIFF exactly as openEO returns it, without the COG rewrite.",
+    )
+    parser.add_argument(
+        "--no-derivatives",
+        action="store_true",
+        help="Skip the pre-rendered uint8 RGB COGs (natural, gris, falso) uploaded under "
+             "derivados/ for the app.",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Overlap downloads, local processing and uploads: run N synchronous "
+             "download workers feeding bounded queues. With 0 (default) each unit is "
+             "downloaded and uploaded before the next one starts. --max-jobs always "
+             "uses the staged pipeline, with the batch scheduler as download stage.",
+    )
+    parser.add_argument(
+        "--post-workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Worker threads of the local processing stage (cluster crops, "
+             "post-processing, statistics and derivatives).",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=2,
+        metavar="N",
+        help="Worker threads of the Azure upload stage.",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=4,
+        metavar="N",
+        help="Capacity of each queue between stages; a full queue pauses the "
+             "stage feeding it.",
+    )
     return parser.parse_args()
 
 
 def main():
+    global LOG_PATH
+    inicio_corrida = time.monotonic()
     args = parse_args()
     validar_configuracion()
+    if args.shard:
+        LOG_PATH = Path(ruta_shard(str(LOG_PATH), args.shard))
+        registrar_log_en(LOG_PATH)
+        log.info(f"Shard {args.shard[0]}/{args.shard[1]}: logging to {LOG_PATH}.")
 
     log.info("Reading project metadata...")
     df = leer_metadata_proyectos()
@@ -253,17 +1285,71 @@ def main():
             print(f"  - {bpin_dup}")
         print("Only the first occurrence of each will be processed. Consider")
         print("cleaning up duplicate rows in the metadata source.")
-        df = df.drop_duplicates(subset=["bpin"], keep="first")
-
-    blob_service     = BlobServiceClient.from_connection_string(AZURE_CONN_STR)
-    container_client = blob_service.get_container_client(AZURE_CONTAINER)
+        df = df.drop_duplicates(subset=["bpin"], keep="first")
+
+    if args.shard:
+        total = len(df)
+        df    = filtrar_shard(df, *args.shard)
+        log.info(f"Shard {args.shard[0]}/{args.shard[1]}: {len(df)} of {total} project(s).")
 
-    print("\nChecking Azure Blob Storage for existing images per project...")
-    pendientes_por_proyecto = calcular_pendientes(df, container_client)
+    blob_service     = BlobServiceClient.from_connection_string(
+        AZURE_CONN_STR, max_block_size=STREAM_BLOCK_MB * 1024 * 1024,
+    )
+    container_client = blob_service.get_container_client(AZURE_CONTAINER)
+
+    global BITACORA
+    BITACORA = Bitacora(ruta_shard(RUTA_BITACORA, args.shard),
+                        container_client.get_blob_client(ruta_shard(BLOB_BITACORA, args.shard)))
+    if not args.no_resume:
+        try:
+            repuestas = reponer_subidas(container_client,
+                                        subidas_confirmadas(BITACORA.interrumpida()))
+            if repuestas:
+                log.info(f"Recorded {repuestas} upload(s) of the interrupted run in "
+                         f"{BLOB_MANIFIESTO}.")
+        except Exception as e:
+            log.warning(f"Could not record the interrupted run's uploads in {BLOB_MANIFIESTO}: {e}")
+
+    print("\nChecking Azure Blob Storage for existing images per project...")
+    inicio = time.perf_counter()
+    inventario = None
+    manifiesto = None
+    if args.inventory == "manifest" or args.repair_manifest:
+        manifiesto = cargar_manifiesto(container_client, args.repair_manifest)
+        inventario = inventario_desde_manifiesto(manifiesto)
+        log.info(f"Manifest inventory: {sum(len(m) for m in inventario.values())} image(s) "
+                 f"for {len(inventario)} BPIN(s) in {time.perf_counter() - inicio:.2f}s.")
+    elif args.no_data_ttl_days > 0:
+        manifiesto, _ = leer_manifiesto(container_client)   # no-data records only
+    if args.inventory == "container":
+        bpins      = [str(b).strip() for b in df["bpin"]]
+        inventario = inventario_azure(container_client, bpins, args.inventory_workers)
+        log.info(f"Container inventory: {sum(len(m) for m in inventario.values())} image(s) "
+                 f"for {len(inventario)} BPIN(s) listed in {time.perf_counter() - inicio:.2f}s "
+                 f"with {args.inventory_workers} worker(s).")
+    sin_datos = {}
+    if manifiesto is not None and args.no_data_ttl_days > 0:
+        sin_datos = meses_sin_datos(manifiesto, args.no_data_ttl_days)
+    omitidos = []
+    pendientes_por_proyecto = calcular_pendientes(df, container_client, inventario,
+                                                  sin_datos, omitidos)
+    log.info(f"Pending-work diff ({args.inventory}) computed in "
+             f"{time.perf_counter() - inicio:.2f}s for {len(df)} row(s).")
+    if omitidos:
+        log.info(f"Skipping {len(omitidos)} month(s) of {len({b for b, _, _ in omitidos})} "
+                 f"BPIN(s) with no Copernicus data in the last {args.no_data_ttl_days} day(s).")
+
+    sin_escenas = []
+    if pendientes_por_proyecto and not args.no_stac_preflight:
+        pendientes_por_proyecto, sin_escenas = prevuelo_stac(pendientes_por_proyecto,
+                                                             args.stac_workers)
+        log.info(f"STAC pre-flight left out {len(sin_escenas)} month(s) with no scene "
+                 f"under {MAX_NUBOSIDAD}% cloud cover.")
 
     if not pendientes_por_proyecto:
-        print("\nAll projects in the sheet already have their images in Azure. Nothing to do.")
-        return
+        print("\nAll projects in the sheet already have their images in Azure. Nothing to do.")
+        BITACORA.descartar(motivo="nothing to do")
+        return
 
     print(f"\n{len(pendientes_por_proyecto)} project(s) with missing images:")
     for item in pendientes_por_proyecto:
@@ -278,39 +1364,135 @@ def main():
         respuesta = input("\nProceed with download and upload for these? [y/N]: ").strip().lower()
         if respuesta != "y":
             print("Cancelled. No changes made.")
+            BITACORA.descartar(motivo="cancelled")
             return
     else:
         log.info("Automatic mode active (--auto): skipping manual confirmation.")
 
+    global REGISTRO_MANIFIESTO
+    REGISTRO_MANIFIESTO = RegistroManifiesto(container_client)
+    for bpin, anio, mes in sin_escenas:
+        REGISTRO_MANIFIESTO.registrar_sin_datos(bpin, anio, mes)
+
     log.info("Authenticating with Copernicus...")
     connection = openeo.connect("openeo.dataspace.copernicus.eu")
     connection.authenticate_oidc(max_poll_time=120)
-    log.info("Copernicus authentication successful.")
+    log.info("Copernicus authentication successful.")
+    LIMITADOR_OPENEO.instalar_en_sesion(connection)
 
-    descarga_log = []
-    resultados   = []
-    for item in pendientes_por_proyecto:
-        resultado = procesar_proyecto(
-            connection, container_client, item["row"], item["pendientes"], descarga_log,
-        )
-        resultados.append(resultado)
+    descarga_log = []
+    por_bpin     = {}
+    tareas, copias, areas = planificar_tareas(
+        pendientes_por_proyecto, por_bpin, args.multi_month, args.cluster_km,
+        args.storage_profile,
+    )
+    reanudar = trabajos_en_curso(BITACORA.iniciar(reanudar=not args.no_resume))
+    if reanudar:
+        n_trabajos = len({t["job_id"] for trabajos in reanudar.values() for t in trabajos})
+        log.info(f"Resuming an interrupted run: {n_trabajos} openEO batch job(s) to "
+                 f"re-attach to.")
+        if args.max_jobs == 0:
+            log.warning("Re-attaching to batch jobs needs --max-jobs; they will be requested again.")
+    _anotar("plan", tareas=len(tareas), copias=len(copias), shard=args.shard)
+
+    global PRESUPUESTO
+    blob_aplazadas = ruta_shard(BLOB_APLAZADAS, args.shard)
+    # Per shard as well: parallel shards would overwrite each other's history.
+    blob_costos    = ruta_shard(BLOB_COSTOS, args.shard)
+    contexto = {
+        "posicion":   {str(b).strip(): i for i, b in enumerate(df["bpin"])},
+        "existentes": {str(item["row"]["bpin"]).strip(): len(item["existentes"])
+                       for item in pendientes_por_proyecto},
+        "aplazadas":  {tuple(m) for m in leer_json(container_client, blob_aplazadas, [])},
+    }
+    tareas      = ordenar_tareas(tareas, args.priority, contexto)
+    PRESUPUESTO = Presupuesto(args.deadline * 60 if args.deadline else None,
+                              leer_json(container_client, blob_costos, {}),
+                              "batch" if args.max_jobs > 0 else "sync", inicio_corrida)
+    log.info(f"Requests ordered by {','.join(args.priority)}, "
+             f"{len(contexto['aplazadas'])} month(s) carried over from the last run; "
+             f"estimated {PRESUPUESTO.segundos_por_mes():.0f}s per month.")
+
+    log.info(f"Planned {len(tareas)} request(s) covering {areas['solicitada']:.0f} km2 "
+             f"({areas['sin_agrupar']:.0f} km2 without deduplication/clustering).")
+    if copias:
+        log.info(f"{len(copias)} image(s) already exist for another BPIN with the same "
+                 f"coordinates; copying them server-side.")
+        copiar_pendientes(container_client, copias, por_bpin)
+
+    if args.stream_upload and args.max_jobs > 0:
+        log.warning("--stream-upload has no effect with --max-jobs; batch results go through disk.")
+    if args.stream_upload and args.storage_profile == "scaled-int16":
+        log.warning("--stream-upload is disabled with --storage-profile scaled-int16: the "
+                    "scale and nodata metadata are written locally before upload.")
+        args.stream_upload = False
+    metricas_etapas = []
+    inicio = time.perf_counter()
+    try:
+        if args.max_jobs > 0 or args.download_workers > 0:
+            metricas_etapas = procesar_por_etapas(connection, container_client, tareas,
+                                                  descarga_log, por_bpin, args, reanudar)
+        else:
+            procesar_secuencial(connection, container_client, tareas, descarga_log, por_bpin,
+                                args.stream_upload, opciones_postproceso(args))
+    finally:
+        # Also on a crash: whatever was uploaded must reach the manifest,
+        # or the next run would download it again.
+        vaciar_manifiesto()
+    duracion = time.perf_counter() - inicio
+    log.info(f"openEO rate limiter: {LIMITADOR_OPENEO.metricas()}")
+
+    resultados = list(por_bpin.values())
+    for resultado in resultados:
+        log.info(f"{resultado['bpin']}: {resultado['imagenes_ok']} uploaded, "
+                 f"{resultado['imagenes_error']} failed")
 
     # audit log only, not used to decide what runs next time
-    STATE_PATH.write_text(
+    Path(ruta_shard(str(STATE_PATH), args.shard)).write_text(
         json.dumps({r["bpin"]: r for r in resultados}, indent=2, ensure_ascii=False),
         encoding="utf-8",
     )
 
     os.makedirs(CARPETA_SALIDA, exist_ok=True)
-    with open(os.path.join(CARPETA_SALIDA, "log_descarga.txt"), "w", encoding="utf-8") as f:
-        f.write("\n".join(descarga_log))
-
+    with open(ruta_shard(os.path.join(CARPETA_SALIDA, "log_descarga.txt"), args.shard),
+              "w", encoding="utf-8") as f:
+        f.write("\n".join(descarga_log))
+
+    aplazados = PRESUPUESTO.meses_aplazados()
+    guardar_json(container_client, blob_aplazadas, [list(m) for m in aplazados])
+    guardar_json(container_client, blob_costos, PRESUPUESTO.historial)
+    if aplazados:
+        _anotar("aplazadas", meses=aplazados)
+        log.warning(f"Deadline reached: {len(aplazados)} project month(s) deferred to the next "
+                    f"run ({blob_aplazadas}).")
+
+    # Only a run that gets here is complete; otherwise the next one resumes it.
+    BITACORA.cerrar(imagenes_ok=sum(r["imagenes_ok"] for r in resultados),
+                    imagenes_error=sum(r["imagenes_error"] for r in resultados))
+
     print("\n--- Summary ---")
     total_ok    = sum(r["imagenes_ok"] for r in resultados)
     total_error = sum(r["imagenes_error"] for r in resultados)
     print(f"  Projects processed : {len(resultados)}")
     print(f"  Images uploaded     : {total_ok}")
-    print(f"  Images failed       : {total_error}")
+    print(f"  Images failed       : {total_error}")
+    print(f"  Copied server-side  : {sum(r['imagenes_copiadas'] for r in resultados)}")
+    print(f"  No data (recorded)  : {sum(r['imagenes_sin_datos'] for r in resultados)}")
+    print(f"  No-data jobs skipped: {len(omitidos)} month(s), re-checked after "
+          f"{args.no_data_ttl_days} day(s)")
+    print(f"  STAC pre-flight     : {len(sin_escenas)} month(s) without usable scenes "
+          f"left out")
+    print(f"  Deferred (deadline) : {len(PRESUPUESTO.aplazadas)} request(s), "
+          f"{len(aplazados)} project month(s)")
+    print(f"  Area downloaded     : {areas['solicitada']:.0f} km2 "
+          f"(without dedup/clustering: {areas['sin_agrupar']:.0f} km2)")
+    print(f"  Processing time     : {duracion:.0f}s")
+    if metricas_etapas:
+        print("  Stages              : workers  items  errors  queue max/avg  busy s  idle s  blocked s")
+        for m in metricas_etapas:
+            print(f"    {m['etapa']:<17}: {m['workers']:>7}  {m['procesados']:>5}  {m['errores']:>6}  "
+                  f"{m['profundidad_max']:>5}/{m['profundidad_media']:<7.1f}  {m['ocupado_s']:>6.0f}  "
+                  f"{m['inactivo_s']:>6.0f}  {m['bloqueado_s']:>9.0f}")
     print(f"  Log file            : {LOG_PATH}")
 
 
@@ -0,0 +1,108 @@
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+import pipeline
+from utils import lotes_openeo
+from utils.bitacora import Bitacora, subidas_confirmadas, trabajos_en_curso
+from utils.manifiesto import (
+    escribir_manifiesto, inventario_desde_manifiesto, leer_manifiesto, manifiesto_vacio,
+)
+
+BPIN  = "2021000001"
+MESES = [("2024", "01"), ("2024", "02"), ("2024", "03")]
+
+
+class _Caida(BaseException):
+    """The runner dying mid-run: nothing in the pipeline catches it."""
+
+
+class _Descarga:
+    def __init__(self, datos: bytes, etag: str):
+        self._datos     = datos
+        self.properties = type("Propiedades", (), {"etag": etag})()
+
+    def readall(self) -> bytes:
+        return self._datos
+
+
+class _Blob:
+    def __init__(self, blobs: dict, nombre: str):
+        self.blobs, self.blob_name = blobs, nombre
+
+    def download_blob(self, **kwargs):
+        if self.blob_name not in self.blobs:
+            raise ResourceNotFoundError(self.blob_name)
+        return _Descarga(*self.blobs[self.blob_name])
+
+    def upload_blob(self, datos, **kwargs):
+        etag = f'"{len(self.blobs)}"'
+        self.blobs[self.blob_name] = (datos, etag)
+        return {"etag": etag}
+
+
+class _Contenedor:
+    def __init__(self):
+        self.blobs = {}
+
+    def get_blob_client(self, nombre: str) -> _Blob:
+        return _Blob(self.blobs, nombre)
+
+
+class _Job:
+    def __init__(self, job_id: str, estado: str):
+        self.job_id, self.estado = job_id, estado
+
+    def status(self):
+        if self.estado == "caida":
+            raise _Caida()
+        return self.estado
+
+
+def _planificar(pendientes: list) -> list:
+    item = {"row": {"bpin": BPIN, "latitud": "4°36'0\"N", "longitud": "74°4'0\"W"},
+            "pendientes": pendientes, "existentes": set()}
+    tareas, _, _ = pipeline.planificar_tareas([item], {}, multimes=True)
+    return tareas
+
+
+def test_resumed_run_reattaches_to_partly_uploaded_multi_month_job(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(lotes_openeo, "INTERVALO_SONDEO", 0)
+    contenedor = _Contenedor()
+    escribir_manifiesto(contenedor, manifiesto_vacio(), None)
+
+    # First run: one 3-month job is submitted, its first month uploaded, then the runner dies.
+    monkeypatch.setattr(pipeline, "BITACORA", Bitacora(str(tmp_path / "journal.jsonl")))
+    pipeline.BITACORA.iniciar(reanudar=False)
+    monkeypatch.setattr(lotes_openeo, "enviar_trabajo", lambda connection, tarea: _Job("J1", "caida"))
+    with pytest.raises(_Caida):
+        pipeline.procesar_en_lotes(None, _planificar(MESES), [], 1, lambda *a: None)
+    pipeline._registrar_blob(f"sentinel2_{BPIN}/2024_01.tiff", 10, '"E1"')
+
+    # Second run on a fresh runner: the upload is replayed, the plan shrinks to two months.
+    bitacora = Bitacora(str(tmp_path / "journal.jsonl"))
+    monkeypatch.setattr(pipeline, "BITACORA", bitacora)
+    assert pipeline.reponer_subidas(contenedor, subidas_confirmadas(bitacora.interrumpida())) == 1
+    ya_en_azure = inventario_desde_manifiesto(leer_manifiesto(contenedor)[0])[BPIN]
+    tareas = _planificar([m for m in MESES if m not in ya_en_azure])
+    assert [t["meses"] for t in tareas] == [MESES[1:]]
+
+    reanudar = trabajos_en_curso(bitacora.iniciar())
+    enviados, descargas, entregados = [], [], []
+    monkeypatch.setattr(lotes_openeo, "enviar_trabajo", lambda c, tarea: enviados.append(tarea))
+    monkeypatch.setattr(lotes_openeo, "reenganchar_trabajo",
+                        lambda c, job_id: _Job(job_id, "finished"))
+    monkeypatch.setattr(lotes_openeo, "borrar_trabajos", lambda jobs: None)
+
+    def descargar(job, tarea, log, meses_job=None, bbox_job=None):
+        descargas.append((job.job_id, lotes_openeo.meses_tarea(tarea), meses_job))
+        return {m: "ok" for m in lotes_openeo.meses_tarea(tarea)}
+
+    monkeypatch.setattr(lotes_openeo, "_descargar_resultado", descargar)
+    pipeline.procesar_en_lotes(None, tareas, [], 1,
+                               lambda tarea_mes, estado: entregados.append(tarea_mes["mes"]),
+                               reanudar)
+
+    assert enviados == []
+    assert descargas == [("J1", MESES[1:], MESES)]
+    assert entregados == ["02", "03"]
@@ -0,0 +1,52 @@
+import io
+from unittest import mock
+
+import pipeline
+
+
+class _RespuestaFalsa:
+    """Stands in for the streaming requests.Response returned by openEO."""
+
+    def __init__(self, contenido: bytes):
+        self.raw    = io.BytesIO(contenido)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _subir_todo(lector, **kwargs):
+    while lector.read(3):
+        pass
+    return {"etag": '"0x8DC"', "last_modified": None}
+
+
+def test_stream_upload_ok(monkeypatch):
+    respuesta = _RespuestaFalsa(b"GTiff bytes")
+    monkeypatch.setattr(pipeline, "abrir_resultado_mes", lambda *a: respuesta)
+    registrados = []
+    monkeypatch.setattr(pipeline, "_registrar_blob", lambda *a: registrados.append(a))
+
+    container_client = mock.MagicMock()
+    container_client.get_blob_client.return_value.upload_blob.side_effect = _subir_todo
+    descarga_log = []
+
+    estado = pipeline.transmitir_a_azure(None, container_client, "2021001", {}, "2024", "03",
+                                         descarga_log)
+
+    assert estado == "ok"
+    assert respuesta.closed
+    assert registrados == [("sentinel2_2021001/2024_03.tiff", 11, '"0x8DC"')]
+    assert descarga_log[-1].startswith("OK | 2021001 | 2024-03")
+
+
+def test_stream_upload_failure_falls_back(monkeypatch):
+    respuesta = _RespuestaFalsa(b"partial")
+    monkeypatch.setattr(pipeline, "abrir_resultado_mes", lambda *a: respuesta)
+    container_client = mock.MagicMock()
+    container_client.get_blob_client.return_value.upload_blob.side_effect = OSError("reset")
+
+    estado = pipeline.transmitir_a_azure(None, container_client, "2021001", {}, "2024", "03", [])
+
+    assert estado is None
+    assert respuesta.closed
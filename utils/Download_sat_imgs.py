@@ -9,10 +9,16 @@ Usage:
 import openeo
 import os
 import re
-import time
 import calendar
 import numpy as np
 import pandas as pd
+import xarray as xr
+import rioxarray  # noqa: F401  (registers the .rio accessor)
+
+try:
+    from utils.limitador_tasa import LIMITADOR_OPENEO, es_limite_tasa
+except ImportError:   # run as a script from inside utils/
+    from limitador_tasa import LIMITADOR_OPENEO, es_limite_tasa
 
 
 # ── Configuration ─────────────────────────────────────────────────
@@ -27,10 +33,20 @@ DESCARGA = {
 MAX_NUBOSIDAD         = 50
 KM_BUFFER             = 5
 CARPETA_SALIDA        = "Imagenes"
-PAUSA_ENTRE_DESCARGAS = 5
 MAX_REINTENTOS        = 4
+TIMEOUT_SINCRONO      = 30 * 60
 PROYECTOS_LIMITE      = None
 
+# Storage profile of the downloaded bands:
+#   "float32"      reflectance, scaled server-side (x * 0.0001)
+#   "scaled-int16" digital numbers as int16, with scale/offset metadata
+#                  and an explicit nodata value (half the bytes)
+PERFILES_ALMACENAMIENTO = ("float32", "scaled-int16")
+PERFIL_ALMACENAMIENTO   = "float32"
+ESCALA_REFLECTANCIA     = 0.0001
+NODATA_INT16            = -32768
+MAX_DN_INT16            = 32767
+
 # ─────────────────────────────────────────────────────────────────
 
 
@@ -58,71 +74,244 @@ def calcular_bbox(lat: float, lon: float, km: float) -> dict:
     }
 
 
-def descargar_mes(connection, bpin: str, bbox: dict,
-                  anio: str, mes: str, log: list) -> str:
-    carpeta   = os.path.join(CARPETA_SALIDA, f"sentinel2_{bpin}")
-    ruta_tiff = os.path.join(carpeta, f"{anio}_{mes}.tiff")
+def ruta_local(bpin: str, anio: str, mes: str) -> str:
+    return os.path.join(CARPETA_SALIDA, f"sentinel2_{bpin}", f"{anio}_{mes}.tiff")
+
+
+def es_sin_datos(msg: str) -> bool:
+    return "NoDataAvailable" in msg or "no data" in msg.lower()
 
-    if os.path.exists(ruta_tiff):
-        log.append(f"SKIPPED | {bpin} | {anio}-{mes} | {ruta_tiff}")
-        return "ya_existe"
 
-    os.makedirs(carpeta, exist_ok=True)
+def _aplicar_perfil(cubo, perfil: str):
+    if perfil == "scaled-int16":
+        # Keep digital numbers; an integer output range makes the backend
+        # write integer pixels instead of float32.
+        return cubo.linear_scale_range(0, MAX_DN_INT16, 0, MAX_DN_INT16)
+    return cubo.apply(lambda x: x * ESCALA_REFLECTANCIA)
 
+
+def construir_composicion(connection, bbox: dict, anio: str, mes: str,
+                          perfil: str = PERFIL_ALMACENAMIENTO):
+    """
+    Builds the monthly cloud-masked median composite for one bbox as a lazy
+    openEO datacube. Nothing is sent to the backend until it is downloaded
+    or submitted as a batch job.
+    """
     ultimo_dia      = calendar.monthrange(int(anio), int(mes))[1]
     temporal_extent = [f"{anio}-{mes}-01", f"{anio}-{mes}-{ultimo_dia}"]
 
+    cubo = connection.load_collection(
+        "SENTINEL2_L2A",
+        spatial_extent=bbox,
+        temporal_extent=temporal_extent,
+        bands=["B02", "B03", "B04", "B08", "SCL"],
+        max_cloud_cover=MAX_NUBOSIDAD,
+    )
+    cubo        = cubo.process("mask_scl_dilation", data=cubo, scl_band_name="SCL")
+    composicion = cubo.reduce_dimension(dimension="t", reducer="median")
+    return _aplicar_perfil(composicion, perfil)
+
+
+def _intervalo_mes(anio: str, mes: str) -> list:
+    """[first day, first day of next month): openEO end dates are exclusive."""
+    siguiente = pd.Timestamp(f"{anio}-{mes}-01") + pd.offsets.MonthBegin(1)
+    return [f"{anio}-{mes}-01", siguiente.strftime("%Y-%m-%d")]
+
+
+def construir_composicion_multimes(connection, bbox: dict, meses: list,
+                                   perfil: str = PERFIL_ALMACENAMIENTO):
+    """
+    Builds one lazy datacube with a cloud-masked median composite for each
+    (anio, mes) in `meses`. The collection is loaded and masked once for the
+    whole extent, and aggregate_temporal reduces only the requested months,
+    so gaps between non-consecutive months are never composited.
+    """
+    intervalos = [_intervalo_mes(anio, mes) for anio, mes in sorted(meses)]
+
+    cubo = connection.load_collection(
+        "SENTINEL2_L2A",
+        spatial_extent=bbox,
+        temporal_extent=[intervalos[0][0], intervalos[-1][1]],
+        bands=["B02", "B03", "B04", "B08", "SCL"],
+        max_cloud_cover=MAX_NUBOSIDAD,
+    )
+    cubo      = cubo.process("mask_scl_dilation", data=cubo, scl_band_name="SCL")
+    compuesto = cubo.aggregate_temporal(
+        intervals=intervalos,
+        reducer="median",
+        labels=[inicio for inicio, _ in intervalos],
+    )
+    return _aplicar_perfil(compuesto, perfil)
+
+
+def dividir_por_mes(ruta_nc: str, bpin: str, meses: list, log: list) -> dict:
+    """
+    Splits a multi-month netCDF result into the per-month GeoTIFFs that the
+    single-month path would have written. Returns {(anio, mes): estado}.
+    """
+    estados = {}
+    with xr.open_dataset(ruta_nc, decode_coords="all") as ds:
+        bandas = [v for v in ds.data_vars if {"y", "x"} <= set(ds[v].dims)]
+        crs    = ds.rio.crs
+        fechas = {pd.Timestamp(t).strftime("%Y-%m"): t for t in ds["t"].values}
+
+        for anio, mes in meses:
+            ruta_tiff = ruta_local(bpin, anio, mes)
+            t = fechas.get(f"{anio}-{mes}")
+            if t is None:
+                log.append(f"NO_DATA | {bpin} | {anio}-{mes} | month missing from result")
+                estados[(anio, mes)] = "sin_datos"
+                continue
+
+            capa = ds[bandas].sel(t=t).to_array(dim="band").astype("float32")
+            if not bool(capa.notnull().any()):
+                log.append(f"NO_DATA | {bpin} | {anio}-{mes} | all pixels masked")
+                estados[(anio, mes)] = "sin_datos"
+                continue
+
+            capa = capa.assign_coords(band=np.arange(1, len(bandas) + 1))
+            capa.rio.write_crs(crs, inplace=True)
+            os.makedirs(os.path.dirname(ruta_tiff), exist_ok=True)
+            capa.rio.to_raster(ruta_tiff)
+            log.append(f"OK | {bpin} | {anio}-{mes} | {ruta_tiff}")
+            estados[(anio, mes)] = "ok"
+    return estados
+
+
+def _descargar_con_reintentos(descargar, bpin: str, periodo: str,
+                              destino: str, log: list) -> str:
+    """
+    Runs `descargar()` (a synchronous openEO download) with the shared
+    retry policy: every attempt goes through LIMITADOR_OPENEO, HTTP 429 is
+    retried after the pause the limiter imposes, anything else gives up.
+    """
     intento = 0
     while intento <= MAX_REINTENTOS:
-        if intento > 0:
-            time.sleep(2 ** intento)
-
-        print(f"  {anio}-{mes}  attempt {intento + 1}/{MAX_REINTENTOS + 1}", end=" ", flush=True)
+        LIMITADOR_OPENEO.adquirir()
+        print(f"  {periodo}  attempt {intento + 1}/{MAX_REINTENTOS + 1}", end=" ", flush=True)
 
         try:
-            cubo = connection.load_collection(
-                "SENTINEL2_L2A",
-                spatial_extent=bbox,
-                temporal_extent=temporal_extent,
-                bands=["B02", "B03", "B04", "B08", "SCL"],
-                max_cloud_cover=MAX_NUBOSIDAD,
-            )
-            cubo        = cubo.process("mask_scl_dilation", data=cubo, scl_band_name="SCL")
-            composicion = cubo.reduce_dimension(dimension="t", reducer="median")
-            composicion = composicion.apply(lambda x: x * 0.0001)
-            composicion.download(ruta_tiff, format="GTiff")
+            descargar()
+            LIMITADOR_OPENEO.exito()
 
             print("-> [OK]")
-            log.append(f"OK | {bpin} | {anio}-{mes} | {ruta_tiff}")
+            log.append(f"OK | {bpin} | {periodo} | {destino}")
             return "ok"
 
         except Exception as e:
             msg = str(e)
 
-            if "429" in msg:
-                retry_after = 10
-                ra_match    = re.search(r"Retry-After.*?(\d+)", msg)
-                if ra_match:
-                    retry_after = max(int(ra_match.group(1)), 5)
-                print(f"-> [RATE LIMITED] waiting {retry_after}s")
-                time.sleep(retry_after)
+            if es_limite_tasa(e):
+                pausa = LIMITADOR_OPENEO.limitado()
+                print(f"-> [RATE LIMITED] waiting {pausa:.0f}s")
                 intento += 1
                 continue
 
-            if "NoDataAvailable" in msg or "no data" in msg.lower():
+            if es_sin_datos(msg):
+                LIMITADOR_OPENEO.exito()
                 print("-> [NO DATA]")
-                log.append(f"NO_DATA | {bpin} | {anio}-{mes} | {msg[:120]}")
+                log.append(f"NO_DATA | {bpin} | {periodo} | {msg[:120]}")
                 return "sin_datos"
 
             print(f"-> [ERROR] {msg[:100]}")
-            log.append(f"ERROR | {bpin} | {anio}-{mes} | {msg[:120]}")
+            log.append(f"ERROR | {bpin} | {periodo} | {msg[:120]}")
             return "error"
 
     print("-> [MAX RETRIES REACHED]")
-    log.append(f"MAX_RETRIES | {bpin} | {anio}-{mes}")
+    log.append(f"MAX_RETRIES | {bpin} | {periodo}")
     return "error"
 
 
+def abrir_resultado_mes(connection, bbox: dict, anio: str, mes: str,
+                        perfil: str = PERFIL_ALMACENAMIENTO):
+    """
+    Sends the monthly composite for synchronous processing and returns the
+    open streaming HTTP response with the GeoTIFF body, without reading it.
+    The caller is responsible for closing the response.
+    """
+    composicion = construir_composicion(connection, bbox, anio, mes, perfil).save_result(format="GTiff")
+    return connection.post(
+        path="/result",
+        json={"process": {"process_graph": composicion.flat_graph()}},
+        expected_status=200,
+        stream=True,
+        timeout=TIMEOUT_SINCRONO,
+    )
+
+
+def descargar_mes(connection, bpin: str, bbox: dict, anio: str, mes: str,
+                  log: list, perfil: str = PERFIL_ALMACENAMIENTO) -> str:
+    ruta_tiff = ruta_local(bpin, anio, mes)
+
+    if os.path.exists(ruta_tiff):
+        log.append(f"SKIPPED | {bpin} | {anio}-{mes} | {ruta_tiff}")
+        return "ya_existe"
+
+    os.makedirs(os.path.dirname(ruta_tiff), exist_ok=True)
+
+    def descargar():
+        composicion = construir_composicion(connection, bbox, anio, mes, perfil)
+        composicion.download(ruta_tiff, format="GTiff")
+
+    return _descargar_con_reintentos(descargar, bpin, f"{anio}-{mes}", ruta_tiff, log)
+
+
+def etiqueta_meses(meses: list) -> str:
+    (a0, m0), (a1, m1) = min(meses), max(meses)
+    if len(meses) == 1:
+        return f"{a0}-{m0}"
+    return f"{a0}-{m0}..{a1}-{m1} ({len(meses)} months)"
+
+
+def ruta_multimes(bpin: str, meses: list) -> str:
+    (a0, m0), (a1, m1) = min(meses), max(meses)
+    return os.path.join(CARPETA_SALIDA, f"sentinel2_{bpin}", f"{a0}_{m0}-{a1}_{m1}.nc")
+
+
+def descargar_meses(connection, bpin: str, bbox: dict, meses: list,
+                    log: list, perfil: str = PERFIL_ALMACENAMIENTO) -> dict:
+    """
+    Downloads every month in `meses` with a single openEO request (see
+    construir_composicion_multimes) and splits the result locally into the
+    usual {anio}_{mes}.tiff files. Returns {(anio, mes): estado} with the
+    same states as descargar_mes.
+    """
+    estados   = {}
+    faltantes = []
+    for anio, mes in meses:
+        ruta_tiff = ruta_local(bpin, anio, mes)
+        if os.path.exists(ruta_tiff):
+            log.append(f"SKIPPED | {bpin} | {anio}-{mes} | {ruta_tiff}")
+            estados[(anio, mes)] = "ya_existe"
+        else:
+            faltantes.append((anio, mes))
+    if not faltantes:
+        return estados
+
+    ruta_nc = ruta_multimes(bpin, faltantes)
+    os.makedirs(os.path.dirname(ruta_nc), exist_ok=True)
+
+    def descargar():
+        compuesto = construir_composicion_multimes(connection, bbox, faltantes, perfil)
+        compuesto.download(ruta_nc, format="netCDF")
+
+    periodo = etiqueta_meses(faltantes)
+    estado  = _descargar_con_reintentos(descargar, bpin, periodo, ruta_nc, log)
+    if estado != "ok":
+        estados.update({anio_mes: estado for anio_mes in faltantes})
+        return estados
+
+    try:
+        estados.update(dividir_por_mes(ruta_nc, bpin, faltantes, log))
+    except Exception as e:
+        log.append(f"ERROR | {bpin} | {periodo} | could not split result: {str(e)[:100]}")
+        estados.update({anio_mes: "error" for anio_mes in faltantes})
+    finally:
+        if os.path.exists(ruta_nc):
+            os.remove(ruta_nc)
+    return estados
+
+
 def main():
     df = pd.read_csv(CSV_PATH, encoding="utf-8-sig", dtype=str)
     df.columns = [c.strip() for c in df.columns]
@@ -137,6 +326,7 @@ def main():
 
     connection = openeo.connect("openeo.dataspace.copernicus.eu")
     connection.authenticate_oidc(max_poll_time=120)
+    LIMITADOR_OPENEO.instalar_en_sesion(connection)
 
     log        = []
     contadores = {"ok": 0, "ya_existe": 0, "sin_datos": 0, "error": 0}
@@ -162,8 +352,6 @@ def main():
             for mes in meses:
                 resultado = descargar_mes(connection, bpin, bbox, anio, mes, log)
                 contadores[resultado] += 1
-                if resultado != "ya_existe":
-                    time.sleep(PAUSA_ENTRE_DESCARGAS)
 
     print("\n--- Summary ---")
     print(f"  [OK]      : {contadores['ok']}")
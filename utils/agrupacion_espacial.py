@@ -0,0 +1,124 @@
+"""
+agrupacion_espacial.py
+Groups nearby project bboxes so a single openEO request can cover several
+projects, and crops each project's window back out of the shared result.
+
+Used by pipeline.py when it is called with --cluster-km D.
+"""
+
+import os
+import numpy as np
+import rasterio
+from rasterio.errors import WindowError
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+MAX_LADO_KM = 30   # largest side allowed for the union extent of a cluster
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def _km_por_grado_lon(lat: float) -> float:
+    return 111 * np.cos(np.radians(lat))
+
+
+def area_km2(bbox: dict) -> float:
+    lat_media = (bbox["north"] + bbox["south"]) / 2
+    ancho = (bbox["east"] - bbox["west"]) * _km_por_grado_lon(lat_media)
+    alto  = (bbox["north"] - bbox["south"]) * 111
+    return float(ancho * alto)
+
+
+def union_bbox(bboxes: list) -> dict:
+    return {
+        "west":  min(b["west"] for b in bboxes),
+        "south": min(b["south"] for b in bboxes),
+        "east":  max(b["east"] for b in bboxes),
+        "north": max(b["north"] for b in bboxes),
+    }
+
+
+def distancia_km(a: dict, b: dict) -> float:
+    """Gap between two bboxes in km; 0 when they overlap or touch."""
+    lat_media = (a["north"] + a["south"] + b["north"] + b["south"]) / 4
+    dx = max(0.0, max(a["west"], b["west"]) - min(a["east"], b["east"]))
+    dy = max(0.0, max(a["south"], b["south"]) - min(a["north"], b["north"]))
+    return float(np.hypot(dx * _km_por_grado_lon(lat_media), dy * 111))
+
+
+def _lados_km(bbox: dict) -> tuple:
+    lat_media = (bbox["north"] + bbox["south"]) / 2
+    return ((bbox["east"] - bbox["west"]) * _km_por_grado_lon(lat_media),
+            (bbox["north"] - bbox["south"]) * 111)
+
+
+def agrupar_bboxes(items: list, umbral_km: float, max_lado_km: float = MAX_LADO_KM) -> list:
+    """
+    Greedy clustering of `items` ([(clave, bbox), ...]). An item joins the
+    first open cluster whose union extent is within `umbral_km` of it,
+    provided the grown union stays under `max_lado_km` per side, so chains
+    of neighbours cannot grow into one huge request.
+
+    Returns a list of clusters, each a list of claves.
+    """
+    umbral_grados = umbral_km / 111
+    ordenados     = sorted(items, key=lambda item: item[1]["west"])
+    abiertos      = []   # [{"bbox": union, "claves": [...]}, ...]
+    cerrados      = []
+
+    for clave, bbox in ordenados:
+        # Sorted by west edge: clusters ending further west than this item
+        # minus the threshold can never be joined again.
+        sigue_abierto = []
+        for grupo in abiertos:
+            if grupo["bbox"]["east"] + umbral_grados * 2 < bbox["west"]:
+                cerrados.append(grupo)
+            else:
+                sigue_abierto.append(grupo)
+        abiertos = sigue_abierto
+
+        for grupo in abiertos:
+            if distancia_km(grupo["bbox"], bbox) > umbral_km:
+                continue
+            union = union_bbox([grupo["bbox"], bbox])
+            if max(_lados_km(union)) > max_lado_km:
+                continue
+            grupo["bbox"] = union
+            grupo["claves"].append(clave)
+            break
+        else:
+            abiertos.append({"bbox": dict(bbox), "claves": [clave]})
+
+    return [grupo["claves"] for grupo in cerrados + abiertos]
+
+
+def recortar_bbox(ruta_origen: str, bbox: dict, ruta_destino: str) -> bool:
+    """
+    Writes the part of `ruta_origen` covered by `bbox` (EPSG:4326) to
+    `ruta_destino`, keeping the source CRS, resolution and dtype. Returns
+    False when the window does not intersect the source raster.
+    """
+    with rasterio.open(ruta_origen) as src:
+        limites = transform_bounds("EPSG:4326", src.crs, bbox["west"], bbox["south"],
+                                   bbox["east"], bbox["north"])
+        ventana = from_bounds(*limites, transform=src.transform)
+        try:
+            ventana = ventana.round_offsets().round_lengths().intersection(
+                Window(0, 0, src.width, src.height))
+        except WindowError:
+            return False
+        if ventana.width <= 0 or ventana.height <= 0:
+            return False
+
+        datos  = src.read(window=ventana)
+        perfil = src.profile.copy()
+        perfil.update(width=ventana.width, height=ventana.height,
+                      transform=src.window_transform(ventana))
+
+    os.makedirs(os.path.dirname(ruta_destino), exist_ok=True)
+    with rasterio.open(ruta_destino, "w", **perfil) as dst:
+        dst.write(datos)
+    return True
@@ -0,0 +1,171 @@
+"""
+bitacora.py
+Append-only journal of a pipeline run, so an interrupted run can resume.
+
+Every transition is one JSON line: run start and end, each openEO batch
+job submitted (with its job ID and task key), the outcome of each
+(bpin, month) and each blob confirmed in Azure. Lines are flushed and
+fsynced to a local file and mirrored to an Azure append blob as they
+happen. A runner that dies loses its disk, but the blob remains.
+
+On the next run, a journal without a "fin" line belongs to an interrupted
+run: trabajos_en_curso indexes its batch jobs, and lotes_openeo re-attaches
+to those still queued, running or finished that cover a task of the new
+plan instead of submitting them again. The manifest only receives uploads in batches, so the ones a dead
+runner had buffered are lost there; subidas_confirmadas extracts them
+from the journal to be merged back before the pending months are
+computed. A journal that ended normally is replaced by a fresh one.
+
+Used by pipeline.py.
+"""
+
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+from azure.core.exceptions import ResourceNotFoundError
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+RUTA_BITACORA = "pipeline_journal.jsonl"
+BLOB_BITACORA = "journal/pipeline_journal.jsonl"
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def _leer_lineas(texto: str) -> list:
+    eventos = []
+    for linea in texto.splitlines():
+        try:
+            eventos.append(json.loads(linea))
+        except ValueError:
+            break   # torn last line of a run that died mid-write
+    return eventos
+
+
+def trabajos_en_curso(eventos: list) -> dict:
+    """
+    Batch jobs submitted by an interrupted run, indexed by (perfil, bpin,
+    anio, mes) for every BPIN and month each one covers. Each job is
+    {"job_id", "perfil", "bbox", "meses", "bpins"}, as submitted (see
+    lotes_openeo.firma_trabajo).
+    """
+    indice = {}
+    for e in eventos:
+        if e.get("evento") != "trabajo" or "bbox" not in e:
+            continue
+        trabajo = {k: e[k] for k in ("job_id", "perfil", "bbox", "meses", "bpins")}
+        for bpin in trabajo["bpins"]:
+            for anio, mes in trabajo["meses"]:
+                indice.setdefault((trabajo["perfil"], bpin, anio, mes), []).append(trabajo)
+    return indice
+
+
+def subidas_confirmadas(eventos: list) -> list:
+    """"subida" events of an interrupted run: blobs already in Azure, maybe not in the manifest."""
+    return [e for e in eventos if e.get("evento") == "subida"]
+
+
+class Bitacora:
+    def __init__(self, ruta: str = RUTA_BITACORA, blob_client=None):
+        self.ruta        = ruta
+        self.blob_client = blob_client
+        self._lock       = threading.Lock()
+        self._archivo    = None
+        self._eventos    = None
+
+    def _previa(self) -> list:
+        """Events of the previous journal: the blob when there is one, else the local file."""
+        if self._eventos is None:
+            self._eventos = self._leer_previa()
+        return self._eventos
+
+    def _leer_previa(self) -> list:
+        if self.blob_client is not None:
+            try:
+                return _leer_lineas(self.blob_client.download_blob().readall().decode("utf-8"))
+            except ResourceNotFoundError:
+                pass
+            except Exception as e:
+                print(f"  [journal] could not read {self.blob_client.blob_name}: {e}")
+        if os.path.exists(self.ruta):
+            with open(self.ruta, encoding="utf-8") as f:
+                return _leer_lineas(f.read())
+        return []
+
+    def interrumpida(self) -> list:
+        """Events of the previous run if it did not end normally, else []."""
+        previa = self._previa()
+        return previa if previa and previa[-1].get("evento") != "fin" else []
+
+    def iniciar(self, reanudar: bool = True) -> list:
+        """
+        Opens the journal for this run. Returns the events of the previous
+        run when it was interrupted (no "fin" line) and `reanudar` is set;
+        this run then appends to the same journal. Otherwise the journal
+        starts over and [] is returned.
+        """
+        previa = self.interrumpida()
+        if previa and reanudar:
+            self._archivo = open(self.ruta, "a", encoding="utf-8")
+            if self.blob_client is not None and not self._blob_existe():
+                self._crear_blob()
+            self.anotar("reanudada", eventos_previos=len(previa))
+            return previa
+
+        self._archivo = open(self.ruta, "w", encoding="utf-8")
+        if self.blob_client is not None:
+            self._crear_blob()
+        self.anotar("inicio")
+        return []
+
+    def _blob_existe(self) -> bool:
+        try:
+            self.blob_client.get_blob_properties()
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    def _crear_blob(self) -> None:
+        try:
+            self.blob_client.create_append_blob()
+        except Exception as e:
+            print(f"  [journal] could not create {self.blob_client.blob_name}, "
+                  f"journaling locally only: {e}")
+            self.blob_client = None
+
+    def descartar(self, **datos) -> None:
+        """
+        For a run that ends before doing any work: an interrupted journal is
+        replaced by a closed one, so later runs neither replay nor resume it.
+        """
+        if self.interrumpida():
+            self.iniciar(reanudar=False)
+            self.cerrar(**datos)
+
+    def anotar(self, evento: str, **datos) -> None:
+        linea = json.dumps({"evento": evento,
+                            "t": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                            **datos}, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._archivo is None:
+                return
+            self._archivo.write(linea)
+            self._archivo.flush()
+            os.fsync(self._archivo.fileno())
+            if self.blob_client is not None:
+                try:
+                    self.blob_client.append_block(linea.encode("utf-8"))
+                except Exception as e:
+                    # The local line is there; losing the mirror must not stop the run.
+                    print(f"  [journal] could not append to {self.blob_client.blob_name}: {e}")
+
+    def cerrar(self, **datos) -> None:
+        """Marks the run as complete: the next run starts a new journal."""
+        self.anotar("fin", **datos)
+        with self._lock:
+            if self._archivo is not None:
+                self._archivo.close()
+                self._archivo = None
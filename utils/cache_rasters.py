@@ -0,0 +1,181 @@
+"""
+cache_rasters.py
+Bounded on-disk cache of the rasters the app downloads and renders.
+
+Entries are content-addressed: the file name is a hash of the key, and the
+app builds keys from the blob name and its ETag, so an overwritten blob
+gets a new entry and a stale one is never served. Files are written under
+a temporary name and renamed into place, so a reader (another session, or
+another process on the same instance) never sees a partial raster. When
+the folder goes over its size cap, the least recently used files are
+removed; a hit refreshes the file's mtime, which is what eviction sorts by.
+
+MemoLRU is the in-memory layer above it: a bounded map from a key to the
+result of preparing an image (path and state), so a rerun with unchanged
+inputs neither renders nor re-checks anything.
+
+Used by app.py.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+CARPETA_CACHE_RASTERS = os.getenv("RASTER_CACHE_DIR",
+                                  os.path.join(tempfile.gettempdir(), "satview_rasters"))
+LIMITE_CACHE_MB       = int(os.getenv("RASTER_CACHE_MB", "1024"))
+MAX_ENTRADAS_MEMO     = 256
+
+# ─────────────────────────────────────────────────────────────────
+
+
+class CacheRasters:
+    def __init__(self, carpeta: str = CARPETA_CACHE_RASTERS, limite_mb: int = LIMITE_CACHE_MB):
+        self.carpeta      = carpeta
+        self.limite_bytes = limite_mb * 1024 * 1024
+        os.makedirs(carpeta, exist_ok=True)
+
+        self._lock     = threading.Lock()
+        self._claves   = {}   # clave -> [lock, holders], so two sessions do not build the same entry
+        self._metricas = {"aciertos": 0, "fallos": 0, "escrituras": 0, "desalojos": 0}
+
+    def ruta(self, clave: str, sufijo: str = ".tif") -> str:
+        return os.path.join(self.carpeta, hashlib.sha1(clave.encode()).hexdigest() + sufijo)
+
+    def _sumar(self, clave: str, n: int = 1) -> None:
+        with self._lock:
+            self._metricas[clave] += n
+
+    @contextmanager
+    def _lock_clave(self, clave: str):
+        """
+        Per-key lock, dropped when its last holder or waiter is done, so the
+        map only holds the keys being built right now.
+        """
+        with self._lock:
+            entrada = self._claves.setdefault(clave, [threading.Lock(), 0])
+            entrada[1] += 1
+        try:
+            with entrada[0]:
+                yield
+        finally:
+            with self._lock:
+                entrada[1] -= 1
+                if entrada[1] == 0:
+                    del self._claves[clave]
+
+    def obtener(self, clave: str) -> str | None:
+        """Path of the cached file for `clave`, or None. Counts a hit or a miss."""
+        ruta = self.ruta(clave)
+        try:
+            os.utime(ruta)
+        except FileNotFoundError:
+            self._sumar("fallos")
+            return None
+        self._sumar("aciertos")
+        return ruta
+
+    def vigente(self, ruta: str) -> bool:
+        """True if `ruta` is still cached; marks it as recently used."""
+        try:
+            os.utime(ruta)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def obtener_o_crear(self, clave: str, crear) -> str | None:
+        """
+        Returns the cached file for `clave`, building it first with
+        `crear(ruta_temporal)` on a miss. `crear` writes the file at the
+        path it receives; if it raises or returns False nothing is cached
+        and None is returned.
+        """
+        ruta = self.obtener(clave)
+        if ruta is not None:
+            return ruta
+        with self._lock_clave(clave):
+            # Another session may have built it while this one waited.
+            if os.path.exists(self.ruta(clave)):
+                return self.ruta(clave)
+            ruta     = self.ruta(clave)
+            temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                if crear(temporal) is False or not os.path.exists(temporal):
+                    return None
+                os.replace(temporal, ruta)
+            finally:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+        self._sumar("escrituras")
+        self.desalojar(conservar=ruta)
+        return ruta
+
+    def desalojar(self, conservar: str | None = None) -> int:
+        """Removes least recently used files until the folder fits the cap. Returns the count."""
+        archivos = []
+        for entrada in os.scandir(self.carpeta):
+            if entrada.is_file() and not entrada.name.endswith(".tmp"):
+                estado = entrada.stat()
+                archivos.append((estado.st_mtime, estado.st_size, entrada.path))
+        total = sum(tamano for _, tamano, _ in archivos)
+
+        borrados = 0
+        for _, tamano, ruta in sorted(archivos):
+            if total <= self.limite_bytes:
+                break
+            if ruta == conservar:
+                continue
+            try:
+                os.remove(ruta)
+            except OSError:
+                continue
+            total    -= tamano
+            borrados += 1
+        if borrados:
+            self._sumar("desalojos", borrados)
+        return borrados
+
+    def metricas(self) -> dict:
+        with self._lock:
+            m = dict(self._metricas)
+        m["mb"] = sum(e.stat().st_size for e in os.scandir(self.carpeta)
+                      if e.is_file()) / 1e6
+        return m
+
+
+class MemoLRU:
+    def __init__(self, max_entradas: int = MAX_ENTRADAS_MEMO):
+        self.max_entradas = max_entradas
+        self._lock        = threading.Lock()
+        self._entradas    = OrderedDict()
+        self._metricas    = {"aciertos": 0, "fallos": 0}
+
+    def obtener(self, clave):
+        with self._lock:
+            if clave not in self._entradas:
+                self._metricas["fallos"] += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self._metricas["aciertos"] += 1
+            return self._entradas[clave]
+
+    def guardar(self, clave, valor) -> None:
+        with self._lock:
+            self._entradas[clave] = valor
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def descartar(self, clave) -> None:
+        with self._lock:
+            self._entradas.pop(clave, None)
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return {**self._metricas, "entradas": len(self._entradas)}
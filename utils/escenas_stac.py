@@ -0,0 +1,146 @@
+"""
+escenas_stac.py
+Pre-flight scene check against the Copernicus Data Space STAC catalogue.
+
+Before a month is sent to openEO, one STAC search per bbox covers the
+whole range of its pending months and returns the Sentinel-2 L2A scenes at
+or under MAX_NUBOSIDAD (the same filter load_collection applies). The
+cloud-cover limit goes to the server as a CQL2 filter, so only usable
+scenes are paged back. A month with none would come back as "sin_datos"
+after a full job, so it is dropped before any openEO request.
+
+A STAC search only reads catalogue metadata: it needs no authentication
+and does not count against the openEO quota. Searches for different bboxes
+run concurrently, and results are kept per (bbox, months) for the run, so
+projects sharing coordinates are looked up once.
+
+Used by pipeline.py.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from pystac_client import Client
+
+try:
+    from utils.Download_sat_imgs import MAX_NUBOSIDAD
+except ImportError:   # run as a script from inside utils/
+    from Download_sat_imgs import MAX_NUBOSIDAD
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+URL_STAC           = "https://stac.dataspace.copernicus.eu/v1"
+COLECCION_STAC     = "sentinel-2-l2a"
+ESCENAS_POR_PAGINA = 200
+WORKERS_STAC       = 8    # concurrent STAC searches
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def _clave_bbox(bbox: dict) -> tuple:
+    return bbox["west"], bbox["south"], bbox["east"], bbox["north"]
+
+
+def _rango_meses(meses: list) -> str:
+    """STAC datetime interval from the first day of the first month to the end of the last."""
+    anio, mes = min(meses)
+    inicio    = pd.Timestamp(f"{anio}-{mes}-01")
+    anio, mes = max(meses)
+    fin       = pd.Timestamp(f"{anio}-{mes}-01") + pd.offsets.MonthBegin(1)
+    return f"{inicio:%Y-%m-%d}T00:00:00Z/{fin - pd.Timedelta(seconds=1):%Y-%m-%dT%H:%M:%S}Z"
+
+
+def resumir_escenas(nubosidades: dict, meses: list, max_nubosidad: float = MAX_NUBOSIDAD) -> dict:
+    """
+    {(anio, mes): {"escenas", "nubosidad_min", "nubosidad_media"}} for the
+    months of `meses` with at least one scene at or under `max_nubosidad`,
+    from {(anio, mes): [cloud cover, ...]}.
+    """
+    resumen = {}
+    for anio_mes in meses:
+        utiles = [n for n in nubosidades.get(anio_mes, []) if n <= max_nubosidad]
+        if utiles:
+            resumen[anio_mes] = {"escenas":         len(utiles),
+                                 "nubosidad_min":   min(utiles),
+                                 "nubosidad_media": sum(utiles) / len(utiles)}
+    return resumen
+
+
+class VerificadorEscenas:
+    """
+    Runs the STAC searches of one pipeline run. Thread-safe; each worker
+    thread opens its own catalogue client.
+    """
+
+    def __init__(self, url: str = URL_STAC, coleccion: str = COLECCION_STAC,
+                 max_nubosidad: float = MAX_NUBOSIDAD):
+        self.url           = url
+        self.coleccion     = coleccion
+        self.max_nubosidad = max_nubosidad
+
+        self._local    = threading.local()
+        self._lock     = threading.Lock()
+        self._cache    = {}   # (bbox, months) -> resumir_escenas result, or None on failure
+        self._metricas = {"busquedas": 0, "escenas": 0, "fallos": 0, "aciertos_cache": 0}
+
+    def _cliente(self) -> Client:
+        if getattr(self._local, "cliente", None) is None:
+            self._local.cliente = Client.open(self.url)
+        return self._local.cliente
+
+    def _buscar(self, bbox: dict, meses: tuple) -> dict | None:
+        try:
+            busqueda = self._cliente().search(
+                collections=[self.coleccion],
+                bbox=list(_clave_bbox(bbox)),
+                datetime=_rango_meses(meses),
+                filter={"op": "<=", "args": [{"property": "eo:cloud_cover"}, self.max_nubosidad]},
+                filter_lang="cql2-json",
+                limit=ESCENAS_POR_PAGINA,
+            )
+            nubosidades = {}
+            n_escenas   = 0
+            for escena in busqueda.items_as_dicts():
+                propiedades = escena.get("properties", {})
+                nubosidad   = propiedades.get("eo:cloud_cover")
+                fecha       = propiedades.get("datetime") or propiedades.get("start_datetime")
+                if nubosidad is None or not fecha:
+                    continue
+                nubosidades.setdefault((fecha[:4], fecha[5:7]), []).append(float(nubosidad))
+                n_escenas += 1
+        except Exception as e:
+            print(f"  [stac] search failed for {_clave_bbox(bbox)}: {str(e)[:120]}")
+            with self._lock:
+                self._metricas["fallos"] += 1
+            return None
+        with self._lock:
+            self._metricas["busquedas"] += 1
+            self._metricas["escenas"]   += n_escenas
+        return resumir_escenas(nubosidades, list(meses), self.max_nubosidad)
+
+    def verificar(self, consultas: list, workers: int = WORKERS_STAC) -> list:
+        """
+        `consultas` is a list of (bbox, [(anio, mes), ...]). Returns, in the
+        same order, the resumir_escenas result of each one, or None when its
+        search failed and every month should be tried as usual.
+        """
+        claves = [(_clave_bbox(bbox), tuple(sorted(meses))) for bbox, meses in consultas]
+        bboxes = {_clave_bbox(bbox): bbox for bbox, _ in consultas}
+        with self._lock:
+            nuevas = sorted({c for c in claves if c not in self._cache})
+            self._metricas["aciertos_cache"] += len(claves) - len(nuevas)
+
+        if nuevas:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(nuevas)))) as pool:
+                resultados = list(pool.map(lambda c: self._buscar(bboxes[c[0]], c[1]), nuevas))
+            with self._lock:
+                self._cache.update(zip(nuevas, resultados))
+
+        with self._lock:
+            return [self._cache[c] for c in claves]
+
+    def metricas(self) -> dict:
+        with self._lock:
+            return dict(self._metricas)
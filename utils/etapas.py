@@ -0,0 +1,122 @@
+"""
+etapas.py
+Minimal producer/consumer pipeline built on threads and bounded queues.
+
+Each Etapa owns a bounded input queue and its own pool of worker threads.
+A worker takes an item, runs the stage function on it and hands every
+returned item to the next stage. When the next stage's queue is full the
+worker blocks, so a slow stage applies back-pressure upstream instead of
+letting work pile up in memory.
+
+Used by pipeline.py to overlap Copernicus downloads, local processing and
+Azure uploads.
+"""
+
+import queue
+import threading
+import time
+
+
+_FIN = object()   # sentinel that tells one worker to exit
+
+
+class Etapa:
+    def __init__(self, nombre: str, funcion, workers: int = 1,
+                 capacidad: int = 4, siguiente: "Etapa | None" = None):
+        """
+        `funcion(item)` returns an iterable of items for `siguiente`, or
+        None. Exceptions are logged through `on_error` and counted; they
+        never kill the worker.
+        """
+        self.nombre    = nombre
+        self.funcion   = funcion
+        self.workers   = max(1, workers)
+        self.siguiente = siguiente
+        self.on_error  = lambda item, e: print(f"  [{nombre}] error: {e}")
+
+        self._cola     = queue.Queue(maxsize=max(1, capacidad))
+        self._hilos    = []
+        self._lock     = threading.Lock()
+        self._metricas = {"procesados": 0, "errores": 0, "profundidad_max": 0,
+                          "suma_profundidad": 0, "muestras": 0,
+                          "ocupado_s": 0.0, "inactivo_s": 0.0, "bloqueado_s": 0.0}
+
+    def iniciar(self) -> "Etapa":
+        for n in range(self.workers):
+            hilo = threading.Thread(target=self._trabajar, name=f"{self.nombre}-{n}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+        if self.siguiente is not None:
+            self.siguiente.iniciar()
+        return self
+
+    def poner(self, item) -> None:
+        self._cola.put(item)
+        profundidad = self._cola.qsize()
+        with self._lock:
+            m = self._metricas
+            m["profundidad_max"]  = max(m["profundidad_max"], profundidad)
+            m["suma_profundidad"] += profundidad
+            m["muestras"]        += 1
+
+    def cerrar(self) -> None:
+        """Waits for every queued item to be processed, then closes downstream."""
+        for _ in self._hilos:
+            self._cola.put(_FIN)
+        for hilo in self._hilos:
+            hilo.join()
+        if self.siguiente is not None:
+            self.siguiente.cerrar()
+
+    def _sumar(self, clave: str, valor) -> None:
+        with self._lock:
+            self._metricas[clave] += valor
+
+    def _trabajar(self) -> None:
+        while True:
+            espera = time.perf_counter()
+            item   = self._cola.get()
+            self._sumar("inactivo_s", time.perf_counter() - espera)
+            if item is _FIN:
+                return
+
+            inicio = time.perf_counter()
+            try:
+                salidas = self.funcion(item) or ()
+            except Exception as e:
+                self._sumar("errores", 1)
+                self.on_error(item, e)
+                salidas = ()
+            self._sumar("ocupado_s", time.perf_counter() - inicio)
+            self._sumar("procesados", 1)
+
+            if self.siguiente is not None:
+                for salida in salidas:
+                    espera = time.perf_counter()
+                    self.siguiente.poner(salida)
+                    self._sumar("bloqueado_s", time.perf_counter() - espera)
+
+    def metricas(self) -> dict:
+        with self._lock:
+            m = dict(self._metricas)
+        muestras = m.pop("muestras")
+        suma     = m.pop("suma_profundidad")
+        m["profundidad_media"] = suma / muestras if muestras else 0.0
+        m["workers"] = self.workers
+        return m
+
+
+def encadenar(*etapas: Etapa) -> Etapa:
+    """Links the stages in order and returns the first one."""
+    for actual, siguiente in zip(etapas, etapas[1:]):
+        actual.siguiente = siguiente
+    return etapas[0]
+
+
+def resumen_etapas(primera: Etapa) -> list:
+    filas = []
+    etapa = primera
+    while etapa is not None:
+        filas.append({"etapa": etapa.nombre, **etapa.metricas()})
+        etapa = etapa.siguiente
+    return filas
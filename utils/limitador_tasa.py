@@ -0,0 +1,153 @@
+"""
+limitador_tasa.py
+Adaptive request limiter shared by every thread that talks to openEO.
+
+Token bucket whose refill rate follows AIMD: each successful request adds
+INCREMENTO_TASA requests/s to the rate, each HTTP 429 multiplies it by
+FACTOR_REDUCCION and pauses every caller for the server's Retry-After (or
+PAUSA_429_DEFECTO when the response has none). The limiter therefore
+replaces both the fixed pause between downloads and the per-call backoff.
+
+The Retry-After header is read straight from the HTTP response through a
+hook on the openEO session (see instalar_en_sesion), since openEO
+exceptions do not carry response headers.
+
+Used by utils/Download_sat_imgs.py, utils/lotes_openeo.py and pipeline.py.
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+TASA_INICIAL      = 0.2    # requests/s at start (one every 5 s)
+TASA_MIN          = 1 / 60
+TASA_MAX          = 2.0
+INCREMENTO_TASA   = 0.05   # additive increase per successful request
+FACTOR_REDUCCION  = 0.5    # multiplicative decrease per throttle event
+RAFAGA            = 2      # bucket capacity: requests allowed back to back
+PAUSA_429_DEFECTO = 10     # seconds to pause on a 429 without Retry-After
+PAUSA_429_MAX     = 300    # cap on a single Retry-After pause
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def segundos_retry_after(valor: str | None) -> float | None:
+    """Parses a Retry-After header (delta-seconds or HTTP date)."""
+    if not valor:
+        return None
+    valor = valor.strip()
+    if valor.isdigit():
+        return float(valor)
+    try:
+        fecha = parsedate_to_datetime(valor)
+    except (TypeError, ValueError):
+        return None
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return max(0.0, (fecha - datetime.now(timezone.utc)).total_seconds())
+
+
+def es_limite_tasa(error: Exception) -> bool:
+    return getattr(error, "http_status_code", None) == 429 or "429" in str(error)
+
+
+class LimitadorTasa:
+    def __init__(self, tasa: float = TASA_INICIAL, tasa_min: float = TASA_MIN,
+                 tasa_max: float = TASA_MAX, rafaga: int = RAFAGA):
+        self.tasa      = tasa
+        self.tasa_min  = tasa_min
+        self.tasa_max  = tasa_max
+        self.rafaga    = rafaga
+
+        self._lock        = threading.Lock()
+        self._tokens      = 1.0
+        self._ultimo      = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._metricas    = {"solicitudes": 0, "esperas": 0, "espera_s": 0.0,
+                             "exitos": 0, "eventos_429": 0, "retry_after_max_s": 0.0,
+                             "tasa_min_alcanzada": tasa}
+
+    def _recargar(self, ahora: float) -> None:
+        self._tokens = min(self.rafaga, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    def adquirir(self) -> float:
+        """Blocks until a request may be sent. Returns the seconds waited."""
+        inicio  = time.monotonic()
+        esperas = 0
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._recargar(ahora)
+                if ahora < self._pausa_hasta:
+                    espera = self._pausa_hasta - ahora
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    esperado = ahora - inicio if esperas else 0.0
+                    m = self._metricas
+                    m["solicitudes"] += 1
+                    if esperas:
+                        m["esperas"]  += 1
+                        m["espera_s"] += esperado
+                    return esperado
+                else:
+                    espera = (1 - self._tokens) / self.tasa
+            esperas += 1
+            time.sleep(espera)
+
+    def exito(self) -> None:
+        with self._lock:
+            self.tasa = min(self.tasa_max, self.tasa + INCREMENTO_TASA)
+            self._metricas["exitos"] += 1
+
+    def limitado(self, retry_after: float | None = None) -> float:
+        """
+        Registers a throttle event and returns the seconds every caller will
+        now wait. A report that arrives while a pause is still running is
+        the same event seen twice (session hook, then the caller's exception
+        handler): the rate is not cut again, and only an explicit
+        Retry-After can extend the pause.
+        """
+        pausa = min(PAUSA_429_MAX, retry_after if retry_after is not None else PAUSA_429_DEFECTO)
+        with self._lock:
+            ahora = time.monotonic()
+            m = self._metricas
+            if ahora >= self._pausa_hasta:
+                self._recargar(ahora)
+                self.tasa    = max(self.tasa_min, self.tasa * FACTOR_REDUCCION)
+                self._tokens = 0.0
+                m["eventos_429"] += 1
+                m["tasa_min_alcanzada"] = min(m["tasa_min_alcanzada"], self.tasa)
+                self._pausa_hasta = ahora + pausa
+            elif retry_after is not None:
+                self._pausa_hasta = max(self._pausa_hasta, ahora + pausa)
+            if retry_after is not None:
+                m["retry_after_max_s"] = max(m["retry_after_max_s"], retry_after)
+            return self._pausa_hasta - ahora
+
+    def instalar_en_sesion(self, connection) -> None:
+        """Registers throttled responses of `connection` with this limiter."""
+        def al_responder(respuesta, *args, **kwargs):
+            if respuesta.status_code == 429:
+                self.limitado(segundos_retry_after(respuesta.headers.get("Retry-After")))
+            return respuesta
+
+        hooks = connection.session.hooks.setdefault("response", [])
+        if any(getattr(hook, "limitador", None) is self for hook in hooks):
+            return
+        al_responder.limitador = self
+        hooks.append(al_responder)
+
+    def metricas(self) -> dict:
+        with self._lock:
+            self._recargar(time.monotonic())
+            return {**self._metricas, "tasa_actual": round(self.tasa, 4),
+                    "tokens": round(self._tokens, 2)}
+
+
+# Single instance shared by every openEO caller of the process.
+LIMITADOR_OPENEO = LimitadorTasa()
@@ -0,0 +1,346 @@
+"""
+lotes_openeo.py
+Runs monthly Sentinel-2 composites as openEO batch jobs instead of
+synchronous downloads. Up to `max_jobs` jobs are kept in flight, their
+status is polled together, and each result is downloaded as soon as its
+job finishes.
+
+A task covers either one month ({"bpin", "bbox", "anio", "mes"}) or
+several months of the same project ({"bpin", "bbox", "meses"}); the latter
+is sent as a single multi-month graph and split locally on download.
+
+Jobs submitted by an interrupted run can be passed back in `reanudar`
+(see trabajos_en_curso in utils/bitacora.py). The next run plans only what
+is still missing, so its tasks rarely match the old requests exactly: a
+task re-attaches to any journaled job, still queued, running or finished,
+with the same storage profile, months covering the task's and a bbox
+containing the task's. The result is split for the task's months and
+cropped to its bbox instead of being requested again.
+
+Used by pipeline.py when it is called with --max-jobs N.
+"""
+
+import os
+import time
+from collections import deque
+
+from utils.Download_sat_imgs import (
+    PERFIL_ALMACENAMIENTO,
+    construir_composicion,
+    construir_composicion_multimes,
+    dividir_por_mes,
+    es_sin_datos,
+    etiqueta_meses,
+    ruta_local,
+    ruta_multimes,
+)
+from utils.agrupacion_espacial import recortar_bbox
+from utils.limitador_tasa import LIMITADOR_OPENEO, es_limite_tasa
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+INTERVALO_SONDEO   = 20   # seconds between status polls of the in-flight jobs
+MAX_ERRORES_SONDEO = 5    # consecutive failed status polls before giving up on a job
+
+ESTADOS_ERROR = ("error", "canceled")
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def meses_tarea(tarea: dict) -> list:
+    return tarea["meses"] if "meses" in tarea else [(tarea["anio"], tarea["mes"])]
+
+
+def tarea_por_mes(tarea: dict, anio: str, mes: str) -> dict:
+    """Single-month view of `tarea`, keeping any extra keys it carries."""
+    por_mes = {k: v for k, v in tarea.items() if k != "meses"}
+    por_mes.update(anio=anio, mes=mes)
+    return por_mes
+
+
+def bpins_tarea(tarea: dict) -> list:
+    """BPINs a task delivers to: those of its member sites, or its own."""
+    if "miembros" not in tarea:
+        return [tarea["bpin"]]
+    return [d["bpin"] for sitio in tarea["miembros"] for d in sitio["destinos"]]
+
+
+def firma_trabajo(tarea: dict) -> dict:
+    """What the journal keeps about a submitted task to re-attach to its job later."""
+    return {"perfil": tarea.get("perfil", PERFIL_ALMACENAMIENTO), "bbox": tarea["bbox"],
+            "meses": [list(m) for m in meses_tarea(tarea)], "bpins": bpins_tarea(tarea)}
+
+
+def _contiene(exterior: dict, interior: dict) -> bool:
+    return (exterior["west"] <= interior["west"] and exterior["south"] <= interior["south"]
+            and exterior["east"] >= interior["east"] and exterior["north"] >= interior["north"])
+
+
+def trabajos_para(reanudar: dict | None, tarea: dict) -> list:
+    """
+    Journaled jobs (see trabajos_en_curso) that can deliver `tarea`: same
+    storage profile, its months among theirs and its bbox inside theirs.
+    The tightest come first, as their results need the least cropping.
+    """
+    if not reanudar:
+        return []
+    perfil     = tarea.get("perfil", PERFIL_ALMACENAMIENTO)
+    meses      = meses_tarea(tarea)
+    candidatos = {t["job_id"]: t for bpin in bpins_tarea(tarea)
+                   for t in reanudar.get((perfil, bpin, *meses[0]), [])}
+    utiles = [t for t in candidatos.values()
+              if set(meses) <= {tuple(m) for m in t["meses"]} and _contiene(t["bbox"], tarea["bbox"])]
+    return sorted(utiles, key=lambda t: (len(t["meses"]),
+                                         (t["bbox"]["east"] - t["bbox"]["west"])
+                                         * (t["bbox"]["north"] - t["bbox"]["south"])))
+
+
+def borrar_trabajos(jobs: list) -> None:
+    """Deletes finished jobs from the backend once their results are safe in Azure."""
+    for job in jobs:
+        try:
+            job.delete()
+        except Exception:
+            pass
+
+
+def reenganchar_trabajo(connection, job_id: str | None):
+    """The job `job_id` if it can still deliver a result, else None."""
+    if not job_id:
+        return None
+    LIMITADOR_OPENEO.adquirir()
+    try:
+        job    = connection.job(job_id)
+        estado = job.status()
+        LIMITADOR_OPENEO.exito()
+        if estado in ESTADOS_ERROR:
+            return None
+        if estado == "created":
+            job.start()
+        return job
+    except Exception as e:
+        if es_limite_tasa(e):
+            LIMITADOR_OPENEO.limitado()
+        return None
+
+
+def enviar_trabajo(connection, tarea: dict):
+    meses  = meses_tarea(tarea)
+    perfil = tarea.get("perfil", PERFIL_ALMACENAMIENTO)
+    if len(meses) == 1:
+        cubo    = construir_composicion(connection, tarea["bbox"], *meses[0], perfil)
+        formato = "GTiff"
+    else:
+        cubo    = construir_composicion_multimes(connection, tarea["bbox"], meses, perfil)
+        formato = "netCDF"
+    job = cubo.create_job(
+        out_format=formato,
+        title=f"satview {tarea['bpin']} {etiqueta_meses(meses)}",
+    )
+    job.start()
+    return job
+
+
+def _recortar_a_tarea(tarea: dict, estados: dict, bbox_job: dict | None) -> dict:
+    """Crops each delivered month to the task's bbox when the job covered a larger one."""
+    if bbox_job is None or bbox_job == tarea["bbox"]:
+        return estados
+    for (anio, mes), estado in estados.items():
+        if estado != "ok":
+            continue
+        ruta    = ruta_local(tarea["bpin"], anio, mes)
+        recorte = ruta + ".recorte.tif"
+        if recortar_bbox(ruta, tarea["bbox"], recorte):
+            os.replace(recorte, ruta)
+        else:
+            os.remove(ruta)
+            estados[(anio, mes)] = "error"
+    return estados
+
+
+def _descargar_resultado(job, tarea: dict, log: list, meses_job: list | None = None,
+                         bbox_job: dict | None = None) -> dict:
+    """
+    Downloads a finished job and returns {(anio, mes): estado} for the
+    months of `tarea`. `meses_job` and `bbox_job` are what the job was
+    submitted with, when a re-attached job covers more than the task needs.
+    """
+    bpin, meses = tarea["bpin"], meses_tarea(tarea)
+    meses_job   = meses_job or meses
+    if len(meses_job) == 1:
+        anio, mes = meses[0]
+        ruta = ruta_local(bpin, anio, mes)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        job.get_results().download_file(ruta)
+        log.append(f"OK | {bpin} | {anio}-{mes} | {ruta} | job {job.job_id}")
+        return _recortar_a_tarea(tarea, {(anio, mes): "ok"}, bbox_job)
+
+    ruta_nc = ruta_multimes(bpin, meses_job)
+    os.makedirs(os.path.dirname(ruta_nc), exist_ok=True)
+    try:
+        job.get_results().download_file(ruta_nc)
+        return _recortar_a_tarea(tarea, dividir_por_mes(ruta_nc, bpin, meses, log), bbox_job)
+    finally:
+        if os.path.exists(ruta_nc):
+            os.remove(ruta_nc)
+
+
+def _mensaje_error(job) -> str:
+    try:
+        return " / ".join(str(entry.get("message", "")) for entry in job.logs(level="error"))
+    except Exception as e:
+        return f"could not read job logs: {e}"
+
+
+def ejecutar_lotes(connection, tareas: list, max_jobs: int, al_terminar, log: list,
+                   reanudar: dict | None = None, al_enviar=None, puede_enviar=None,
+                   terminados: list | None = None) -> list:
+    """
+    Runs every task in `tareas` as a batch job, with at most `max_jobs`
+    submitted at the same time.
+
+    `al_terminar(tarea, estado)` is called exactly once per month, from this
+    thread, with a single-month task dict and "ok", "ya_existe", "sin_datos"
+    or "error". On "ok" and "ya_existe" the GeoTIFF is at
+    ruta_local(bpin, anio, mes). The job is deleted from the backend once
+    the callbacks for all of its months have returned; with a `terminados`
+    list it is appended there instead, for the caller to delete with
+    borrar_trabajos when the results are uploaded, so a run that dies in
+    between can still re-attach to it.
+
+    A task re-attaches to a job of `reanudar` that trabajos_para finds
+    for it and that is still usable; several tasks may share one job. The
+    month dicts of such a task carry "reanudado": True, as their latency
+    started in an earlier run. `al_enviar(tarea, job)` is called after
+    each new submission.
+
+    When `puede_enviar(tarea)` returns False, nothing more is submitted:
+    the jobs in flight are finished and the tasks not started are returned
+    (the first one possibly reduced to its months without a local file).
+    """
+    cola      = deque(tareas)
+    en_vuelo  = {}   # n -> {"job", "tarea", "meses_job", "bbox_job", "inicio", "errores_sondeo"}
+    aplazadas = []
+    enviados  = 0
+
+    while cola or en_vuelo:
+        while cola and len(en_vuelo) < max_jobs:
+            tarea = cola.popleft()
+
+            faltantes = []
+            for anio, mes in meses_tarea(tarea):
+                ruta = ruta_local(tarea["bpin"], anio, mes)
+                if os.path.exists(ruta):
+                    log.append(f"SKIPPED | {tarea['bpin']} | {anio}-{mes} | {ruta}")
+                    al_terminar(tarea_por_mes(tarea, anio, mes), "ya_existe")
+                else:
+                    faltantes.append((anio, mes))
+            if not faltantes:
+                continue
+            if len(faltantes) == 1:
+                tarea = tarea_por_mes(tarea, *faltantes[0])
+            else:
+                tarea = {**tarea, "meses": faltantes}
+            etiqueta = f"{tarea['bpin']} | {etiqueta_meses(faltantes)}"
+
+            if puede_enviar is not None and not puede_enviar(tarea):
+                aplazadas.append(tarea)
+                aplazadas.extend(cola)
+                cola.clear()
+                print(f"  {etiqueta} -> [DEFERRED] {len(aplazadas)} task(s) left for the next run")
+                break
+
+            job, meses_job, bbox_job = None, faltantes, None
+            for previo in trabajos_para(reanudar, tarea):
+                job = reenganchar_trabajo(connection, previo["job_id"])
+                if job is not None:
+                    meses_job = [tuple(m) for m in previo["meses"]]
+                    bbox_job  = previo["bbox"]
+                    break
+            if job is not None:
+                tarea = {**tarea, "reanudado": True}
+                print(f"  {etiqueta} -> re-attached to job {job.job_id}")
+                log.append(f"RESUMED | {etiqueta} | job {job.job_id}")
+            else:
+                LIMITADOR_OPENEO.adquirir()
+                try:
+                    job = enviar_trabajo(connection, tarea)
+                    LIMITADOR_OPENEO.exito()
+                except Exception as e:
+                    msg = str(e)
+                    if es_limite_tasa(e):
+                        pausa = LIMITADOR_OPENEO.limitado()
+                        print(f"  {etiqueta} -> [RATE LIMITED] submission, waiting {pausa:.0f}s")
+                        cola.appendleft(tarea)
+                        break
+                    print(f"  {etiqueta} -> [SUBMIT ERROR] {msg[:100]}")
+                    log.append(f"ERROR | {etiqueta} | {msg[:120]}")
+                    for anio, mes in faltantes:
+                        al_terminar(tarea_por_mes(tarea, anio, mes), "error")
+                    continue
+
+                print(f"  {etiqueta} -> submitted job {job.job_id}")
+                if al_enviar is not None:
+                    al_enviar(tarea, job)
+            en_vuelo[enviados] = {"job": job, "tarea": tarea, "meses_job": meses_job,
+                                  "bbox_job": bbox_job, "inicio": time.monotonic(),
+                                  "errores_sondeo": 0}
+            enviados += 1
+
+        if not en_vuelo:
+            continue
+
+        time.sleep(INTERVALO_SONDEO)
+
+        for n, entrada in list(en_vuelo.items()):
+            job, tarea = entrada["job"], entrada["tarea"]
+            job_id   = job.job_id
+            meses    = meses_tarea(tarea)
+            etiqueta = f"{tarea['bpin']} | {etiqueta_meses(meses)}"
+
+            try:
+                estado_job = job.status()
+                entrada["errores_sondeo"] = 0
+            except Exception as e:
+                entrada["errores_sondeo"] += 1
+                if entrada["errores_sondeo"] < MAX_ERRORES_SONDEO:
+                    continue
+                estado_job = "error"
+                log.append(f"ERROR | {etiqueta} | status polling failed: {str(e)[:100]}")
+
+            if estado_job == "finished":
+                duracion = time.monotonic() - entrada["inicio"]
+                try:
+                    estados = _descargar_resultado(job, tarea, log, entrada["meses_job"],
+                                                   entrada["bbox_job"])
+                    print(f"  {etiqueta} -> [OK] job {job_id} in {duracion:.0f}s")
+                except Exception as e:
+                    print(f"  {etiqueta} -> [DOWNLOAD ERROR] {str(e)[:100]}")
+                    log.append(f"ERROR | {etiqueta} | result download failed: {str(e)[:100]}")
+                    estados = {anio_mes: "error" for anio_mes in meses}
+
+            elif estado_job in ESTADOS_ERROR:
+                msg = _mensaje_error(job)
+                if es_sin_datos(msg):
+                    print(f"  {etiqueta} -> [NO DATA] job {job_id}")
+                    log.append(f"NO_DATA | {etiqueta} | {msg[:120]}")
+                    estado = "sin_datos"
+                else:
+                    print(f"  {etiqueta} -> [JOB {estado_job.upper()}] {msg[:100]}")
+                    log.append(f"ERROR | {etiqueta} | job {job_id} {estado_job}: {msg[:100]}")
+                    estado = "error"
+                estados = {anio_mes: estado for anio_mes in meses}
+
+            else:
+                continue
+
+            del en_vuelo[n]
+            for (anio, mes), estado in estados.items():
+                al_terminar(tarea_por_mes(tarea, anio, mes), estado)
+            if terminados is not None:
+                terminados.append(job)
+            elif all(e["job"].job_id != job_id for e in en_vuelo.values()):
+                borrar_trabajos([job])
+
+    return aplazadas
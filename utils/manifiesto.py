@@ -0,0 +1,328 @@
+"""
+manifiesto.py
+Container-level manifest of the satellite images in Azure Blob Storage.
+
+A single gzip-compressed JSON blob (BLOB_MANIFIESTO) holds one entry per
+image, keyed "{bpin}/{anio}_{mes}":
+
+    {"bpin", "anio", "mes", "blob", "bytes", "etag", "estado", "actualizado",
+     "estadisticas": {...} | None, "derivados": {modo: etag}}
+
+The pipeline records every upload and server-side copy in it, and the app
+and calcular_pendientes read this one object instead of listing prefixes.
+
+Months for which Copernicus returned no data (every scene over the cloud
+limit or masked) are recorded too, with estado "sin_datos" and the time
+of the last check ("verificado", "intentos"). calcular_pendientes skips
+them until TTL_SIN_DATOS_DIAS have passed, instead of sending the same
+empty job every run. A check made before the month ended is not trusted,
+since scenes may still arrive.
+Writes use optimistic concurrency: the manifest is read with its ETag, the
+pending changes are applied to that copy and it is uploaded with If-Match
+(If-None-Match: * when it does not exist yet). When another writer got in
+first, the upload fails with a precondition error and the cycle starts
+again from the fresh copy, so concurrent runs never lose each other's
+entries.
+
+Listing stays as the consistency-repair fallback: construir_manifiesto
+rebuilds the whole manifest from a container listing with blob metadata
+(pipeline.py --repair-manifest, or automatically when there is none).
+
+Used by pipeline.py and app.py.
+"""
+
+import calendar
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError, ResourceModifiedError, ResourceNotFoundError, ResourceNotModifiedError,
+)
+
+try:
+    from utils.visualizacion import MODOS, PREFIJO_DERIVADOS, estadisticas_desde_metadata
+except ImportError:   # run as a script from inside utils/
+    from visualizacion import MODOS, PREFIJO_DERIVADOS, estadisticas_desde_metadata
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+BLOB_MANIFIESTO         = "manifest.json.gz"
+PREFIJO_IMAGENES        = "sentinel2_"
+VERSION_MANIFIESTO      = 1
+INTENTOS_ESCRITURA      = 8    # optimistic-concurrency retries before giving up
+REGISTROS_POR_ESCRITURA = 25   # buffered records that trigger a write during a run
+TTL_SIN_DATOS_DIAS      = int(os.getenv("NO_DATA_TTL_DAYS", "30"))   # re-check no-data months after
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def manifiesto_vacio() -> dict:
+    return {"version": VERSION_MANIFIESTO, "actualizado": None, "imagenes": {}}
+
+
+def clave_imagen(bpin: str, anio: str, mes: str) -> str:
+    return f"{bpin}/{anio}_{mes}"
+
+
+def parsear_blob(nombre: str) -> tuple | None:
+    """
+    (bpin, anio, mes, modo) for an image blob ('sentinel2_{bpin}/{anio}_{mes}.tiff',
+    modo None) or a display derivative ('derivados/sentinel2_{bpin}/{anio}_{mes}_{modo}.tif').
+    None for any other name.
+    """
+    modo = None
+    if nombre.startswith(PREFIJO_DERIVADOS):
+        nombre = nombre[len(PREFIJO_DERIVADOS):]
+        base, _, modo = nombre.rsplit(".", 1)[0].rpartition("_")
+        if modo not in MODOS:
+            return None
+        nombre = base
+    carpeta, _, archivo = nombre.rpartition("/")
+    if not carpeta.startswith(PREFIJO_IMAGENES):
+        return None
+    partes = archivo.rsplit(".", 1)[0].split("_")
+    if len(partes) != 2 or not all(p.isdigit() for p in partes):
+        return None
+    return carpeta[len(PREFIJO_IMAGENES):], partes[0], partes[1], modo
+
+
+def _ahora() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def aplicar_registro(manifiesto: dict, nombre: str, tamano: int, etag: str,
+                     metadata: dict | None = None, actualizado: str | None = None) -> bool:
+    """
+    Records one image or derivative blob in `manifiesto` (in place). A
+    derivative only sets its mode's ETag; an image keeps the derivatives
+    already recorded. Returns False for names that are neither.
+    """
+    parsed = parsear_blob(nombre)
+    if parsed is None:
+        return False
+    bpin, anio, mes, modo = parsed
+    entrada = manifiesto["imagenes"].setdefault(clave_imagen(bpin, anio, mes), {
+        "bpin": bpin, "anio": anio, "mes": mes, "blob": None, "bytes": None,
+        "etag": None, "estado": None, "actualizado": None,
+        "estadisticas": None, "derivados": {},
+    })
+    if modo is not None:
+        entrada.setdefault("derivados", {})[modo] = etag
+        return True
+    entrada.update({
+        "blob": nombre, "bytes": tamano, "etag": etag, "estado": "ok",
+        "actualizado": actualizado or _ahora(),
+        "estadisticas": estadisticas_desde_metadata(metadata),
+    })
+    return True
+
+
+def aplicar_sin_datos(manifiesto: dict, bpin: str, anio: str, mes: str,
+                      verificado: str | None = None) -> None:
+    """
+    Records that Copernicus had no data for (bpin, anio, mes). An image
+    uploaded in the meantime wins: its entry is left untouched.
+    """
+    entrada = manifiesto["imagenes"].setdefault(clave_imagen(bpin, anio, mes), {
+        "bpin": bpin, "anio": anio, "mes": mes, "intentos": 0,
+    })
+    if entrada.get("estado") == "ok":
+        return
+    entrada.update({
+        "estado": "sin_datos", "verificado": verificado or _ahora(),
+        "intentos": entrada.get("intentos", 0) + 1,
+    })
+
+
+def _fin_de_mes(anio: str, mes: str) -> datetime:
+    ultimo = calendar.monthrange(int(anio), int(mes))[1]
+    return datetime(int(anio), int(mes), ultimo, tzinfo=timezone.utc) + timedelta(days=1)
+
+
+def meses_sin_datos(manifiesto: dict, ttl_dias: int = TTL_SIN_DATOS_DIAS,
+                    ahora: datetime | None = None) -> dict:
+    """
+    {bpin: {(anio, mes), ...}} of the no-data records still in force: made
+    after the month ended and less than `ttl_dias` ago.
+    """
+    ahora    = ahora or datetime.now(timezone.utc)
+    limite   = ahora - timedelta(days=ttl_dias)
+    vigentes = {}
+    for entrada in manifiesto["imagenes"].values():
+        if entrada.get("estado") != "sin_datos":
+            continue
+        verificado = datetime.fromisoformat(entrada["verificado"])
+        if verificado < limite or verificado < _fin_de_mes(entrada["anio"], entrada["mes"]):
+            continue
+        vigentes.setdefault(entrada["bpin"], set()).add((entrada["anio"], entrada["mes"]))
+    return vigentes
+
+
+def leer_manifiesto(container_client) -> tuple:
+    """(manifiesto, etag); (None, None) when the container has no manifest yet."""
+    try:
+        descarga = container_client.get_blob_client(BLOB_MANIFIESTO).download_blob()
+    except ResourceNotFoundError:
+        return None, None
+    contenido = descarga.readall()
+    return json.loads(gzip.decompress(contenido)), descarga.properties.etag
+
+
+def leer_manifiesto_si_cambio(container_client, etag: str | None) -> tuple:
+    """
+    Conditional leer_manifiesto for readers that keep a copy: (None, etag)
+    when the blob still has `etag`, so an unchanged manifest costs a 304.
+    """
+    if etag is None:
+        return leer_manifiesto(container_client)
+    try:
+        descarga = container_client.get_blob_client(BLOB_MANIFIESTO).download_blob(
+            etag=etag, match_condition=MatchConditions.IfModified)
+    except ResourceNotModifiedError:
+        return None, etag
+    except ResourceNotFoundError:
+        return None, None
+    return json.loads(gzip.decompress(descarga.readall())), descarga.properties.etag
+
+
+def escribir_manifiesto(container_client, manifiesto: dict, etag: str | None) -> str:
+    """
+    Uploads `manifiesto` only if the blob still has `etag` (or, with None,
+    does not exist). Returns the new ETag; raises ResourceModifiedError or
+    ResourceExistsError when another writer changed it first.
+    """
+    manifiesto["actualizado"] = _ahora()
+    datos = gzip.compress(json.dumps(manifiesto, separators=(",", ":")).encode("utf-8"))
+    blob  = container_client.get_blob_client(BLOB_MANIFIESTO)
+    if etag is None:
+        respuesta = blob.upload_blob(datos, overwrite=False)
+    else:
+        respuesta = blob.upload_blob(datos, overwrite=True, etag=etag,
+                                     match_condition=MatchConditions.IfNotModified)
+    return respuesta["etag"]
+
+
+def actualizar_manifiesto(container_client, cambios, intentos: int = INTENTOS_ESCRITURA) -> dict:
+    """
+    Read-modify-write with optimistic concurrency: `cambios(manifiesto)`
+    edits the fresh copy in place and is replayed on every retry. Returns
+    the manifest as written.
+    """
+    for intento in range(intentos):
+        manifiesto, etag = leer_manifiesto(container_client)
+        if manifiesto is None:
+            manifiesto = manifiesto_vacio()
+        cambios(manifiesto)
+        try:
+            escribir_manifiesto(container_client, manifiesto, etag)
+            return manifiesto
+        except (ResourceModifiedError, ResourceExistsError):
+            time.sleep(min(5.0, 0.2 * 2 ** intento))
+    raise RuntimeError(f"{BLOB_MANIFIESTO}: gave up after {intentos} concurrent-write conflicts")
+
+
+def construir_manifiesto(container_client) -> dict:
+    """Rebuilds the manifest from a listing of every image and derivative, with blob metadata."""
+    manifiesto = manifiesto_vacio()
+    for prefijo in (PREFIJO_DERIVADOS + PREFIJO_IMAGENES, PREFIJO_IMAGENES):
+        for blob in container_client.list_blobs(name_starts_with=prefijo, include=["metadata"]):
+            aplicar_registro(manifiesto, blob.name, blob.size, blob.etag, blob.metadata,
+                             blob.last_modified.isoformat(timespec="seconds")
+                             if blob.last_modified else None)
+    # Derivatives whose image is gone leave incomplete entries behind.
+    manifiesto["imagenes"] = {clave: e for clave, e in manifiesto["imagenes"].items()
+                              if e.get("estado")}
+    return manifiesto
+
+
+def reparar_manifiesto(container_client) -> dict:
+    """
+    Replaces the image entries with construir_manifiesto's, whatever they
+    held. No-data records have no blob to list and are kept.
+    """
+    nuevo = construir_manifiesto(container_client)
+
+    def cambios(manifiesto):
+        manifiesto["imagenes"] = {
+            **{clave: e for clave, e in manifiesto["imagenes"].items()
+               if e.get("estado") == "sin_datos"},
+            **nuevo["imagenes"],
+        }
+
+    return actualizar_manifiesto(container_client, cambios)
+
+
+def inventario_desde_manifiesto(manifiesto: dict) -> dict:
+    """{bpin: {(anio, mes), ...}} of the images present, the shape of inventario_azure."""
+    inventario = {}
+    for entrada in manifiesto["imagenes"].values():
+        if entrada.get("estado") == "ok":
+            inventario.setdefault(entrada["bpin"], set()).add((entrada["anio"], entrada["mes"]))
+    return inventario
+
+
+def imagenes_de_bpin(manifiesto: dict, bpin: str) -> list:
+    prefijo = f"{bpin}/"
+    return [e for clave, e in manifiesto["imagenes"].items()
+            if clave.startswith(prefijo) and e.get("estado") == "ok"]
+
+
+class RegistroManifiesto:
+    """
+    Buffers the blobs written and the no-data months found during a
+    pipeline run and merges them into the manifest every `cada` records
+    and on vaciar(). Thread-safe, since uploads and copies run on several
+    stages at once.
+    """
+
+    def __init__(self, container_client, cada: int = REGISTROS_POR_ESCRITURA):
+        self.container_client = container_client
+        self.cada             = cada
+        self._lock            = threading.Lock()
+        self._escritura       = threading.Lock()
+        self._pendientes      = []
+        self.escritos         = 0
+
+    def registrar(self, nombre: str, tamano: int, etag: str, metadata: dict | None = None) -> None:
+        self._agregar(aplicar_registro, nombre, tamano, etag, metadata, _ahora())
+
+    def registrar_sin_datos(self, bpin: str, anio: str, mes: str) -> None:
+        self._agregar(aplicar_sin_datos, bpin, anio, mes, _ahora())
+
+    def _agregar(self, aplicar, *registro) -> None:
+        with self._lock:
+            self._pendientes.append((aplicar, registro))
+            lleno = len(self._pendientes) >= self.cada
+        if lleno:
+            try:
+                self.vaciar()
+            except Exception as e:
+                # Kept buffered for the next write; never fails the upload itself.
+                print(f"  [manifest] could not update {BLOB_MANIFIESTO}: {e}")
+
+    def vaciar(self) -> int:
+        """Writes the buffered records. Returns how many; on failure they stay buffered."""
+        with self._escritura:
+            with self._lock:
+                lote, self._pendientes = self._pendientes, []
+            if not lote:
+                return 0
+
+            def cambios(manifiesto):
+                for aplicar, registro in lote:
+                    aplicar(manifiesto, *registro)
+
+            try:
+                actualizar_manifiesto(self.container_client, cambios)
+            except Exception:
+                with self._lock:
+                    self._pendientes = lote + self._pendientes
+                raise
+            self.escritos += len(lote)
+            return len(lote)
@@ -0,0 +1,219 @@
+"""
+metadata_proyectos.py
+Shared loader for the project metadata workbook (SharePoint/OneDrive Excel).
+
+The workbook is fetched with a conditional request (If-None-Match /
+If-Modified-Since). When the server answers 304, or sends back the same
+bytes, the previous parse is read from a local Parquet snapshot instead of
+parsing the Excel again. Only the requested columns are parsed, with the
+calamine engine when python-calamine is installed (openpyxl otherwise).
+
+Used by pipeline.py and app.py. Run it directly to benchmark a cold parse
+against a warm snapshot load:
+
+    python utils/metadata_proyectos.py
+"""
+
+import hashlib
+import json
+import os
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import requests
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+CARPETA_CACHE    = os.getenv("METADATA_CACHE_DIR", os.path.join(".cache", "metadata"))
+TIMEOUT_DESCARGA = 120
+
+COLUMNAS_PIPELINE = ["bpin", "nombre_del_proyecto", "latitud", "longitud"]
+COLUMNAS_APP      = COLUMNAS_PIPELINE + [
+    "sector", "alcance", "fase_del_proyecto", "total_proyecto",
+    "instancia_de_aprobacion_inicial", "fecha_aprobacion",
+    "entidad_ejecutora", "nit_entidad_ejecutora", "valor_total_de_los_contratos",
+    "numero_de_contratos_asociados", "fecha_inicial_de_la_programacion",
+    "fecha_final_de_la_programacion", "total_pagos_al_proyecto",
+    "avance_fisico", "avance_financiero",
+]
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def _motor_excel() -> str:
+    try:
+        import python_calamine  # noqa: F401
+    except ImportError:
+        return "openpyxl"
+    version = tuple(int(p) for p in pd.__version__.split(".")[:2])
+    return "calamine" if version >= (2, 2) else "openpyxl"
+
+
+MOTOR_EXCEL = _motor_excel()
+
+
+def url_descarga(url: str) -> str:
+    """
+    Normalizes SharePoint/OneDrive viewer links to direct-download links.
+    Other URLs are left untouched.
+    """
+    if "sharepoint.com" in url and "/:x:/" in url:
+        return url.split("?", 1)[0] + "?download=1"
+    return url
+
+
+def parsear_excel(contenido: bytes, hoja: str, columnas: list | None = None,
+                  motor: str = MOTOR_EXCEL) -> pd.DataFrame:
+    """
+    Parses the workbook as strings, keeping only `columnas` (all when None).
+    Falls back to the first sheet when `hoja` does not exist.
+    """
+    usecols     = None if columnas is None else (lambda c: str(c).strip() in columnas)
+    excel_bytes = BytesIO(contenido)
+    try:
+        df = pd.read_excel(excel_bytes, sheet_name=hoja, dtype=str,
+                           usecols=usecols, engine=motor)
+    except ValueError:
+        excel_bytes.seek(0)
+        df = pd.read_excel(excel_bytes, sheet_name=0, dtype=str,
+                           usecols=usecols, engine=motor)
+    df.columns = [str(c).strip() for c in df.columns]
+    return df
+
+
+def _rutas_cache(carpeta: str, url: str, hoja: str, columnas: list | None) -> tuple:
+    clave = json.dumps([url, hoja, sorted(columnas) if columnas else None])
+    base  = os.path.join(carpeta, hashlib.sha1(clave.encode()).hexdigest()[:16])
+    return base + ".parquet", base + ".json"
+
+
+def _leer_meta(ruta_meta: str, ruta_parquet: str) -> dict:
+    if not (os.path.exists(ruta_meta) and os.path.exists(ruta_parquet)):
+        return {}
+    try:
+        with open(ruta_meta, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _guardar_snapshot(df: pd.DataFrame, ruta_parquet: str, ruta_meta: str, meta: dict) -> None:
+    """Writes both files through temporary names so readers never see a partial snapshot."""
+    os.makedirs(os.path.dirname(ruta_parquet), exist_ok=True)
+    sufijo = f".{os.getpid()}.tmp"
+    try:
+        df.to_parquet(ruta_parquet + sufijo, index=False)
+        with open(ruta_meta + sufijo, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(ruta_parquet + sufijo, ruta_parquet)
+        os.replace(ruta_meta + sufijo, ruta_meta)
+    except Exception as e:
+        print(f"  [metadata] could not write snapshot: {e}")
+        for ruta in (ruta_parquet + sufijo, ruta_meta + sufijo):
+            if os.path.exists(ruta):
+                os.remove(ruta)
+
+
+def _desde_snapshot(ruta_parquet: str, meta: dict, origen: str, inicio: float) -> pd.DataFrame:
+    df = pd.read_parquet(ruta_parquet)
+    # Parquet hands missing object cells back as None; a fresh parse has NaN.
+    df = df.where(df.notna(), np.nan)
+    return _etiquetar(df, meta, origen, inicio)
+
+
+def _etiquetar(df: pd.DataFrame, meta: dict, origen: str, inicio: float) -> pd.DataFrame:
+    df.attrs["version"]  = meta.get("etag") or meta.get("last_modified") or meta.get("sha1")
+    df.attrs["origen"]   = origen
+    df.attrs["segundos"] = time.perf_counter() - inicio
+    return df
+
+
+def cargar_metadata(url: str, hoja: str, columnas: list | None = None,
+                    carpeta_cache: str = CARPETA_CACHE) -> pd.DataFrame:
+    """
+    Returns the project sheet as a string DataFrame (missing cells stay NaN).
+
+    df.attrs carries "version" (ETag, Last-Modified or content hash, usable
+    as a cache key), "origen" ("no_modificado" for a 304 or unchanged body,
+    "descarga" for a fresh parse, "snapshot" when the server could not be
+    reached and the last snapshot was used) and "segundos".
+    """
+    inicio = time.perf_counter()
+    ruta_parquet, ruta_meta = _rutas_cache(carpeta_cache, url, hoja, columnas)
+    meta = _leer_meta(ruta_meta, ruta_parquet)
+
+    cabeceras = {}
+    if meta.get("etag"):
+        cabeceras["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        cabeceras["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        response = requests.get(url_descarga(url), headers=cabeceras, timeout=TIMEOUT_DESCARGA)
+        if response.status_code == 304 and meta:
+            return _desde_snapshot(ruta_parquet, meta, "no_modificado", inicio)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if not meta:
+            raise
+        print(f"  [metadata] workbook unreachable ({str(e)[:100]}), using last snapshot.")
+        return _desde_snapshot(ruta_parquet, meta, "snapshot", inicio)
+
+    sha1 = hashlib.sha1(response.content).hexdigest()
+    nueva_meta = {
+        "etag":          response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "sha1":          sha1,
+    }
+    if meta.get("sha1") == sha1:
+        # Server ignores conditional headers but the workbook is unchanged.
+        with open(ruta_meta, "w", encoding="utf-8") as f:
+            json.dump(nueva_meta, f)
+        return _desde_snapshot(ruta_parquet, nueva_meta, "no_modificado", inicio)
+
+    df = parsear_excel(response.content, hoja, columnas)
+    _guardar_snapshot(df, ruta_parquet, ruta_meta, nueva_meta)
+    return _etiquetar(df, nueva_meta, "descarga", inicio)
+
+
+def _medir(funcion, repeticiones: int = 3) -> float:
+    mejores = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        mejores.append(time.perf_counter() - inicio)
+    return min(mejores)
+
+
+def main():
+    import tempfile
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    url  = os.getenv("PROJECT_METADATA_XLSX_URL")
+    hoja = os.getenv("PROJECT_METADATA_SHEET_NAME", "proyectos_satview")
+    if not url:
+        raise SystemExit("Set PROJECT_METADATA_XLSX_URL to run the benchmark.")
+
+    inicio    = time.perf_counter()
+    contenido = requests.get(url_descarga(url), timeout=TIMEOUT_DESCARGA).content
+    print(f"Download              : {time.perf_counter() - inicio:8.3f}s  ({len(contenido) / 1e6:.1f} MB)")
+
+    print(f"Cold parse, all cols  : {_medir(lambda: parsear_excel(contenido, hoja, motor='openpyxl')):8.3f}s  (openpyxl)")
+    print(f"Cold parse, app cols  : {_medir(lambda: parsear_excel(contenido, hoja, COLUMNAS_APP, motor='openpyxl')):8.3f}s  (openpyxl)")
+    if MOTOR_EXCEL != "openpyxl":
+        print(f"Cold parse, app cols  : {_medir(lambda: parsear_excel(contenido, hoja, COLUMNAS_APP)):8.3f}s  ({MOTOR_EXCEL})")
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        cargar_metadata(url, hoja, COLUMNAS_APP, carpeta)
+        ruta_parquet, _ = _rutas_cache(carpeta, url, hoja, COLUMNAS_APP)
+        print(f"Warm snapshot load    : {_medir(lambda: pd.read_parquet(ruta_parquet)):8.3f}s")
+        df = cargar_metadata(url, hoja, COLUMNAS_APP, carpeta)
+        print(f"Conditional reload    : {df.attrs['segundos']:8.3f}s  ({df.attrs['origen']}, {len(df)} rows)")
+
+
+if __name__ == "__main__":
+    main()
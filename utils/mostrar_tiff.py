@@ -63,7 +63,8 @@ def diagnose(data, verbose: bool) -> bool:
 
 def render(filepath: str, guardar: bool, verbose: bool) -> None:
     log(f"Reading: {filepath}", verbose)
-    data = rioxarray.open_rasterio(filepath)
+    # mask_and_scale: scaled-int16 files come back as float reflectance with NaN nodata
+    data = rioxarray.open_rasterio(filepath, mask_and_scale=True)
 
     empty = diagnose(data, verbose)
     if empty:
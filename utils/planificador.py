@@ -0,0 +1,173 @@
+"""
+planificador.py
+Order and time budget of the pipeline's download requests.
+
+ordenar_tareas sorts the planned requests by the priorities chosen with
+--priority, applied in order as a compound key:
+
+    sheet          spreadsheet order (the default)
+    newest-rows    rows further down the sheet, the most recently added, first
+    recent-months  most recent months first
+    empty-first    projects with the fewest images already in Azure first
+
+Requests the previous run had to defer always go first, so whatever sits
+at the end of the order is not starved run after run.
+
+Presupuesto enforces --deadline: before each request starts it estimates
+how long it will take (seconds per month, an exponentially weighted mean
+of the latencies observed in past runs and so far in this one) and
+refuses it when it would not finish before the deadline. Refused requests
+are saved with guardar_json for the next run, and the run ends cleanly
+instead of being killed by the CI timeout.
+
+Used by pipeline.py.
+"""
+
+import json
+import threading
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+
+try:
+    from utils.lotes_openeo import bpins_tarea, meses_tarea
+except ImportError:   # run as a script from inside utils/
+    from lotes_openeo import bpins_tarea, meses_tarea
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+BLOB_COSTOS       = "journal/costos.json"            # latency history, per mode (and shard)
+BLOB_APLAZADAS    = "journal/cola_aplazada.json"     # requests deferred by the last run
+COSTO_INICIAL_MES = 600    # seconds per month assumed before there is any history
+ALFA_COSTO        = 0.3    # weight of each new observation in the moving average
+MARGEN_PLAZO      = 300    # seconds kept free before the deadline for uploads and reports
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def meses_por_bpin(tarea: dict) -> list:
+    """(bpin, anio, mes) of every project month the request delivers."""
+    return [(d["bpin"], anio, mes) for sitio in tarea["miembros"] for d in sitio["destinos"]
+            for anio, mes in meses_tarea(tarea) if (anio, mes) in d["pendientes"]]
+
+
+def _mes_absoluto(anio_mes: tuple) -> int:
+    return int(anio_mes[0]) * 12 + int(anio_mes[1])
+
+
+CLAVES_PRIORIDAD = {
+    "sheet":         lambda t, c: min(c["posicion"].get(b, len(c["posicion"])) for b in bpins_tarea(t)),
+    "newest-rows":   lambda t, c: -max(c["posicion"].get(b, -1) for b in bpins_tarea(t)),
+    "recent-months": lambda t, c: -max(map(_mes_absoluto, meses_tarea(t))),
+    "empty-first":   lambda t, c: min(c["existentes"].get(b, 0) for b in bpins_tarea(t)),
+}
+
+
+def parsear_prioridad(texto: str) -> list:
+    """'empty-first,recent-months' -> ['empty-first', 'recent-months']."""
+    claves = [c.strip() for c in texto.split(",") if c.strip()]
+    desconocidas = [c for c in claves if c not in CLAVES_PRIORIDAD]
+    if not claves or desconocidas:
+        raise ValueError(f"unknown priority {', '.join(desconocidas) or texto!r}; "
+                         f"choose from {', '.join(CLAVES_PRIORIDAD)}")
+    return claves
+
+
+def ordenar_tareas(tareas: list, prioridad: list, contexto: dict) -> list:
+    """
+    `contexto` holds {"posicion": {bpin: row index}, "existentes": {bpin:
+    images in Azure}, "aplazadas": {(bpin, anio, mes), ...}}. The sort is
+    stable, so ties keep the planned order.
+    """
+    aplazadas = contexto.get("aplazadas", set())
+
+    def clave(tarea):
+        arrastre = any(m in aplazadas for m in meses_por_bpin(tarea))
+        return (not arrastre, *(CLAVES_PRIORIDAD[p](tarea, contexto) for p in prioridad))
+
+    return sorted(tareas, key=clave)
+
+
+def leer_json(container_client, blob: str, defecto):
+    try:
+        return json.loads(container_client.get_blob_client(blob).download_blob().readall())
+    except ResourceNotFoundError:
+        return defecto
+    except Exception as e:
+        print(f"  [planner] could not read {blob}: {e}")
+        return defecto
+
+
+def guardar_json(container_client, blob: str, datos) -> None:
+    try:
+        container_client.get_blob_client(blob).upload_blob(
+            json.dumps(datos, ensure_ascii=False).encode("utf-8"), overwrite=True)
+    except Exception as e:
+        print(f"  [planner] could not write {blob}: {e}")
+
+
+class Presupuesto:
+    """
+    Time budget of one run. `plazo_s` is the number of seconds, counted
+    from `inicio` (time.monotonic), by which every started request must be
+    done; None means no deadline. Thread-safe.
+    """
+
+    def __init__(self, plazo_s: float | None, historial: dict, modo: str,
+                 inicio: float | None = None, margen: float = MARGEN_PLAZO):
+        self.fin       = None if plazo_s is None else (inicio or time.monotonic()) + plazo_s - margen
+        self.modo      = modo
+        self.historial = dict(historial)
+        self.aplazadas = []
+        self._lock     = threading.Lock()
+        self._inicios  = {}   # (bpin, anio, mes) -> (time.monotonic() at start, months in request)
+
+    def segundos_por_mes(self) -> float:
+        with self._lock:
+            return self.historial.get(self.modo, {}).get("segundos_por_mes", COSTO_INICIAL_MES)
+
+    def estimar(self, tarea: dict) -> float:
+        return self.segundos_por_mes() * len(meses_tarea(tarea))
+
+    def restante(self) -> float | None:
+        return None if self.fin is None else self.fin - time.monotonic()
+
+    def alcanza(self, tarea: dict) -> bool:
+        """True if `tarea` is expected to finish before the deadline; marks its start."""
+        if self.fin is not None and time.monotonic() + self.estimar(tarea) > self.fin:
+            return False
+        self.iniciar(tarea)
+        return True
+
+    def aplazar(self, tareas: list) -> None:
+        with self._lock:
+            self.aplazadas.extend(tareas)
+
+    def iniciar(self, tarea: dict) -> None:
+        ahora = time.monotonic()
+        meses = meses_tarea(tarea)
+        with self._lock:
+            for anio, mes in meses:
+                self._inicios.setdefault((tarea["bpin"], anio, mes), (ahora, len(meses)))
+
+    def observar(self, tarea: dict, medir: bool = True) -> None:
+        """
+        Records the latency of one month of `tarea` (a single-month view)
+        that just finished. The months of a multi-month request share its
+        elapsed time. With medir=False the start is only forgotten.
+        """
+        with self._lock:
+            inicio = self._inicios.pop((tarea["bpin"], tarea["anio"], tarea["mes"]), None)
+            if inicio is None or not medir:
+                return
+            segundos = (time.monotonic() - inicio[0]) / inicio[1]
+            entrada  = self.historial.setdefault(self.modo, {"segundos_por_mes": segundos,
+                                                             "muestras": 0})
+            if entrada["muestras"]:
+                entrada["segundos_por_mes"] += ALFA_COSTO * (segundos - entrada["segundos_por_mes"])
+            entrada["muestras"] += 1
+
+    def meses_aplazados(self) -> list:
+        with self._lock:
+            return sorted({m for tarea in self.aplazadas for m in meses_por_bpin(tarea)})
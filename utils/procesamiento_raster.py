@@ -0,0 +1,181 @@
+"""
+procesamiento_raster.py
+Local post-processing applied to each monthly GeoTIFF before upload.
+
+escalar_a_int16 writes the scaled-int16 storage profile (see
+Download_sat_imgs.py) with explicit nodata and scale metadata.
+convertir_a_cog rewrites the GeoTIFF that openEO returns (stripped,
+uncompressed, no overviews) as a Cloud-Optimized GeoTIFF with internal
+tiles, overviews and DEFLATE or ZSTD compression with a predictor. A
+reader can then fetch a thumbnail from the overviews without decoding the
+full-resolution data.
+
+Used by pipeline.py. Run it directly to compare raw files against their COG
+and scaled-int16 versions (size, upload time, first-render latency):
+
+    python utils/procesamiento_raster.py Imagenes/sentinel2_<BPIN>/2025_01.tiff ...
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import rasterio
+from rasterio.shutil import copy as copiar_raster
+
+try:
+    from utils.Download_sat_imgs import ESCALA_REFLECTANCIA, MAX_DN_INT16, NODATA_INT16
+except ImportError:   # run as a script from inside utils/
+    from Download_sat_imgs import ESCALA_REFLECTANCIA, MAX_DN_INT16, NODATA_INT16
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+COMPRESIONES_COG  = ("DEFLATE", "ZSTD")
+COG_BLOQUE        = 256    # internal tile size in pixels
+COG_NIVEL         = 6      # DEFLATE/ZSTD level: good ratio without slow writes
+LADO_MINIATURA    = 512    # longest side, in pixels, of the first render
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def escalar_a_int16(ruta: str, escala_origen: float = 1.0) -> bool:
+    """
+    Rewrites a digital-number GeoTIFF from the scaled-int16 profile in place
+    as int16 with NODATA_INT16 as nodata and ESCALA_REFLECTANCIA as band
+    scale, whatever integer or float type and nodata convention the backend
+    used. Readers opening it with mask_and_scale get float reflectance back.
+    Pass escala_origen=ESCALA_REFLECTANCIA to convert a float32 reflectance
+    file. Returns False when the file is already in that form.
+    """
+    with rasterio.open(ruta) as src:
+        if (src.dtypes[0] == "int16" and src.nodata == NODATA_INT16
+                and src.scales[0] == ESCALA_REFLECTANCIA):
+            return False
+        datos  = src.read(masked=True)
+        perfil = src.profile.copy()
+
+    valores = np.ma.filled(datos.astype("float64"), np.nan) / escala_origen
+    validos = np.isfinite(valores)
+    dn      = np.full(valores.shape, NODATA_INT16, dtype="int16")
+    dn[validos] = np.clip(np.rint(valores[validos]), 0, MAX_DN_INT16)
+
+    perfil.update(driver="GTiff", dtype="int16", nodata=NODATA_INT16)
+    temporal = ruta + ".int16.tmp"
+    try:
+        with rasterio.open(temporal, "w", **perfil) as dst:
+            dst.write(dn)
+            dst.scales  = (ESCALA_REFLECTANCIA,) * dst.count
+            dst.offsets = (0.0,) * dst.count
+        os.replace(temporal, ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return True
+
+
+def convertir_a_cog(ruta: str, compresion: str = "DEFLATE", ruta_destino: str | None = None) -> str:
+    """
+    Writes `ruta` as a COG to `ruta_destino` (in place by default) and
+    returns the output path. The file is written under a temporary name
+    first, so a failed conversion leaves the original untouched.
+    """
+    destino  = ruta_destino or ruta
+    temporal = destino + ".cog.tmp"
+    try:
+        with rasterio.open(ruta) as src:
+            copiar_raster(
+                src, temporal,
+                driver="COG",
+                compress=compresion,
+                level=COG_NIVEL,
+                predictor="YES",   # floating-point or horizontal, by band type
+                blocksize=COG_BLOQUE,
+                overviews="AUTO",
+                overview_resampling="AVERAGE",
+                bigtiff="IF_SAFER",
+            )
+        os.replace(temporal, destino)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return destino
+
+
+def leer_miniatura(ruta: str, lado: int = LADO_MINIATURA) -> np.ndarray:
+    """Reads every band decimated to at most `lado` pixels per side, using overviews when present."""
+    with rasterio.open(ruta) as src:
+        escala = max(src.width, src.height) / lado
+        if escala <= 1:
+            return src.read()
+        forma = (src.count, max(1, round(src.height / escala)), max(1, round(src.width / escala)))
+        return src.read(out_shape=forma)
+
+
+def _medir_miniatura(ruta: str, repeticiones: int = 3) -> float:
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        leer_miniatura(ruta)
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos)
+
+
+def _medir_subida(container_client, ruta: str) -> float | None:
+    if container_client is None:
+        return None
+    blob = f"benchmarks/{os.getpid()}_{os.path.basename(ruta)}"
+    inicio = time.perf_counter()
+    with open(ruta, "rb") as f:
+        container_client.upload_blob(name=blob, data=f, overwrite=True)
+    segundos = time.perf_counter() - inicio
+    container_client.delete_blob(blob)
+    return segundos
+
+
+def main(rutas: list):
+    import tempfile
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    container_client = None
+    if os.getenv("AZURE_STORAGE_CONNECTION_STRING"):
+        from azure.storage.blob import BlobServiceClient
+        container_client = BlobServiceClient.from_connection_string(
+            os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        ).get_container_client(os.getenv("AZURE_CONTAINER", "imagenes-sentinel"))
+    else:
+        print("AZURE_STORAGE_CONNECTION_STRING not set: upload times are skipped.\n")
+
+    print(f"{'file':<28} {'variant':<12} {'MB':>8} {'upload s':>9} {'render ms':>10}")
+    with tempfile.TemporaryDirectory() as carpeta:
+        for ruta in rutas:
+            nombre    = os.path.basename(os.path.dirname(ruta)) + "/" + os.path.basename(ruta)
+            variantes = [("raw", ruta)]
+            for compresion in COMPRESIONES_COG:
+                destino = os.path.join(carpeta, f"{compresion.lower()}_{os.path.basename(ruta)}")
+                variantes.append((f"cog-{compresion.lower()}", convertir_a_cog(ruta, compresion, destino)))
+
+            with rasterio.open(ruta) as src:
+                es_float = src.dtypes[0].startswith("float")
+            if es_float:
+                destino = os.path.join(carpeta, f"int16_{os.path.basename(ruta)}")
+                copiar_raster(ruta, destino, driver="GTiff")
+                escalar_a_int16(destino, ESCALA_REFLECTANCIA)
+                variantes.append(("int16", destino))
+                variantes.append(("cog-int16", convertir_a_cog(destino, "DEFLATE",
+                                                               destino + ".cog.tiff")))
+
+            for variante, archivo in variantes:
+                subida = _medir_subida(container_client, archivo)
+                print(f"{nombre[-28:]:<28} {variante:<12} "
+                      f"{os.path.getsize(archivo) / 1e6:>8.2f} "
+                      f"{'-' if subida is None else f'{subida:.2f}':>9} "
+                      f"{_medir_miniatura(archivo) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        raise SystemExit(__doc__)
+    main(sys.argv[1:])
@@ -0,0 +1,143 @@
+"""
+shards.py
+Deterministic split of the pipeline's work across parallel workers.
+
+`pipeline.py --shard K/N` keeps only the projects whose key hashes to
+slice K of N (1-based). The hash is a stable digest of the BPIN, not
+Python's salted hash(), so every worker computes the same split without
+talking to the others. Each worker writes its own state and log files,
+named with sufijo_shard, and combinar_shards merges them into one run
+report.
+
+Only the standard library is used, so the merge step runs without
+installing the pipeline's dependencies:
+
+    python utils/shards.py <folder with the shard artifacts> [--salida reporte]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+CONTADORES = ("imagenes_ok", "imagenes_error", "imagenes_copiadas", "imagenes_sin_datos")
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def parsear_shard(texto: str) -> tuple:
+    """'K/N' -> (K, N), with 1 <= K <= N. Raises ValueError otherwise."""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", texto or "")
+    if not match:
+        raise ValueError(f"expected K/N, got '{texto}'")
+    k, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= k <= n:
+        raise ValueError(f"shard {k} is out of range 1..{n}")
+    return k, n
+
+
+def indice_shard(clave: str, n: int) -> int:
+    """Slice (1..n) that `clave` belongs to; the same on every machine and run."""
+    digest = hashlib.md5(str(clave).strip().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % n + 1
+
+
+def sufijo_shard(k: int, n: int) -> str:
+    return f".shard{k}of{n}"
+
+
+def ruta_shard(ruta: str, shard: tuple | None) -> str:
+    """'pipeline_state.json' -> 'pipeline_state.shard2of4.json' for shard (2, 4)."""
+    if shard is None:
+        return ruta
+    base, extension = os.path.splitext(ruta)
+    return base + sufijo_shard(*shard) + extension
+
+
+def _shard_de_archivo(ruta: str) -> str:
+    match = re.search(r"\.shard(\d+)of(\d+)\.", os.path.basename(ruta))
+    return f"{match.group(1)}/{match.group(2)}" if match else "?"
+
+
+def combinar_shards(carpeta: str) -> dict:
+    """
+    Merges every pipeline_state*.json and log_descarga*.txt under `carpeta`
+    (searched recursively, as download-artifact leaves one folder per
+    artifact). Returns {"estado": {bpin: resultado}, "log": [lines],
+    "shards": {shard: totals}}.
+    """
+    estado, shards = {}, {}
+    for ruta in sorted(glob.glob(os.path.join(carpeta, "**", "pipeline_state*.json"), recursive=True)):
+        shard = _shard_de_archivo(ruta)
+        with open(ruta, encoding="utf-8") as f:
+            resultados = json.load(f)
+        totales = shards.setdefault(shard, {"proyectos": 0, **{c: 0 for c in CONTADORES}})
+        for bpin, resultado in resultados.items():
+            totales["proyectos"] += 1
+            for contador in CONTADORES:
+                totales[contador] += resultado.get(contador, 0)
+            if bpin in estado:
+                # Only possible if two shards were run with different N.
+                for contador in CONTADORES:
+                    estado[bpin][contador] = estado[bpin].get(contador, 0) + resultado.get(contador, 0)
+            else:
+                estado[bpin] = {**resultado, "shard": shard}
+
+    log = []
+    for ruta in sorted(glob.glob(os.path.join(carpeta, "**", "log_descarga*.txt"), recursive=True)):
+        with open(ruta, encoding="utf-8") as f:
+            lineas = [linea for linea in f.read().splitlines() if linea.strip()]
+        log.append(f"# shard {_shard_de_archivo(ruta)}: {len(lineas)} line(s)")
+        log.extend(lineas)
+    return {"estado": estado, "log": log, "shards": shards}
+
+
+def reporte_markdown(combinado: dict) -> str:
+    filas = ["| Shard | Projects | Uploaded | Failed | Copied | No data |",
+             "|---|---:|---:|---:|---:|---:|"]
+    total = {"proyectos": 0, **{c: 0 for c in CONTADORES}}
+    for shard, t in sorted(combinado["shards"].items()):
+        filas.append(f"| {shard} | {t['proyectos']} | {t['imagenes_ok']} | {t['imagenes_error']} "
+                     f"| {t['imagenes_copiadas']} | {t['imagenes_sin_datos']} |")
+        for clave in total:
+            total[clave] += t[clave]
+    filas.append(f"| **Total** | {total['proyectos']} | {total['imagenes_ok']} | "
+                 f"{total['imagenes_error']} | {total['imagenes_copiadas']} | "
+                 f"{total['imagenes_sin_datos']} |")
+    return "## SatView pipeline run\n\n" + "\n".join(filas) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the state and logs of a sharded pipeline run.")
+    parser.add_argument("carpeta", help="Folder holding the per-shard artifacts.")
+    parser.add_argument("--salida", default="reporte", help="Output folder (default: reporte).")
+    args = parser.parse_args()
+
+    combinado = combinar_shards(args.carpeta)
+    if not combinado["shards"]:
+        # A shard with nothing pending exits before writing any state.
+        print(f"No pipeline_state*.json found under {args.carpeta}: nothing was processed.")
+
+    os.makedirs(args.salida, exist_ok=True)
+    with open(os.path.join(args.salida, "pipeline_state.json"), "w", encoding="utf-8") as f:
+        json.dump(combinado["estado"], f, indent=2, ensure_ascii=False)
+    with open(os.path.join(args.salida, "log_descarga.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(combinado["log"]))
+    reporte = reporte_markdown(combinado)
+    with open(os.path.join(args.salida, "reporte.md"), "w", encoding="utf-8") as f:
+        f.write(reporte)
+
+    # Shown on the workflow run page when running on GitHub Actions.
+    if os.getenv("GITHUB_STEP_SUMMARY"):
+        with open(os.environ["GITHUB_STEP_SUMMARY"], "a", encoding="utf-8") as f:
+            f.write(reporte)
+    print(reporte)
+
+
+if __name__ == "__main__":
+    main()
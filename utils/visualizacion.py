@@ -0,0 +1,355 @@
+"""
+visualizacion.py
+Display rendering of Sentinel-2 monthly composites, shared by the pipeline
+and the app.
+
+componer_rgb turns the four reflectance bands (B02, B03, B04, B08) into an
+8-bit RGB image for one of the display modes: percentile stretch, gamma
+and band stacking. The pipeline writes the result of every mode as a small
+uint8 COG next to the source blob (see blob_derivado), so the app only has
+to download it; the app renders on the fly only for blobs uploaded before
+derivatives existed.
+
+calcular_estadisticas summarizes an image once at pipeline time (valid
+fraction, per-band percentiles, min/max). The stats travel as blob
+metadata, so the app can skip empty months and stretch without scanning
+pixels.
+
+overlay_web turns a rendering into a small Web Mercator WebP/PNG data URL
+with its lat/lon bounds, which the app embeds in the map HTML as a folium
+ImageOverlay instead of serving the GeoTIFF through a tile server.
+
+The rendering kernel (renderizar) works on the float32 bands read once by
+leer_reflectancia: one nanpercentile call for every band it needs, stretch
+and gamma in place, and the emptiness verdict from the same pass. Run this
+module directly to benchmark it against the previous float64 path:
+
+    python utils/visualizacion.py Imagenes/sentinel2_<BPIN>/2025_01.tiff ...
+"""
+
+import base64
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as copiar_raster
+from rasterio.warp import Resampling, calculate_default_transform, reproject, transform_bounds
+
+
+# ── Configuration ─────────────────────────────────────────────────
+
+MODOS = ("natural", "gris", "falso")
+
+# 1-based band numbers stacked as (R, G, B) for each mode
+BANDAS_MODO = {
+    "natural": (3, 2, 1),   # B04, B03, B02
+    "gris":    (3, 3, 3),   # B04 on every channel
+    "falso":   (4, 3, 2),   # B08, B04, B03
+}
+
+BANDA_MASCARA     = 3    # pixels that are NaN in B04 are blanked in every mode
+GAMMA             = 1.2
+PERCENTILES       = (2, 98)
+PREFIJO_DERIVADOS = "derivados/"
+
+LADO_OVERLAY      = 1024     # longest side, in pixels, of the image embedded in a map
+CALIDAD_WEBP      = 85
+
+# ─────────────────────────────────────────────────────────────────
+
+
+def blob_derivado(blob_path: str, modo: str) -> str:
+    """sentinel2_{bpin}/{anio}_{mes}.tiff -> derivados/sentinel2_{bpin}/{anio}_{mes}_{modo}.tif"""
+    base = os.path.splitext(blob_path)[0]
+    return f"{PREFIJO_DERIVADOS}{base}_{modo}.tif"
+
+
+def calcular_estadisticas(bandas: np.ndarray) -> dict:
+    """
+    Flat stats of a (band, y, x) reflectance array with NaN nodata:
+    fraccion_valida and pct_nubes (pixels masked by the SCL cloud mask or
+    outside the scene) over BANDA_MASCARA, plus b{n}_p2, b{n}_p98, b{n}_min
+    and b{n}_max for every band n (1-based). Bands without valid pixels get
+    no per-band keys.
+    """
+    validos = np.isfinite(bandas[BANDA_MASCARA - 1])
+    fraccion = float(validos.mean()) if validos.size else 0.0
+    est = {"fraccion_valida": fraccion, "pct_nubes": 100 * (1 - fraccion)}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # all-NaN bands
+        percentiles = np.nanpercentile(bandas, PERCENTILES, axis=(1, 2))
+        minimos     = np.nanmin(bandas, axis=(1, 2))
+        maximos     = np.nanmax(bandas, axis=(1, 2))
+    for n in range(1, len(bandas) + 1):
+        if np.isnan(minimos[n - 1]):
+            continue
+        est.update({f"b{n}_p2":  float(percentiles[0, n - 1]),
+                    f"b{n}_p98": float(percentiles[1, n - 1]),
+                    f"b{n}_min": float(minimos[n - 1]),
+                    f"b{n}_max": float(maximos[n - 1])})
+    return est
+
+
+def estadisticas_a_metadata(est: dict) -> dict:
+    """Blob metadata values must be strings."""
+    return {clave: f"{valor:.6g}" for clave, valor in est.items()}
+
+
+def estadisticas_desde_metadata(metadata: dict | None) -> dict | None:
+    """Inverse of estadisticas_a_metadata; None for blobs uploaded without stats."""
+    if not metadata or "fraccion_valida" not in metadata:
+        return None
+    est = {}
+    for clave, valor in metadata.items():
+        try:
+            est[clave] = float(valor)
+        except ValueError:
+            continue
+    return est
+
+
+def _limites(estadisticas: dict | None, n: int) -> tuple | None:
+    if not estadisticas or f"b{n}_p2" not in estadisticas:
+        return None
+    return estadisticas[f"b{n}_p2"], estadisticas[f"b{n}_p98"]
+
+
+def percentiles_bandas(bandas: np.ndarray, indices, estadisticas: dict | None = None) -> dict:
+    """
+    {banda: (p2, p98)} for the 1-based `indices`, taken from `estadisticas`
+    when present and otherwise computed for all the missing bands in a
+    single nanpercentile call. (nan, nan) for a band without valid pixels.
+    """
+    limites = {i: _limites(estadisticas, i) for i in indices}
+    faltan  = sorted(i for i, lim in limites.items() if lim is None)
+    if faltan:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            p = np.nanpercentile(bandas[[i - 1 for i in faltan]], PERCENTILES, axis=(1, 2))
+        limites.update({i: (p[0, k], p[1, k]) for k, i in enumerate(faltan)})
+    return limites
+
+
+def _estirar(canal: np.ndarray, p2: float, p98: float) -> np.ndarray:
+    """Percentile stretch and gamma of one float32 band, in place, to [0, 1] with nodata at 0."""
+    nodata = np.isnan(canal)
+    if not np.isfinite(p2):
+        canal.fill(0.0)
+    elif p98 == p2:
+        canal.fill(0.5)
+    else:
+        canal -= np.float32(p2)
+        canal *= np.float32(1 / (p98 - p2))
+        np.clip(canal, 0, 1, out=canal)
+        np.power(canal, np.float32(1 / GAMMA), out=canal)
+    canal[nodata] = 0.0
+    return canal
+
+
+def renderizar(bandas: np.ndarray, modo: str, estadisticas: dict | None = None) -> tuple:
+    """
+    `bandas` is the (band, y, x) float32 reflectance array with NaN nodata,
+    as returned by leer_reflectancia; it is not modified. Returns
+    (rgb, tiene_datos): the (3, y, x) uint8 display image for `modo`, with
+    pixels that are NaN in BANDA_MASCARA at 0, and whether that band has
+    any valid pixel. The percentiles in `estadisticas` are used when given.
+    """
+    bandas  = np.asarray(bandas, dtype=np.float32)
+    indices = BANDAS_MODO.get(modo, BANDAS_MODO["natural"])
+    nodata  = np.isnan(bandas[BANDA_MASCARA - 1])
+    limites = percentiles_bandas(bandas, set(indices), estadisticas)
+
+    canales = {}
+    for i in set(indices):
+        canal = _estirar(bandas[i - 1].copy(), *limites[i])
+        canal *= 255
+        canal[nodata] = 0.0
+        canales[i] = canal
+
+    rgb = np.empty((3,) + bandas.shape[1:], dtype=np.uint8)
+    for k, i in enumerate(indices):
+        rgb[k] = canales[i]   # truncating cast, as astype(uint8)
+    return rgb, not nodata.all()
+
+
+def componer_rgb(bandas: np.ndarray, modo: str, estadisticas: dict | None = None) -> np.ndarray:
+    """renderizar without the emptiness verdict."""
+    return renderizar(bandas, modo, estadisticas)[0]
+
+
+def leer_reflectancia(ruta: str) -> tuple:
+    """
+    Reads every band as float32 reflectance with NaN nodata, applying the
+    band scale/offset of the scaled-int16 profile when present. Returns
+    (bandas, perfil).
+    """
+    with rasterio.open(ruta) as src:
+        datos  = src.read(masked=True, out_dtype="float32")
+        escala = np.array(src.scales, dtype="float32").reshape(-1, 1, 1)
+        offset = np.array(src.offsets, dtype="float32").reshape(-1, 1, 1)
+        perfil = src.profile.copy()
+    bandas = datos.data
+    bandas[np.ma.getmaskarray(datos)] = np.nan
+    # In place, and skipped for float32 files without scale metadata.
+    if (escala != 1).any():
+        bandas *= escala
+    if (offset != 0).any():
+        bandas += offset
+    return bandas, perfil
+
+
+def escribir_rgb(rgb: np.ndarray, perfil_origen: dict, ruta_destino: str) -> str:
+    """Writes a (3, y, x) uint8 image as a DEFLATE COG with the source georeferencing."""
+    perfil = {
+        "driver": "GTiff", "dtype": "uint8", "count": 3,
+        "height": rgb.shape[1], "width": rgb.shape[2],
+        "crs": perfil_origen["crs"], "transform": perfil_origen["transform"],
+    }
+    os.makedirs(os.path.dirname(ruta_destino) or ".", exist_ok=True)
+    with MemoryFile() as memoria:
+        with memoria.open(**perfil) as dst:
+            dst.write(rgb)
+        with memoria.open() as src:
+            copiar_raster(src, ruta_destino, driver="COG", compress="DEFLATE",
+                          predictor="YES", blocksize=256, overviews="AUTO")
+    return ruta_destino
+
+
+def escribir_derivados(ruta: str, bandas: np.ndarray, perfil: dict,
+                       estadisticas: dict | None = None) -> dict:
+    """
+    Renders every display mode of `ruta` (already read with
+    leer_reflectancia) next to it as {base}_{modo}.tif. Returns
+    {modo: ruta_derivado}; empty when the image has no valid pixel, since
+    there is nothing to show.
+    """
+    if not np.isfinite(bandas[BANDA_MASCARA - 1]).any():
+        return {}
+    base = os.path.splitext(ruta)[0]
+    return {modo: escribir_rgb(componer_rgb(bandas, modo, estadisticas), perfil,
+                               f"{base}_{modo}.tif")
+            for modo in MODOS}
+
+
+def _formato_overlay() -> str:
+    with rasterio.Env() as entorno:
+        return "WEBP" if "WEBP" in entorno.drivers() else "PNG"
+
+
+def overlay_web(ruta: str, lado: int = LADO_OVERLAY) -> tuple:
+    """
+    Reprojects the uint8 RGB rendering `ruta` to Web Mercator, at most
+    `lado` pixels per side, and encodes it as an RGBA WebP (PNG when GDAL
+    has no WebP driver) with pixels that are 0 in every channel, i.e.
+    nodata, transparent. Returns (data_url, [[sur, oeste], [norte, este]]),
+    the arguments of folium's ImageOverlay; the payload size is bounded by
+    `lado` whatever the raster size.
+    """
+    with rasterio.open(ruta) as src:
+        destino, ancho, alto = calculate_default_transform(
+            src.crs, "EPSG:3857", src.width, src.height, *src.bounds)
+        escala = max(ancho, alto) / lado
+        if escala > 1:
+            ancho, alto = max(1, round(ancho / escala)), max(1, round(alto / escala))
+            destino, ancho, alto = calculate_default_transform(
+                src.crs, "EPSG:3857", src.width, src.height, *src.bounds,
+                dst_width=ancho, dst_height=alto)
+        # Decimated read first, so overviews do most of the work.
+        lectura = max(1.0, escala)
+        forma   = (3, max(1, round(src.height / lectura)), max(1, round(src.width / lectura)))
+        origen  = src.read([1, 2, 3], out_shape=forma)
+        transform_origen = src.transform * src.transform.scale(src.width / forma[2],
+                                                               src.height / forma[1])
+        crs_origen = src.crs
+
+    rgba = np.zeros((4, alto, ancho), dtype=np.uint8)
+    reproject(origen, rgba[:3], src_transform=transform_origen, src_crs=crs_origen,
+              dst_transform=destino, dst_crs="EPSG:3857", resampling=Resampling.nearest)
+    rgba[3] = np.where(rgba[:3].any(axis=0), 255, 0)
+
+    formato = _formato_overlay()
+    opciones = {"QUALITY": CALIDAD_WEBP} if formato == "WEBP" else {}
+    with MemoryFile() as memoria:
+        with memoria.open(driver="GTiff", width=ancho, height=alto, count=4, dtype="uint8",
+                          crs="EPSG:3857", transform=destino) as dst:
+            dst.write(rgba)
+        with memoria.open() as src, MemoryFile() as salida:
+            copiar_raster(src, salida.name, driver=formato, **opciones)
+            contenido = salida.read()
+
+    oeste, norte = destino * (0, 0)
+    este, sur    = destino * (ancho, alto)
+    oeste, sur, este, norte = transform_bounds("EPSG:3857", "EPSG:4326", oeste, sur, este, norte)
+    url = f"data:image/{formato.lower()};base64,{base64.b64encode(contenido).decode()}"
+    return url, [[sur, oeste], [norte, este]]
+
+
+# ── Benchmark ─────────────────────────────────────────────────────
+
+def _render_float64(ruta: str, modo: str) -> tuple:
+    """The app's previous path: emptiness scan, second decode, float64 stretch per band."""
+    import rioxarray
+
+    banda = rioxarray.open_rasterio(ruta, mask_and_scale=True).sel(band=3).values.astype(float)
+    tiene_datos = bool(np.any(~np.isnan(banda)))
+    datos = rioxarray.open_rasterio(ruta, mask_and_scale=True).values
+
+    def estirar(band):
+        valid = band[~np.isnan(band)]
+        if valid.size == 0:
+            return np.zeros_like(band)
+        p2, p98 = np.percentile(valid, PERCENTILES)
+        if p98 == p2:
+            return np.where(np.isnan(band), 0.0, 0.5)
+        stretched = np.clip((band - p2) / (p98 - p2), 0, 1)
+        stretched = np.power(stretched, 1 / GAMMA)
+        return np.where(np.isnan(band), 0.0, stretched)
+
+    indices  = BANDAS_MODO[modo]
+    canales  = {i: estirar(datos[i - 1].astype(float)) for i in set(indices)}
+    rgb      = np.stack([canales[i] for i in indices])
+    rgb[:, np.isnan(datos[BANDA_MASCARA - 1].astype(float))] = 0.0
+    return (rgb * 255).astype(np.uint8), tiene_datos
+
+
+def _render_float32(ruta: str, modo: str) -> tuple:
+    bandas, _ = leer_reflectancia(ruta)
+    return renderizar(bandas, modo)
+
+
+def _medir(funcion, *args) -> tuple:
+    """(result, best seconds of 3, peak traced MB of one run)."""
+    tiempos = []
+    for _ in range(3):
+        inicio = time.perf_counter()
+        resultado = funcion(*args)
+        tiempos.append(time.perf_counter() - inicio)
+    tracemalloc.start()
+    funcion(*args)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return resultado, min(tiempos), pico / 1e6
+
+
+def main(rutas: list):
+    print(f"{'file':<28} {'mode':<8} {'f64 ms':>8} {'f32 ms':>8} {'f64 MB':>8} {'f32 MB':>8} {'max diff':>9}")
+    for ruta in rutas:
+        nombre = os.path.basename(os.path.dirname(ruta)) + "/" + os.path.basename(ruta)
+        for modo in MODOS:
+            (rgb_64, datos_64), t_64, mb_64 = _medir(_render_float64, ruta, modo)
+            (rgb_32, datos_32), t_32, mb_32 = _medir(_render_float32, ruta, modo)
+            diferencia = int(np.abs(rgb_64.astype(int) - rgb_32).max())
+            aviso = "" if datos_64 == datos_32 else "  (emptiness differs)"
+            print(f"{nombre[-28:]:<28} {modo:<8} {t_64 * 1000:>8.1f} {t_32 * 1000:>8.1f} "
+                  f"{mb_64:>8.1f} {mb_32:>8.1f} {diferencia:>9}{aviso}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        raise SystemExit(__doc__)
+    main(sys.argv[1:])